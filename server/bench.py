@@ -0,0 +1,4 @@
+from shardingApp.benchmarks import main
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,239 @@
+import atexit
+import functools
+import multiprocessing as mp
+import struct
+import threading
+from multiprocessing.connection import Connection
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable
+from . import events
+
+
+class ShardHead:
+	'''
+	Chain head of one shard, published by its actor through shared memory.
+	The coordinator reads it without messaging the actor. Uses a sequence lock: the writer makes the
+	sequence odd while writing, and readers retry until they see the same even sequence before and after.
+
+	Layout
+		<SEQUENCE u64><HEIGHT u64><TIP_VERSION u64><CONFIRMED u64><MEMPOOL u64><TIP_HASH 32 bytes><STATE_ROOT 32 bytes>
+
+	Attributes
+		_memory: SharedMemory
+			Shared memory block holding the head
+	'''
+	_layout = struct.Struct('<QQQQQ32s32s')
+
+	def __init__(self) -> None:
+		self._memory = SharedMemory(create=True, size=self._layout.size)
+		self._layout.pack_into(self._memory.buf, 0, 0, 0, 0, 0, 0, bytes(32), bytes(32))
+
+
+	@property
+	def name(self) -> str:
+		""" Getter for shared memory block name """
+		return self._memory.name
+
+
+	def publish(self, network: 'WalletController') -> None:
+		""" Write network's chain head. Only called by the owning actor """
+		sequence = self._layout.unpack_from(self._memory.buf, 0)[0]
+		struct.pack_into('<Q', self._memory.buf, 0, sequence + 1)
+		snapshot = network.chain.snapshot
+		self._layout.pack_into(self._memory.buf, 0, sequence + 1, snapshot.height, snapshot.version,
+			snapshot.confirmed_count, network.chain.unconfirmed_count(), snapshot.tip_hash, snapshot.state_root)
+		struct.pack_into('<Q', self._memory.buf, 0, sequence + 2)
+
+
+	def read(self) -> dict:
+		""" Consistent copy of the latest published head """
+		while True:
+			before, height, tip_version, confirmed, mempool, tip_hash, state_root = self._layout.unpack_from(self._memory.buf, 0)
+			after = struct.unpack_from('<Q', self._memory.buf, 0)[0]
+			if before == after and before % 2 == 0:
+				return {
+					'height': height,
+					'tipVersion': tip_version,
+					'confirmed': confirmed,
+					'mempool': mempool,
+					'tipHash': tip_hash.hex(),
+					'stateRoot': state_root.hex()
+				}
+
+
+	def close(self) -> None:
+		""" Release shared memory block """
+		self._memory.close()
+		self._memory.unlink()
+
+
+class ShardActor:
+	'''
+	Long-lived process owning one shard's ledger, mempool and chain.
+	The coordinator sends (command, args) messages over a pipe, where command is a dotted path to a
+	WalletController method (e.g. 'process_transaction_request' or 'chain.headers'), or 'mine'.
+	'mine' commands go over a second pipe to a mining thread, so the actor keeps serving other commands
+	while it mines. Both threads take the network's lock around state changes.
+	The actor publishes its chain head to shared memory after every state change and mined block.
+	Events the shard publishes are forwarded to the coordinator's event bus.
+
+	Attributes
+		_shard_id: int
+			Shard owned by actor
+		_conn: Connection
+			Coordinator end of the command pipe
+		_mine_conn: Connection
+			Coordinator end of the mining pipe
+		_process: mp.Process
+			Actor process
+		_head: ShardHead
+			Shared memory chain head
+		_lock: threading.Lock
+			Keeps one request in flight on the command pipe, when the coordinator serves requests from several threads
+		_mine_lock: threading.Lock
+			Keeps one request in flight on the mining pipe
+		_events: mp.Queue
+			Events forwarded by the actor, published on the coordinator's bus by a relay thread
+		_stopped: bool
+			Actor was stopped and its shared memory released
+	'''
+	def __init__(self, shard_id: int, network: 'WalletController', miner: Callable) -> None:
+		self._shard_id = shard_id
+		self._head = ShardHead()
+		self._head.publish(network)
+		self._conn, actor_conn = mp.Pipe()
+		self._mine_conn, actor_mine_conn = mp.Pipe()
+		self._lock = threading.Lock()
+		self._mine_lock = threading.Lock()
+		self._stopped = False
+		self._events = mp.Queue()
+		events.bus.relay(self._events)
+		# Not a daemon, since daemonic processes cannot start miner processes
+		self._process = mp.Process(target=ShardActor._serve, args=(shard_id, network, miner, actor_conn, actor_mine_conn, self._head,
+			self._events, events.bus.shared_subscriptions()), name=f'shard-{shard_id}')
+		self._process.start()
+		actor_conn.close()
+		actor_mine_conn.close()
+
+
+	@staticmethod
+	def _serve(shard_id: int, network: 'WalletController', miner: Callable, conn: Connection, mine_conn: Connection, head: ShardHead,
+			event_queue: mp.Queue, subscriptions) -> None:
+		""" Actor loop. Runs commands until told to stop, or the coordinator goes away, while a thread mines """
+		events.bus.forward_to(event_queue.put, subscriptions)
+		# Shared memory head has a single writer at a time
+		publishing = threading.Lock()
+		def publish() -> None:
+			with publishing:
+				head.publish(network)
+		mining = threading.Thread(target=ShardActor._serve_mining, args=(shard_id, network, miner, mine_conn, publish), daemon=True)
+		mining.start()
+		while True:
+			try:
+				command, args = conn.recv()
+			except EOFError:
+				return
+			if command == 'stop':
+				mining.join()
+				conn.send(('ok', None))
+				return
+			try:
+				with network.lock:
+					result = functools.reduce(getattr, command.split('.'), network)(*args)
+				reply = ('ok', result)
+			except Exception as error:
+				reply = ('error', error)
+			publish()
+			conn.send(reply)
+
+
+	@staticmethod
+	def _serve_mining(shard_id: int, network: 'WalletController', miner: Callable, conn: Connection, publish: Callable) -> None:
+		""" Mining thread loop. Runs 'mine' commands until told to stop, or the coordinator goes away """
+		while True:
+			try:
+				command, args = conn.recv()
+			except EOFError:
+				return
+			if command == 'stop':
+				conn.send(('ok', None))
+				return
+			try:
+				reply = ('ok', miner(*args, network, shard_id, publish))
+			except Exception as error:
+				reply = ('error', error)
+			publish()
+			conn.send(reply)
+
+
+	def _pipe(self, command: str) -> tuple[Connection, threading.Lock]:
+		""" Coordinator end of the pipe serving command, and its lock """
+		if command == 'mine':
+			return self._mine_conn, self._mine_lock
+		return self._conn, self._lock
+
+
+	def send(self, command: str, *args) -> None:
+		""" Send command without waiting for the reply. Must be followed by receive """
+		conn, lock = self._pipe(command)
+		lock.acquire()
+		conn.send((command, args))
+
+
+	def receive(self, command: str):
+		''' Wait for reply to the command sent
+
+		Raises
+			Exception raised by the command inside the actor
+		'''
+		conn, lock = self._pipe(command)
+		try:
+			status, result = conn.recv()
+		finally:
+			lock.release()
+		if status == 'error':
+			raise result
+		return result
+
+
+	def request(self, command: str, *args):
+		""" Run command in actor and return its result """
+		self.send(command, *args)
+		return self.receive(command)
+
+
+	def head(self) -> dict:
+		""" Read actor's chain head from shared memory """
+		return self._head.read()
+
+
+	def stop(self) -> None:
+		""" Stop actor process and release its shared memory """
+		if self._stopped:
+			return
+		if self._process.is_alive():
+			# Waits for a mining round in flight, then ends the actor's mining thread
+			with self._mine_lock:
+				self._mine_conn.send(('stop', ()))
+				self._mine_conn.recv()
+			self.request('stop')
+		self._process.join()
+		self._head.close()
+		# Ends relay thread
+		self._events.put(None)
+		self._stopped = True
+
+
+def start_actors(networks: list['WalletController'], miner: Callable) -> list[ShardActor]:
+	'''
+	Start one actor per shard network. Actors are stopped when the coordinator exits
+
+	Arguments
+		networks: list['WalletController']
+			Shard networks, moved into their actor. The coordinator's copies must not be used afterwards
+		miner: Callable
+			Called in the actor as miner(*args, network, shard_id, on_block) for 'mine' commands
+	'''
+	actors = [ShardActor(shard_id, network, miner) for shard_id, network in enumerate(networks)]
+	atexit.register(lambda: [actor.stop() for actor in actors])
+	return actors
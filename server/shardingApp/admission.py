@@ -0,0 +1,91 @@
+import math
+import time
+
+
+class AdmissionRejected(Exception):
+	'''
+	Raised when a transaction is turned away because the network is overloaded, not because it is invalid
+
+	Attributes
+		retry_after: int
+			Seconds the client should wait before retrying
+	'''
+	def __init__(self, retry_after: int) -> None:
+		super().__init__(f'Overloaded, retry after {retry_after}s')
+		self.retry_after = retry_after
+
+
+	def __reduce__(self):
+		# Rebuilt from retry_after when sent back from a shard actor
+		return AdmissionRejected, (self.retry_after,)
+
+
+class AdmissionController:
+	'''
+	Class applying per sender and per shard quotas before any parsing or signature work.
+	Estimates how fast the mempool drains from the number of confirmed transactions,
+	so rejected clients are told how long the backlog will take to clear.
+
+	Attributes
+		_max_mempool: int
+			Maximum number of transactions in the shard mempool
+		_max_per_sender: int
+			Maximum number of unconfirmed transactions of a single sender, admitted or buffered
+		_drain_rate: float
+			Moving average of transactions confirmed per second. 0 until mining has been observed
+		_last_confirmed: int
+			Confirmed transaction count at last sample
+		_last_sample: float
+			Time of last sample
+	'''
+	_sample_interval = 0.5
+	_smoothing = 0.3
+	_default_retry = 5
+	_max_retry = 60
+
+	def __init__(self, max_mempool: int = 5000, max_per_sender: int = 64) -> None:
+		self._max_mempool = max_mempool
+		self._max_per_sender = max_per_sender
+		self._drain_rate = 0.0
+		self._last_confirmed = 0
+		self._last_sample = time.monotonic()
+
+
+	@property
+	def drain_rate(self) -> float:
+		""" Getter for estimated transactions confirmed per second """
+		return self._drain_rate
+
+
+	def observe(self, confirmed: int) -> None:
+		""" Update drain rate from running count of confirmed transactions """
+		now = time.monotonic()
+		elapsed = now - self._last_sample
+		if elapsed < self._sample_interval:
+			return
+		rate = max(confirmed - self._last_confirmed, 0) / elapsed
+		self._drain_rate = rate if self._drain_rate == 0 else \
+			self._smoothing * rate + (1 - self._smoothing) * self._drain_rate
+		self._last_confirmed = confirmed
+		self._last_sample = now
+
+
+	def retry_after(self, backlog: int) -> int:
+		""" Seconds until backlog transactions drain at the current rate """
+		if self._drain_rate <= 0:
+			return self._default_retry
+		return min(max(math.ceil(backlog / self._drain_rate), 1), self._max_retry)
+
+
+	def check(self, mempool_depth: int, sender_in_flight: int) -> None:
+		'''
+		Checks shard and sender quotas
+
+		Raises
+			AdmissionRejected if either quota is used up
+		'''
+		if mempool_depth >= self._max_mempool:
+			raise AdmissionRejected(self.retry_after(mempool_depth - self._max_mempool + 1))
+		if sender_in_flight >= self._max_per_sender:
+			# Sender's oldest transaction can be anywhere in the mempool
+			raise AdmissionRejected(self.retry_after(mempool_depth))
@@ -0,0 +1,236 @@
+'''
+Microbenchmarks of model hot paths.
+
+Each benchmark is calibrated to run for at least min_time per repeat, then timed over several
+repeats with garbage collection off. The minimum is the most stable estimate of the cost of a
+call, the median shows noise. Allocations are measured in a separate, untimed pass with
+tracemalloc, since tracing slows every allocation down.
+
+Results are saved as JSON, and compared against a saved baseline to flag regressions.
+
+Usage
+	python -m shardingApp.benchmarks --save baseline.json
+	python -m shardingApp.benchmarks --compare baseline.json --threshold 0.1
+'''
+import argparse
+import gc
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Callable
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import RSA
+from Crypto.Signature import pkcs1_15
+from .models import Block, BlockChain, Miner, Transaction, Wallet
+
+""" Name and setup function of every benchmark. Setup returns the function to time """
+_benchmarks: dict[str, Callable[[], Callable[[], None]]] = {}
+
+
+def benchmark(name: str) -> Callable:
+	""" Decorator registering a benchmark setup function """
+	def register(setup: Callable[[], Callable[[], None]]) -> Callable:
+		_benchmarks[name] = setup
+		return setup
+	return register
+
+
+def _signed_transaction() -> tuple[str, bytes, str]:
+	""" Transaction, public key and hex signature, in the format requests use """
+	key = RSA.generate(2048)
+	public_key = key.public_key().export_key('PEM')
+	transaction = f'1:Alice:{public_key.hex()}:Bob:0'
+	signature = pkcs1_15.new(key).sign(SHA256.new(transaction.encode('utf8')))
+	return transaction, public_key, signature.hex()
+
+
+@benchmark('parse_string')
+def _parse_string() -> Callable[[], None]:
+	transaction, _, _ = _signed_transaction()
+	return lambda: Transaction.parse_string(transaction)
+
+
+@benchmark('verify_signature')
+def _verify_signature() -> Callable[[], None]:
+	transaction, public_key, signature = _signed_transaction()
+	return lambda: Transaction.verify_signature(transaction, public_key, signature)
+
+
+@benchmark('calculate_block_hash')
+def _calculate_block_hash() -> Callable[[], None]:
+	block = Block(bytes(32), [b'1:Alice:00:Bob:0'])
+	return block.calculate_block_hash
+
+
+@benchmark('miner_iteration')
+def _miner_iteration() -> Callable[[], None]:
+	block = Block(bytes(32), [b'1:Alice:00:Bob:0'])
+	def iteration() -> None:
+		Miner.attempt(block)
+	return iteration
+
+
+@benchmark('mempool_roundtrip')
+def _mempool_roundtrip() -> Callable[[], None]:
+	chain = BlockChain(difficulty=0)
+	transaction = b'1:Alice:00:Bob:0'
+	def roundtrip() -> None:
+		chain.append_unconfirmed(transaction)
+		chain.unconfirmed_head()
+	return roundtrip
+
+
+@benchmark('wallet_construction')
+def _wallet_construction() -> Callable[[], None]:
+	return lambda: Wallet('Alice', 0)
+
+
+def calibrate(func: Callable[[], None], min_time: float) -> int:
+	""" Smallest power of two iteration count that runs for at least min_time """
+	iterations = 1
+	while True:
+		start = time.perf_counter()
+		for _ in range(iterations):
+			func()
+		if time.perf_counter() - start >= min_time:
+			return iterations
+		iterations *= 2
+
+
+def measure(func: Callable[[], None], iterations: int, repeats: int) -> list[float]:
+	""" Seconds per call in each repeat, with garbage collection off """
+	timings: list[float] = []
+	gc_enabled = gc.isenabled()
+	gc.disable()
+	try:
+		for _ in range(repeats):
+			start = time.perf_counter()
+			for _ in range(iterations):
+				func()
+			timings.append((time.perf_counter() - start) / iterations)
+	finally:
+		if gc_enabled:
+			gc.enable()
+	return timings
+
+
+def allocations(func: Callable[[], None], iterations: int) -> tuple[int, int]:
+	''' Memory allocated by calls, traced with tracemalloc
+
+		Returns
+			Bytes still held per call after it returns, and the most bytes one call held at once
+	'''
+	# Warm caches, so one-off allocations are not charged to the calls
+	func()
+	tracemalloc.start()
+	try:
+		first, _ = tracemalloc.get_traced_memory()
+		peak = 0
+		for _ in range(iterations):
+			start, _ = tracemalloc.get_traced_memory()
+			tracemalloc.reset_peak()
+			func()
+			_, call_peak = tracemalloc.get_traced_memory()
+			peak = max(peak, call_peak - start)
+		last, _ = tracemalloc.get_traced_memory()
+	finally:
+		tracemalloc.stop()
+	return max(last - first, 0) // iterations, peak
+
+
+def run(names: list[str] = None, repeats: int = 5, min_time: float = 0.2) -> dict[str, dict]:
+	'''
+	Run benchmarks
+
+	Arguments
+		names: list[str]
+			Benchmarks to run. Every benchmark if None
+		repeats: int
+			Number of timed repeats
+		min_time: float
+			Minimum seconds per repeat
+
+	Returns
+		Dictionary of each benchmark's iterations, min and median seconds per call,
+		bytes retained per call and peak bytes allocated by one call
+	'''
+	results: dict[str, dict] = {}
+	for name in names or list(_benchmarks):
+		func = _benchmarks[name]()
+		iterations = calibrate(func, min_time)
+		timings = measure(func, iterations, repeats)
+		retained, peak = allocations(func, min(iterations, 100))
+		results[name] = {
+			'iterations': iterations,
+			'min': min(timings),
+			'median': statistics.median(timings),
+			'retainedBytes': retained,
+			'peakBytes': peak
+		}
+	return results
+
+
+def compare(results: dict[str, dict], baseline: dict[str, dict], threshold: float = 0.1) -> list[tuple[str, str, float, float]]:
+	'''
+	Find benchmarks slower, or allocating more, than baseline by more than threshold
+
+	Returns
+		List of (benchmark, metric, baseline value, new value) regressions
+	'''
+	regressions: list[tuple[str, str, float, float]] = []
+	for name, result in results.items():
+		if name not in baseline:
+			continue
+		for metric in ('min', 'peakBytes'):
+			old, new = baseline[name][metric], result[metric]
+			if new > old * (1 + threshold):
+				regressions.append((name, metric, old, new))
+	return regressions
+
+
+def save(path: str, results: dict[str, dict]) -> None:
+	""" Write results with the interpreter and machine they were measured on """
+	with open(path, 'w') as results_file:
+		json.dump({
+			'python': platform.python_version(),
+			'machine': platform.machine(),
+			'benchmarks': results
+		}, results_file, indent=2)
+
+
+def load(path: str) -> dict[str, dict]:
+	""" Read benchmark results written by save """
+	with open(path) as results_file:
+		return json.load(results_file)['benchmarks']
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description='Benchmark model hot paths')
+	parser.add_argument('names', nargs='*', help=f"Benchmarks to run, from {', '.join(_benchmarks)}")
+	parser.add_argument('--repeats', type=int, default=5)
+	parser.add_argument('--min-time', type=float, default=0.2, help='Minimum seconds per repeat')
+	parser.add_argument('--save', help='Write results to JSON file')
+	parser.add_argument('--compare', help='Baseline JSON file to compare against')
+	parser.add_argument('--threshold', type=float, default=0.1, help='Relative slowdown reported as regression')
+	args = parser.parse_args()
+
+	results = run(args.names or None, args.repeats, args.min_time)
+	for name, result in results.items():
+		print(f"{name:<22} {result['min'] * 1e6:>12.2f}us min {result['median'] * 1e6:>12.2f}us median "
+			f"{result['peakBytes']:>8}B peak {result['retainedBytes']:>6}B retained {result['iterations']:>8} iterations")
+	if args.save:
+		save(args.save, results)
+	if args.compare:
+		regressions = compare(results, load(args.compare), args.threshold)
+		for name, metric, old, new in regressions:
+			print(f'REGRESSION {name} {metric}: {old:.6g} -> {new:.6g} ({new / old - 1:+.0%})' if old else
+				f'REGRESSION {name} {metric}: {old:.6g} -> {new:.6g}')
+		if regressions:
+			sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
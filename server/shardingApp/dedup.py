@@ -0,0 +1,165 @@
+'''
+Filter of recently seen transactions, checked before any parsing or signature work.
+
+Recent transaction IDs are kept exactly in a bounded FIFO set. Older IDs fall back to a
+rotating pair of Bloom filters, which can report a transaction as seen when it was not.
+The caller confirms Bloom-only hits with a cheap nonce check, and reports the hits that
+turned out to be new transactions, so the filter can track its false-positive rate.
+'''
+import math
+import sys
+from collections import OrderedDict
+
+""" Results of SeenFilter.check: never seen, Bloom-only hit, exact hit """
+UNSEEN = 0
+MAYBE_SEEN = 1
+SEEN = 2
+
+
+class BloomFilter:
+	'''
+	Class storing set membership of 32 byte hashes in a fixed bit array
+
+	Attributes
+		_bits: bytearray
+			Bit array
+		_size: int
+			Number of bits
+		_probes: int
+			Number of bits set per item
+		_count: int
+			Number of items added
+	'''
+	def __init__(self, capacity: int, error_rate: float) -> None:
+		self._size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+		self._probes = max(1, round(self._size / capacity * math.log(2)))
+		self._bits = bytearray((self._size + 7) // 8)
+		self._count = 0
+
+
+	@property
+	def count(self) -> int:
+		""" Getter for number of items added """
+		return self._count
+
+
+	@property
+	def memory_bytes(self) -> int:
+		""" Getter for size of bit array """
+		return len(self._bits)
+
+
+	def _positions(self, item: bytes) -> list[int]:
+		""" Bit positions of item, by double hashing two halves of the item's hash """
+		first = int.from_bytes(item[:8], 'little')
+		second = int.from_bytes(item[8:16], 'little') | 1
+		return [(first + probe * second) % self._size for probe in range(self._probes)]
+
+
+	def add(self, item: bytes) -> None:
+		for position in self._positions(item):
+			self._bits[position >> 3] |= 1 << (position & 7)
+		self._count += 1
+
+
+	def __contains__(self, item: bytes) -> bool:
+		return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class SeenFilter:
+	'''
+	Class remembering transaction IDs that were accepted
+
+	Attributes
+		_exact: OrderedDict[bytes, None]
+			Most recent transaction IDs, oldest first
+		_max_exact: int
+			Maximum number of exact IDs kept
+		_generation_size: int
+			Number of IDs added to current Bloom filter before it is rotated
+		_error_rate: float
+			Target false-positive rate of each Bloom filter
+		_current: BloomFilter
+			Bloom filter IDs are added to
+		_previous: BloomFilter
+			Bloom filter of the previous generation, still checked
+		_lookups: int
+			Number of transactions checked
+		_exact_hits: int
+			Number of transactions found in the exact set
+		_bloom_hits: int
+			Number of transactions found only in a Bloom filter
+		_false_positives: int
+			Number of Bloom-only hits reported to be new transactions
+	'''
+	def __init__(self, max_exact: int = 65536, generation_size: int = 1 << 18, error_rate: float = 0.001) -> None:
+		self._exact: OrderedDict[bytes, None] = OrderedDict()
+		self._max_exact = max_exact
+		self._generation_size = generation_size
+		self._error_rate = error_rate
+		self._current = BloomFilter(generation_size, error_rate)
+		self._previous = BloomFilter(generation_size, error_rate)
+		self._lookups = self._exact_hits = self._bloom_hits = self._false_positives = 0
+
+
+	def check(self, transaction_id: bytes) -> int:
+		'''
+		Look transaction up
+
+		Returns
+			UNSEEN if transaction was never seen, MAYBE_SEEN if it might have been seen (Bloom-only hit), SEEN if it was seen
+		'''
+		self._lookups += 1
+		if transaction_id in self._exact:
+			self._exact_hits += 1
+			return SEEN
+		if transaction_id in self._current or transaction_id in self._previous:
+			self._bloom_hits += 1
+			return MAYBE_SEEN
+		return UNSEEN
+
+
+	def add(self, transaction_id: bytes) -> None:
+		""" Remember accepted transaction """
+		self._exact[transaction_id] = None
+		if len(self._exact) > self._max_exact:
+			self._exact.popitem(last=False)
+		if self._current.count >= self._generation_size:
+			self._previous = self._current
+			self._current = BloomFilter(self._generation_size, self._error_rate)
+		self._current.add(transaction_id)
+
+
+	def false_positive(self) -> None:
+		""" Record that the last Bloom-only hit was a new transaction """
+		self._false_positives += 1
+
+
+	@property
+	def memory_bytes(self) -> int:
+		""" Getter for approximate size of exact set and both Bloom filters """
+		return sys.getsizeof(self._exact) + len(self._exact) * sys.getsizeof(bytes(32)) + \
+			self._current.memory_bytes + self._previous.memory_bytes
+
+
+	def report(self) -> dict:
+		''' Filter statistics
+
+			Returns
+				Dictionary with
+					lookups -- Transactions checked
+					exactHits -- Duplicates found in exact set
+					bloomHits -- Transactions found only in a Bloom filter
+					falsePositives -- Bloom-only hits that were new transactions
+					falsePositiveRate -- Share of Bloom lookups that were false positives
+					memoryBytes -- Approximate memory used
+		'''
+		bloom_lookups = self._lookups - self._exact_hits
+		return {
+			'lookups': self._lookups,
+			'exactHits': self._exact_hits,
+			'bloomHits': self._bloom_hits,
+			'falsePositives': self._false_positives,
+			'falsePositiveRate': self._false_positives / bloom_lookups if bloom_lookups else 0.0,
+			'memoryBytes': self.memory_bytes
+		}
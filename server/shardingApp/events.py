@@ -0,0 +1,244 @@
+'''
+Push stream of mempool admissions, block confirmations and balance changes.
+
+Networks publish events to topics on the process-wide bus:
+	shard:<SHARD_ID> -- admitted, confirmed and reverted events of a network (-1 for the serial network)
+	wallet:<SHARD_ID>:<USER> -- admitted and balance events of one wallet
+
+Subscribers are asyncio queues, so one event loop can fan events out to many open streams.
+Each queue is bounded and drops its oldest event when a slow client falls behind, so publishers
+never block. Shard actors forward their events to the coordinator, which publishes them on its bus.
+The coordinator keeps its number of subscriptions in shared memory, so actors build and forward
+no events while nobody is subscribed.
+
+sse_application serves the stream as Server-Sent Events:
+	GET /events/?shardId=<SHARD_ID>[&user=<USER>,<USER>...]
+It needs an ASGI server (e.g. uvicorn shardingPoc.asgi:application), since runserver is WSGI only.
+'''
+import asyncio
+import json
+import threading
+from multiprocessing import Value
+from typing import Callable
+from urllib.parse import parse_qs
+
+
+def shard_topic(shard_id: int) -> str:
+	return f'shard:{shard_id}'
+
+
+def wallet_topic(shard_id: int, user: str) -> str:
+	return f'wallet:{shard_id}:{user}'
+
+
+class Subscription:
+	'''
+	Class queueing events of some topics for one subscriber
+
+	Attributes
+		_topics: list[str]
+			Topics subscribed to
+		_loop: asyncio.AbstractEventLoop
+			Event loop of subscriber. Events are pushed from publisher threads through it
+		_queue: asyncio.Queue[dict]
+			Events not yet read
+		_max_queued: int
+			Maximum number of unread events
+		_dropped: int
+			Number of events dropped because subscriber fell behind
+	'''
+	def __init__(self, topics: list[str], loop: asyncio.AbstractEventLoop, max_queued: int) -> None:
+		self._topics = topics
+		self._loop = loop
+		self._queue: asyncio.Queue[dict] = asyncio.Queue()
+		self._max_queued = max_queued
+		self._dropped = 0
+
+
+	@property
+	def topics(self) -> list[str]:
+		""" Getter for subscribed topics """
+		return self._topics
+
+
+	@property
+	def dropped(self) -> int:
+		""" Getter for number of events dropped """
+		return self._dropped
+
+
+	def push(self, event: dict) -> None:
+		""" Queue event from any thread, dropping the oldest unread event if full """
+		self._loop.call_soon_threadsafe(self._push, event)
+
+
+	def _push(self, event: dict) -> None:
+		if self._queue.qsize() >= self._max_queued:
+			self._queue.get_nowait()
+			self._dropped += 1
+		self._queue.put_nowait(event)
+
+
+	async def get(self) -> dict:
+		""" Wait for next event """
+		return await self._queue.get()
+
+
+class EventBus:
+	'''
+	Class fanning events out to subscribers of their topics
+
+	Attributes
+		_subscribers: dict[str, set[Subscription]]
+			Subscriptions of each topic
+		_lock: threading.Lock
+			Guards _subscribers, since events are published from request, mining and relay threads
+		_forward: Callable
+			Sends events to another process instead of publishing them here. None in the coordinator
+		_subscriptions: int
+			Number of open subscriptions
+		_shared_subscriptions: Value
+			Number of open subscriptions in shared memory, for forwarding processes. None until first requested
+		_remote_subscriptions: Value
+			Shared number of subscriptions of the bus events are forwarded to. None in the coordinator
+	'''
+	def __init__(self, max_queued: int = 256) -> None:
+		self._subscribers: dict[str, set[Subscription]] = {}
+		self._lock = threading.Lock()
+		self._max_queued = max_queued
+		self._forward = None
+		self._subscriptions = 0
+		self._shared_subscriptions = None
+		self._remote_subscriptions = None
+
+
+	def subscribe(self, topics: list[str]) -> Subscription:
+		""" Subscribe to topics. Must be called from the subscriber's running event loop """
+		subscription = Subscription(topics, asyncio.get_running_loop(), self._max_queued)
+		with self._lock:
+			for topic in topics:
+				self._subscribers.setdefault(topic, set()).add(subscription)
+			self._count_subscriptions(1)
+		return subscription
+
+
+	def unsubscribe(self, subscription: Subscription) -> None:
+		with self._lock:
+			for topic in subscription.topics:
+				subscribers = self._subscribers.get(topic, set())
+				subscribers.discard(subscription)
+				if not subscribers:
+					self._subscribers.pop(topic, None)
+			self._count_subscriptions(-1)
+
+
+	def _count_subscriptions(self, change: int) -> None:
+		""" Update number of subscriptions, and its shared copy. Called with _lock held """
+		self._subscriptions += change
+		if self._shared_subscriptions is not None:
+			self._shared_subscriptions.value = self._subscriptions
+
+
+	def shared_subscriptions(self) -> Value:
+		""" Number of open subscriptions in shared memory, kept up to date from now on. Passed to forward_to in other processes """
+		with self._lock:
+			if self._shared_subscriptions is None:
+				self._shared_subscriptions = Value('i', self._subscriptions, lock=False)
+			return self._shared_subscriptions
+
+
+	@property
+	def idle(self) -> bool:
+		""" Getter for whether no subscriber, here or in the coordinator, can receive events. Publishers skip building events while idle """
+		if self._forward is not None:
+			return self._remote_subscriptions.value == 0
+		return not self._subscribers
+
+
+	def publish(self, topics: list[str], event: dict) -> None:
+		""" Push event to every subscriber of any of topics, once each """
+		if self._forward is not None:
+			if self._remote_subscriptions.value:
+				self._forward((topics, event))
+			return
+		with self._lock:
+			subscriptions = set().union(*(self._subscribers.get(topic, ()) for topic in topics))
+		for subscription in subscriptions:
+			subscription.push(event)
+
+
+	def forward_to(self, send: Callable, subscriptions: Value) -> None:
+		'''
+		Send every event published in this process to send((topics, event)). Used by shard actors
+
+		Arguments
+			subscriptions: Value
+				shared_subscriptions() of the bus receiving the events. No events are sent while it is 0
+		'''
+		self._forward = send
+		self._remote_subscriptions = subscriptions
+
+
+	def relay(self, queue) -> threading.Thread:
+		""" Publish (topics, event) items received on queue from other processes, until None is received """
+		def run() -> None:
+			for topics, event in iter(queue.get, None):
+				self.publish(topics, event)
+		relay = threading.Thread(target=run, daemon=True, name='event-relay')
+		relay.start()
+		return relay
+
+
+""" Process-wide event bus """
+bus = EventBus()
+
+
+def _format(event: dict) -> bytes:
+	return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode('utf8')
+
+
+async def sse_application(scope: dict, receive: Callable, send: Callable, keepalive: float = 15.0) -> None:
+	'''
+	ASGI application streaming events of a shard, or of some of its wallets, as Server-Sent Events
+
+	Query parameters
+		shardId -- Network to stream. Serial network if missing
+		user -- Optional comma separated wallets to stream instead of the whole network
+	'''
+	query = parse_qs(scope.get('query_string', b'').decode('utf8'))
+	try:
+		shard_id = int(query.get('shardId', ['-1'])[0])
+	except ValueError:
+		await send({'type': 'http.response.start', 'status': 400, 'headers': []})
+		await send({'type': 'http.response.body', 'body': b''})
+		return
+	users = [user for value in query.get('user', []) for user in value.split(',') if user]
+	topics = [wallet_topic(shard_id, user) for user in users] or [shard_topic(shard_id)]
+
+	subscription = bus.subscribe(topics)
+	disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+	try:
+		await send({'type': 'http.response.start', 'status': 200, 'headers': [
+			(b'content-type', b'text/event-stream'),
+			(b'cache-control', b'no-cache'),
+			(b'x-accel-buffering', b'no')
+		]})
+		await send({'type': 'http.response.body', 'body': b': subscribed\n\n', 'more_body': True})
+		while not disconnected.done():
+			next_event = asyncio.ensure_future(subscription.get())
+			done, _ = await asyncio.wait({next_event, disconnected}, timeout=keepalive, return_when=asyncio.FIRST_COMPLETED)
+			if next_event in done:
+				await send({'type': 'http.response.body', 'body': _format(next_event.result()), 'more_body': True})
+				continue
+			next_event.cancel()
+			if not done:
+				# Comment line keeps proxies from closing an idle stream
+				await send({'type': 'http.response.body', 'body': b': keepalive\n\n', 'more_body': True})
+	finally:
+		bus.unsubscribe(subscription)
+		disconnected.cancel()
+
+
+async def _wait_for_disconnect(receive: Callable) -> None:
+	while (await receive())['type'] != 'http.disconnect':
+		pass
@@ -0,0 +1,128 @@
+from .merkle import hash_leaf, verify_proof
+from .models import BlockHeader, Miner
+from .statetree import verify_account
+
+
+class LightClient:
+	'''
+	Header-only client. Follows the longest valid header chain and checks transaction
+	confirmation with Merkle inclusion proofs, and account state with state tree proofs,
+	without downloading block transactions.
+
+	Every block carries the same work, so the longest header chain is the one with most work.
+	The first header received is trusted as Genesis.
+
+	Attributes
+		_difficulty: int
+			Number of leading 0 bytes every non-Genesis header hash needs
+		_headers: list[BlockHeader]
+			Active header chain, indexed by height
+		_heights: dict[bytes, int]
+			Height of each header in _headers
+	'''
+	def __init__(self, difficulty: int = -1) -> None:
+		self._difficulty = Miner.mining_difficulty if difficulty == -1 else difficulty
+		self._headers: list[BlockHeader] = []
+		self._heights: dict[bytes, int] = {}
+
+
+	@property
+	def height(self) -> int:
+		""" Getter for height of header chain tip """
+		return len(self._headers) - 1
+
+
+	def locator(self) -> list[bytes]:
+		""" Known block hashes, newest first, stepping back exponentially to Genesis """
+		locator: list[bytes] = []
+		height, step = self.height, 1
+		while height > 0:
+			locator.append(self._headers[height].block_hash)
+			if len(locator) >= 10:
+				step *= 2
+			height -= step
+		if self._headers:
+			locator.append(self._headers[0].block_hash)
+		return locator
+
+
+	def sync(self, headers: list[BlockHeader]) -> int:
+		'''
+		Connects consecutive headers received from a headers request.
+		A branch forking off the current chain replaces it only if it ends up longer.
+
+		Returns
+			Number of headers added to the header chain
+
+		Raises
+			ValueError if headers do not link together or do not meet difficulty
+		'''
+		genesis_added = 0
+		if headers and not self._headers:
+			self._headers.append(headers[0])
+			self._heights[headers[0].block_hash] = 0
+			headers, genesis_added = headers[1:], 1
+		if not headers:
+			return genesis_added
+		if headers[0].prev_hash not in self._heights:
+			raise ValueError
+		for parent, child in zip(headers, headers[1:]):
+			if child.prev_hash != parent.block_hash:
+				raise ValueError
+		if not all(header.meets_difficulty(self._difficulty) for header in headers):
+			raise ValueError
+
+		fork_height = self._heights[headers[0].prev_hash]
+		if fork_height + len(headers) <= self.height:
+			return genesis_added
+		for header in self._headers[fork_height + 1:]:
+			del self._heights[header.block_hash]
+		del self._headers[fork_height + 1:]
+		for header in headers:
+			self._heights[header.block_hash] = len(self._headers)
+			self._headers.append(header)
+		return genesis_added + len(headers)
+
+
+	def confirmations(self, block_hash: bytes) -> int:
+		""" Number of headers on top of and including block. 0 if block is not in header chain """
+		if block_hash not in self._heights:
+			return 0
+		return self.height - self._heights[block_hash] + 1
+
+
+	def verify_transaction(self, transaction: bytes, block_hash: bytes, proof: list[tuple[bytes, bool]], min_confirmations: int = 1) -> bool:
+		'''
+		Checks transaction is included in block of the header chain, with enough blocks on top
+
+		Arguments
+			transaction: bytes
+				Encoded transaction string
+			block_hash: bytes
+				Hash of block the transaction was confirmed in
+			proof: list[tuple[bytes, bool]]
+				Merkle inclusion proof of transaction in block
+			min_confirmations: int
+				Number of headers needed on top of and including block
+		'''
+		if self.confirmations(block_hash) < min_confirmations:
+			return False
+		header = self._headers[self._heights[block_hash]]
+		return verify_proof(hash_leaf(transaction), proof, header.merkle_root)
+
+
+	def verify_account(self, username: str, value: tuple[int, int], proof: tuple[list[bytes], tuple], block_hash: bytes,
+			min_confirmations: int = 1) -> bool:
+		'''
+		Checks account had state value after block of the header chain, with enough blocks on top
+
+		Arguments
+			value: tuple[int, int]
+				Confirmed (balance change, nonce) of account. EMPTY_ACCOUNT to check account has no confirmed state
+			proof: tuple[list[bytes], tuple]
+				State tree proof of account against the block's state root
+		'''
+		if self.confirmations(block_hash) < min_confirmations:
+			return False
+		header = self._headers[self._heights[block_hash]]
+		return verify_account(header.state_root, username, value, proof)
@@ -0,0 +1,278 @@
+'''
+Signed workload generator and replay files.
+
+Workloads are planned in one pass (payer/payee choice and nonces), then signed in parallel
+and written to a compact replay file. Replay files are memory-mapped and streamed into the
+server at a controlled rate, so benchmark runs measure the server instead of client-side signing.
+
+Replay file format (little endian)
+	Header: <MAGIC 8 bytes><RECORD_COUNT u32>
+	Record: <SHARD_ID i16><TRANSACTION_LENGTH u16><SIGNATURE_LENGTH u16><TRANSACTION><SIGNATURE>
+
+Usage
+	python -m shardingApp.loadgen generate --keys keys.json --count 10000 --skew 1.2 --payee-skew 1.2 --out workload.rpl
+	python -m shardingApp.loadgen replay workload.rpl --url http://localhost:8000/parse-transactions --rate 200
+
+keys.json is a list of wallet information returned by /provision-keys/ (including privKey).
+'''
+import argparse
+import json
+import mmap
+import multiprocessing as mp
+import random
+import struct
+import time
+import urllib.error
+import urllib.request
+from typing import Callable, Iterator
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import RSA
+from Crypto.Signature import pkcs1_15
+
+_MAGIC = b'SHRDRPL1'
+_HEADER = struct.Struct('<8sI')
+_RECORD = struct.Struct('<hHH')
+
+""" Per worker process cache of imported private keys """
+_signers: dict[str, pkcs1_15.PKCS115_SigScheme] = {}
+
+
+def _zipf_weights(rng: random.Random, size: int, skew: float) -> list[float]:
+	""" Zipf weight of each index, with exponent skew, over a random popularity order """
+	hot_order = list(range(size))
+	rng.shuffle(hot_order)
+	weights = [0.0] * size
+	for rank, index in enumerate(hot_order):
+		weights[index] = 1 / (rank + 1) ** skew
+	return weights
+
+
+def plan_workload(wallets: list[dict[str, str]], count: int, skew: float = 0.0, cross_shard_ratio: float = 0.0, seed: int = -1,
+		payee_skew: float = 0.0) -> list[tuple[str, int, str]]:
+	'''
+	Chooses payer/payee pairs and assigns each payer consecutive nonces.
+	Transaction is formatted as <AMOUNT>:<USERNAME>:<PUBLIC_KEY>:<PAYEE>:<NONCE>
+	Payers alone in their shard pay across shards if cross_shard_ratio allows it, and are never picked otherwise
+
+	Arguments
+		wallets: list[dict[str, str]]
+			Wallet information with 'user', 'pubKey' and 'shardId'. Optional 'nonce' is the next unused nonce
+		count: int
+			Number of transactions to generate
+		skew: float
+			Zipf exponent of payer popularity. 0 picks payers uniformly, higher values concentrate load on hot keys
+		cross_shard_ratio: float
+			Probability payee is in a different shard than payer, if one exists
+		seed: int
+			Random seed. -1 for a random workload
+		payee_skew: float
+			Zipf exponent of payee popularity. 0 picks payees uniformly
+
+	Returns
+		List of count (payer, shard_id, transaction_str) in submission order
+
+	Raises
+		ValueError if no wallet has a payee to pay
+	'''
+	rng = random.Random(None if seed == -1 else seed)
+	weights = _zipf_weights(rng, len(wallets), skew)
+	payee_weights = _zipf_weights(rng, len(wallets), payee_skew) if payee_skew else []
+
+	by_shard: dict[int, list[int]] = {}
+	for wallet_index, wallet in enumerate(wallets):
+		by_shard.setdefault(int(wallet['shardId']), []).append(wallet_index)
+	nonces = [int(wallet.get('nonce', 0)) for wallet in wallets]
+	crosses_shards = len(by_shard) > 1 and cross_shard_ratio > 0
+	for wallet_index, wallet in enumerate(wallets):
+		if len(by_shard[int(wallet['shardId'])]) == 1 and not crosses_shards:
+			weights[wallet_index] = 0.0
+	if count and not any(weights):
+		raise ValueError
+
+	workload: list[tuple[str, int, str]] = []
+	for payer_index in rng.choices(range(len(wallets)), weights=weights, k=count):
+		payer = wallets[payer_index]
+		shard_id = int(payer['shardId'])
+		candidates = [index for index in by_shard[shard_id] if index != payer_index]
+		# Payers left without candidates were only picked if they can pay across shards
+		if len(by_shard) > 1 and (rng.random() < cross_shard_ratio or not candidates):
+			candidates = by_shard[rng.choice([other for other in by_shard if other != shard_id])]
+		if payee_weights:
+			payee = wallets[rng.choices(candidates, weights=[payee_weights[index] for index in candidates])[0]]
+		else:
+			payee = wallets[rng.choice(candidates)]
+		transaction = f"1:{payer['user']}:{payer['pubKey']}:{payee['user']}:{nonces[payer_index]}"
+		nonces[payer_index] += 1
+		workload.append((payer['user'], shard_id, transaction))
+	return workload
+
+
+def _init_signer(priv_keys: dict[str, str]) -> None:
+	""" Import every private key once per worker process. Users sharing a key share its signer """
+	imported: dict[str, pkcs1_15.PKCS115_SigScheme] = {}
+	for user, priv_key in priv_keys.items():
+		if priv_key not in imported:
+			imported[priv_key] = pkcs1_15.new(RSA.import_key(bytes.fromhex(priv_key)))
+		_signers[user] = imported[priv_key]
+
+
+def _sign(item: tuple[str, int, str]) -> tuple[int, bytes, bytes]:
+	""" Sign planned transaction with payer's private key """
+	user, shard_id, transaction = item
+	encoded = bytes(transaction, encoding='utf8')
+	return shard_id, encoded, _signers[user].sign(SHA256.new(encoded))
+
+
+def sign_workload(workload: list[tuple[str, int, str]], priv_keys: dict[str, str], workers: int = -1) -> list[tuple[int, bytes, bytes]]:
+	'''
+	Signs planned transactions in parallel, preserving order
+
+	Arguments
+		workload: list[tuple[str, int, str]]
+			Output of plan_workload
+		priv_keys: dict[str, str]
+			Hex PEM private key of each payer
+		workers: int
+			Number of signing processes. -1 uses every CPU
+
+	Returns
+		List of (shard_id, transaction, signature)
+	'''
+	workers = mp.cpu_count() if workers == -1 else workers
+	if workers <= 1:
+		_init_signer(priv_keys)
+		return list(map(_sign, workload))
+	with mp.Pool(workers, initializer=_init_signer, initargs=(priv_keys,)) as pool:
+		return pool.map(_sign, workload, chunksize=max(1, len(workload) // (workers * 4)))
+
+
+def write_replay(path: str, records: list[tuple[int, bytes, bytes]]) -> None:
+	""" Writes signed records to replay file """
+	with open(path, 'wb') as replay_file:
+		replay_file.write(_HEADER.pack(_MAGIC, len(records)))
+		for shard_id, transaction, signature in records:
+			replay_file.write(_RECORD.pack(shard_id, len(transaction), len(signature)))
+			replay_file.write(transaction)
+			replay_file.write(signature)
+
+
+def read_replay(path: str) -> Iterator[dict[str, str]]:
+	'''
+	Memory-maps replay file and yields transaction requests one at a time
+
+	Yields
+		Dictionary with 'transaction', 'signature' and, for sharded records, 'shardId'
+
+	Raises
+		ValueError if file is not a replay file
+	'''
+	with open(path, 'rb') as replay_file, mmap.mmap(replay_file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+		magic, count = _HEADER.unpack_from(buffer, 0)
+		if magic != _MAGIC:
+			raise ValueError
+		offset = _HEADER.size
+		for _ in range(count):
+			shard_id, transaction_length, signature_length = _RECORD.unpack_from(buffer, offset)
+			offset += _RECORD.size
+			request = {
+				'transaction': buffer[offset:offset + transaction_length].decode('utf8'),
+				'signature': buffer[offset + transaction_length:offset + transaction_length + signature_length].hex()
+			}
+			if shard_id >= 0:
+				request['shardId'] = str(shard_id)
+			offset += transaction_length + signature_length
+			yield request
+
+
+def replay(path: str, submit: Callable[[list[dict[str, str]]], int], rate: float = -1, batch_size: int = 1) -> int:
+	'''
+	Streams replay file into submit at a controlled rate
+
+	Arguments
+		path: str
+			Replay file to stream
+		submit: Callable[[list[dict[str, str]]], int]
+			Sends a batch of transaction requests, and returns number accepted
+		rate: float
+			Transactions per second. -1 streams as fast as submit allows
+		batch_size: int
+			Transactions per submit call
+
+	Returns
+		Number of accepted transactions
+	'''
+	accepted = sent = 0
+	start = time.perf_counter()
+	batch: list[dict[str, str]] = []
+	for request in read_replay(path):
+		batch.append(request)
+		if len(batch) < batch_size:
+			continue
+		if rate > 0:
+			time.sleep(max(0, start + (sent + len(batch)) / rate - time.perf_counter()))
+		accepted += submit(batch)
+		sent += len(batch)
+		batch = []
+	if batch:
+		accepted += submit(batch)
+	return accepted
+
+
+def http_submitter(url: str) -> Callable[[list[dict[str, str]]], int]:
+	""" Submit batches to the parse-transactions endpoint, waiting out 429 responses before resending the rest """
+	def submit(batch: list[dict[str, str]]) -> int:
+		accepted = 0
+		while batch:
+			req = urllib.request.Request(url, data=json.dumps(batch).encode('utf8'), headers={'Content-Type': 'application/json'})
+			try:
+				with urllib.request.urlopen(req) as res:
+					return accepted + int(json.load(res))
+			except urllib.error.HTTPError as error:
+				if error.code != 429:
+					raise
+				# Transactions before the rejected one were processed
+				progress = json.load(error)
+				accepted += progress['queued']
+				batch = batch[progress['processed']:]
+				time.sleep(int(error.headers.get('Retry-After', 1)))
+		return accepted
+	return submit
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description='Generate and replay signed transaction workloads')
+	commands = parser.add_subparsers(dest='command', required=True)
+
+	generate = commands.add_parser('generate', help='Sign workload in parallel and write replay file')
+	generate.add_argument('--keys', required=True, help='JSON list of provisioned wallet information')
+	generate.add_argument('--count', type=int, required=True)
+	generate.add_argument('--out', required=True)
+	generate.add_argument('--workers', type=int, default=-1)
+	generate.add_argument('--skew', type=float, default=0.0, help='Zipf exponent of payer popularity')
+	generate.add_argument('--payee-skew', type=float, default=0.0, help='Zipf exponent of payee popularity')
+	generate.add_argument('--cross-shard', type=float, default=0.0, help='Ratio of cross-shard transactions')
+	generate.add_argument('--seed', type=int, default=-1)
+
+	replay_cmd = commands.add_parser('replay', help='Stream replay file to server')
+	replay_cmd.add_argument('path')
+	replay_cmd.add_argument('--url', default='http://localhost:8000/parse-transactions')
+	replay_cmd.add_argument('--rate', type=float, default=-1, help='Transactions per second')
+	replay_cmd.add_argument('--batch', type=int, default=1)
+
+	args = parser.parse_args()
+	if args.command == 'generate':
+		with open(args.keys) as keys_file:
+			wallets = json.load(keys_file)
+		start = time.perf_counter()
+		workload = plan_workload(wallets, args.count, args.skew, args.cross_shard, args.seed, args.payee_skew)
+		records = sign_workload(workload, {wallet['user']: wallet['privKey'] for wallet in wallets}, args.workers)
+		write_replay(args.out, records)
+		print(f'Signed {len(records)} transactions in {time.perf_counter() - start:.2f}s')
+	else:
+		start = time.perf_counter()
+		accepted = replay(args.path, http_submitter(args.url), args.rate, args.batch)
+		print(f'{accepted} transactions accepted in {time.perf_counter() - start:.2f}s')
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,72 @@
+class PendingState:
+	'''
+	Per sender overlay of in-flight transactions on top of confirmed ledger state.
+	Transactions with the next nonce are admitted to the mempool straight away.
+	Transactions with a nonce up to _window ahead are buffered, and promoted in nonce order once the gap fills.
+	Both admitted and buffered transactions reserve their amount, so a sender can never spend more than
+	their confirmed balance.
+
+	Attributes
+		_window: int
+			Number of nonces past the next nonce that can be buffered per sender
+		_retention: int
+			Number of confirmed nonces to keep debits of, so a reorg that un-confirms them counts them again
+		_admitted: dict[str, dict[int, int]]
+			Nonce and amount of each transaction admitted to the mempool, per sender
+		_buffered: dict[str, dict[int, tuple[str, int]]]
+			Nonce, transaction string and amount of each transaction waiting on a nonce gap, per sender
+	'''
+	def __init__(self, window: int = 16, retention: int = 6) -> None:
+		self._window = window
+		self._retention = retention
+		self._admitted: dict[str, dict[int, int]] = {}
+		self._buffered: dict[str, dict[int, tuple[str, int]]] = {}
+
+
+	def can_buffer(self, sender: str, nonce: int, next_nonce: int) -> bool:
+		""" Checks nonce is ahead of next nonce, inside window, and not already buffered """
+		return next_nonce < nonce < next_nonce + self._window and \
+			nonce not in self._buffered.get(sender, {})
+
+
+	def admit(self, sender: str, nonce: int, amount: int, confirmed_nonce: int) -> None:
+		""" Record debit of transaction admitted to mempool, and drop debits confirmed beyond reorg reach """
+		admitted = self._admitted.setdefault(sender, {})
+		admitted[nonce] = amount
+		for old_nonce in [old for old in admitted if old < confirmed_nonce - self._retention]:
+			del admitted[old_nonce]
+
+
+	def buffer(self, sender: str, nonce: int, transaction_str: str, amount: int) -> None:
+		""" Hold validated transaction until every earlier nonce is admitted """
+		self._buffered.setdefault(sender, {})[nonce] = (transaction_str, amount)
+
+
+	def promote(self, sender: str, next_nonce: int) -> list[tuple[int, str, int]]:
+		'''
+		Removes buffered transactions that continue on from next_nonce without a gap
+
+		Returns
+			List of (nonce, transaction_str, amount) in nonce order
+		'''
+		buffered = self._buffered.get(sender)
+		promoted: list[tuple[int, str, int]] = []
+		while buffered and next_nonce in buffered:
+			transaction_str, amount = buffered.pop(next_nonce)
+			promoted.append((next_nonce, transaction_str, amount))
+			next_nonce += 1
+		if not buffered:
+			self._buffered.pop(sender, None)
+		return promoted
+
+
+	def pending_debits(self, sender: str, confirmed_nonce: int) -> int:
+		""" Amount reserved by sender's unconfirmed admitted and buffered transactions """
+		# Items are copied in one step first, since snapshot readers call this while ingestion changes the overlay
+		admitted = sum(amount for nonce, amount in list(self._admitted.get(sender, {}).items()) if nonce >= confirmed_nonce)
+		return admitted + sum(amount for _, amount in list(self._buffered.get(sender, {}).values()))
+
+
+	def buffered_count(self, sender: str) -> int:
+		""" Number of sender's transactions waiting on a nonce gap """
+		return len(self._buffered.get(sender, {}))
@@ -0,0 +1,70 @@
+'''
+Merkle tree helpers committing a block to its list of transactions.
+
+Leaves and inner nodes are hashed with different prefixes so an inner node can never be
+passed off as a transaction. An odd node at the end of a level is promoted unchanged.
+A proof is the list of (sibling_hash, sibling_is_left) pairs from leaf to root.
+'''
+from Crypto.Hash import SHA256
+
+_LEAF_PREFIX = b'\x00'
+_NODE_PREFIX = b'\x01'
+
+
+def hash_leaf(transaction: bytes) -> bytes:
+	""" Hash of transaction as a Merkle leaf. Doubles as transaction ID """
+	return SHA256.new(_LEAF_PREFIX + transaction).digest()
+
+
+def hash_node(left: bytes, right: bytes) -> bytes:
+	""" Hash of inner Merkle node """
+	return SHA256.new(_NODE_PREFIX + left + right).digest()
+
+
+def _next_level(level: list[bytes]) -> list[bytes]:
+	""" Hash pairs of nodes into parent level """
+	parents = [hash_node(level[index], level[index + 1]) for index in range(0, len(level) - 1, 2)]
+	if len(level) % 2:
+		parents.append(level[-1])
+	return parents
+
+
+def merkle_root(transactions: list[bytes]) -> bytes:
+	""" Root hash of transactions. Empty list has an all-zero root """
+	if not transactions:
+		return bytes(32)
+	level = [hash_leaf(transaction) for transaction in transactions]
+	while len(level) > 1:
+		level = _next_level(level)
+	return level[0]
+
+
+def merkle_proof(transactions: list[bytes], index: int) -> list[tuple[bytes, bool]]:
+	'''
+	Builds inclusion proof of transactions[index]
+
+	Returns
+		List of (sibling_hash, sibling_is_left) pairs from leaf to root
+
+	Raises
+		IndexError if index is out of range
+	'''
+	if not 0 <= index < len(transactions):
+		raise IndexError
+	proof: list[tuple[bytes, bool]] = []
+	level = [hash_leaf(transaction) for transaction in transactions]
+	while len(level) > 1:
+		sibling = index ^ 1
+		if sibling < len(level):
+			proof.append((level[sibling], sibling < index))
+		level = _next_level(level)
+		index //= 2
+	return proof
+
+
+def verify_proof(transaction_hash: bytes, proof: list[tuple[bytes, bool]], root: bytes) -> bool:
+	""" Checks proof links transaction leaf hash to Merkle root """
+	node = transaction_hash
+	for sibling, sibling_is_left in proof:
+		node = hash_node(sibling, node) if sibling_is_left else hash_node(node, sibling)
+	return node == root
@@ -1,12 +1,26 @@
 from Crypto.PublicKey import RSA
 from Crypto.Hash import SHA256
 from Crypto.Signature import pkcs1_15
+import queue
 from queue import Queue
+from ctypes import c_uint64
+from collections import OrderedDict
+import threading
 import random
 from .decorators import classproperty
-from time import sleep
-from multiprocessing.synchronize import Event
-from multiprocessing import Queue
+from .merkle import hash_leaf, merkle_proof, merkle_root
+from .mempool import PendingState
+from .admission import AdmissionController, AdmissionRejected
+from .dedup import MAYBE_SEEN, SEEN, SeenFilter
+from . import events
+from .snapshot import LedgerSnapshot
+from .statetree import StateTree
+from .storage import ColdStore
+from .actors import ShardActor, start_actors
+import functools
+from typing import Callable
+import time
+from multiprocessing import Queue, Value
 
 
 class Wallet:
@@ -17,21 +31,22 @@ class Wallet:
 		_name: str
 			Unique ID of wallet
 		_balance: int
-			Amount usable in transactions. Should point to last transaction for proof
+			Opening balance. Confirmed balance adds the wallet's net change confirmed in the blockchain
 		_pub_key: bytes
 			RSA PEM public key
 		_shard_id: int
 			Network wallet belongs to
 		_transactions: int
-			Nonce to verify transactions
+			Next nonce to admit into the mempool
 	'''
-	def __init__(self, username: str, shard_id: int) -> None:
+	def __init__(self, username: str, shard_id: int, pub_key: bytes = b'') -> None:
 		self._name = username
 		self._balance = 100
-		self._pub_key = b''
+		self._pub_key = pub_key
 		self._shard_id = shard_id
 		self._transactions = 0
-		self.generate_rsa_key_pair()
+		if not pub_key:
+			self.generate_rsa_key_pair()
 
 
 	def generate_rsa_key_pair(self) -> tuple[bytes,bytes]:
@@ -88,6 +103,12 @@ class Wallet:
 		self._shard_id = new_shard_id
 
 
+	@property
+	def nonce(self) -> int:
+		""" Getter for next nonce to admit into the mempool """
+		return self._transactions
+
+
 	def correct_nonce(self, nonce) -> bool:
 		""" Verifies nonce in transaction matches current wallet nonce """
 		return nonce == self._transactions
@@ -112,12 +133,47 @@ class WalletController():
 			Dictionary of ID, Wallet keypairs in network
 		_chain: Blockchain
 			Synced blockchain associated with wallets
+		_version: int
+			Incremented every time a wallet changes
+		_info_cache: dict[str, tuple[int, dict[str, str]]]
+			State version and public wallet information of each user
+		_names: list[str]
+			Cached list of wallet IDs, in insertion order
+		_pending: PendingState
+			Unconfirmed debits and out-of-order transactions of each sender
+		_admission: AdmissionController
+			Mempool and per sender quotas, checked before validating transactions
+		_seen: SeenFilter
+			IDs of accepted transactions, so duplicates are rejected before parsing
+		_shard_id: int
+			Network ID used in event topics. -1 for the serial network
+		_lock: threading.RLock
+			Held while admitting transactions and while a miner takes transactions from the mempool or appends
+			blocks, since the network is mined in a background thread while requests admit into it
 	'''
-	def __init__(self, names: list[str], shard_id = -1) -> None:
+	def __init__(self, names: list[str], shard_id = -1, max_body_bytes: int = -1, pub_keys: dict[str, bytes] = None, simulated: bool = False) -> None:
+		''' 
+		Arguments
+			pub_keys: dict[str, bytes]
+				PEM public key of wallets that should not generate their own key pair
+			simulated: bool
+				Blockchain accepts blocks without proof of work, for simulated mining. The duplicate filter is
+				sized for the few transactions each of thousands of simulated shards sees
+		'''
+		pub_keys = pub_keys or {}
 		self._wallets = {}
 		for name in names:
-			self._wallets[name] = self.create_user(name, shard_id)
-		self._chain = BlockChain()
+			self._wallets[name] = self.create_user(name, shard_id, pub_keys.get(name, b''))
+		self._chain = BlockChain(max_body_bytes=max_body_bytes, simulated=simulated)
+		self._version = 0
+		self._info_cache: dict[str, tuple[int, dict[str, str]]] = {}
+		self._names = list(self._wallets.keys())
+		self._pending = PendingState(retention=BlockChain._max_fork_depth)
+		self._admission = AdmissionController()
+		self._seen = SeenFilter(max_exact=1024, generation_size=1 << 12) if simulated else SeenFilter()
+		self._shard_id = shard_id
+		self._lock = threading.RLock()
+		self._chain.listen(self._on_tip_change)
 
 
 	@property
@@ -126,19 +182,68 @@ class WalletController():
 		return self._chain
 
 
+	@property
+	def lock(self) -> threading.RLock:
+		""" Getter for lock guarding mempool, ledger and pending state """
+		return self._lock
+
+
+	@property
+	def seen(self) -> SeenFilter:
+		""" Getter for filter of accepted transactions """
+		return self._seen
+
+
 	def users(self) -> list[str]:
 		""" Returns list of wallet names """
-		return list(self._wallets.keys())
+		return list(self._names)
+
+
+	@property
+	def version(self) -> int:
+		""" Getter for state version. Changes when a wallet or the blockchain tip changes. Used as ETag of wallet reads """
+		return self._version + self._chain.snapshot.version
+
+
+	def _wallet_changed(self, username: str) -> None:
+		""" Invalidate cached information of changed wallet """
+		self._version += 1
+		self._info_cache.pop(username, None)
+
 
+	def confirmed_balance(self, username: str) -> int:
+		""" Opening balance plus net change confirmed in the blockchain """
+		return self.get_user(username).balance + self._chain.confirmed_delta(username)
 
-	def create_user(self, username: str, shard_id: int) -> Wallet:
+
+	def available_balance(self, username: str) -> int:
+		""" Confirmed balance minus debits of unconfirmed transactions """
+		return self.confirmed_balance(username) - \
+			self._pending.pending_debits(username, self._chain.confirmed_nonce(username))
+
+
+	def in_flight(self, username: str) -> int:
+		""" Number of user's transactions admitted or buffered, but not yet confirmed """
+		if username not in self._wallets:
+			return 0
+		return self._wallets[username].nonce - self._chain.confirmed_nonce(username) + \
+			self._pending.buffered_count(username)
+
+
+	def nonce_acceptable(self, username: str, nonce: int) -> bool:
+		""" Verifies nonce is the next nonce, or can be buffered until the gap before it fills """
+		next_nonce = self.get_user(username).nonce
+		return nonce == next_nonce or self._pending.can_buffer(username, nonce, next_nonce)
+
+
+	def create_user(self, username: str, shard_id: int, pub_key: bytes = b'') -> Wallet:
 		''' 
 		Create new Wallet object
 		Does not allow direct modification to existing users
 		'''
 		if username in self._wallets:
 			raise KeyError
-		return Wallet(username, shard_id)
+		return Wallet(username, shard_id, pub_key)
 
 
 	def can_pay(self, payer: str, payee: str) -> bool:
@@ -159,38 +264,179 @@ class WalletController():
 		return self._wallets[username]
 
 
-	def get_user_wallet_info(self, username: str) -> dict[str, str]:
+	def get_user_wallet_info(self, username: str, snapshot: LedgerSnapshot = None) -> dict[str, str]:
+		''' Sends client public wallet information
+		Served from cache until the wallet or blockchain changes. Does not modify the wallet.
+		Confirmed state is read from a chain snapshot, so reads never see a block half applied
+
+		Arguments
+			snapshot -- Chain snapshot to read. Latest snapshot if None
+		'''
+		snapshot = snapshot or self._chain.snapshot
+		version = self._version + snapshot.version
+		cached = self._info_cache.get(username)
+		if cached is None or cached[0] != version:
+			user_wallet = self.get_user(username)
+			confirmed_balance = user_wallet.balance + snapshot.confirmed_delta(username)
+			cached = (version, {
+				'user': user_wallet.name,
+				'balance': str(confirmed_balance - self._pending.pending_debits(username, snapshot.confirmed_nonce(username))),
+				'confirmedBalance': str(confirmed_balance),
+				'shardId': user_wallet.shard_id,
+				'pubKey': user_wallet.pub_key.hex()
+			})
+			self._info_cache[username] = cached
+		return dict(cached[1])
+
+
+	def get_wallets_page(self, offset: int = 0, limit: int = -1) -> list[dict[str, str]]:
+		''' Public wallet information of users in [offset, offset + limit)
+		Returns every user from offset if limit is -1
+		'''
+		names = self._names[offset:] if limit == -1 else self._names[offset:offset + limit]
+		# Whole page reads one snapshot
+		snapshot = self._chain.snapshot
+		return [self.get_user_wallet_info(name, snapshot) for name in names]
+
+
+	def provision_keys(self, username: str) -> dict[str, str]:
 		''' Generates new RSA key pair for user and stores new public key
-		Sends client wallet information, including key pair
+		Sends client wallet information, including key pair.
+		Invalidates transactions signed with the previous key
 		'''
 		user_wallet = self.get_user(username)
-		priv_key, pub_key = user_wallet.generate_rsa_key_pair()
-		return {
-			'user': user_wallet.name,
-			'balance': str(user_wallet.balance),
-			'shardId': user_wallet.shard_id,
-			'privKey': priv_key.hex(), 
-			'pubKey': pub_key.hex()
-		}
+		priv_key, _ = user_wallet.generate_rsa_key_pair()
+		with self._lock:
+			self._wallet_changed(username)
+		return {**self.get_user_wallet_info(username), 'privKey': priv_key.hex()}
 	
 
 	def process_transaction_request(self, transaction_str: str, signature_hex: str) -> bool:
 		'''  Validates transaction came from user and appends it to Blockchain waiting list 
-		Eagerly remove transaction amount from user balance to prevent double spending
+		Transactions with a future nonce are buffered until the nonces before them arrive.
+		Eagerly reserve transaction amount from user balance to prevent double spending
 
 		NOTE: Assume all nodes get the transactions in the same order, so all nodes work on a 
 		consistent blockchain.
+
+		Duplicates of accepted transactions are rejected by transaction ID before any parsing.
+		When only the Bloom filter has seen the ID, a stale nonce confirms the duplicate cheaply,
+		otherwise the transaction is validated as usual
+
+		Raises
+			AdmissionRejected if mempool or sender quota is used up. Checked before any signature work
 		'''
-		transaction_chk = Transaction(self)
-		if not (transaction_chk.validate(transaction_str, signature_hex) and self.check_mempool_not_full()):
+		with self._lock:
+			transaction_id = hash_leaf(Transaction.convert_to_bytes(transaction_str))
+			seen = self._seen.check(transaction_id)
+			if seen == SEEN:
+				return False
+			sender_tokens = transaction_str.split(':', 2)
+			if seen == MAYBE_SEEN and self._stale_nonce(transaction_str, sender_tokens):
+				return False
+			self._admission.observe(self._chain.confirmed_count)
+			self._admission.check(self._chain.unconfirmed_count(),
+				self.in_flight(sender_tokens[1]) if len(sender_tokens) > 1 else 0)
+
+			transaction_chk = Transaction(self)
+			if not transaction_chk.validate(transaction_str, signature_hex):
+				return False
+
+			amount, user_id, _, _, nonce = Transaction.parse_string(transaction_str)
+			self._seen.add(transaction_id)
+			if seen == MAYBE_SEEN:
+				self._seen.false_positive()
+			if not self.get_user(user_id).correct_nonce(nonce):
+				# Transaction is verified, but an earlier nonce is missing - reserve amount and wait
+				self._pending.buffer(user_id, nonce, transaction_str, amount)
+				self._wallet_changed(user_id)
+				return True
+
+			# Transaction is verified - Add it, and every buffered transaction it unblocks, to mempool
+			self._admit_transaction(transaction_str, user_id, nonce, amount)
+			for promoted_nonce, promoted_str, promoted_amount in self._pending.promote(user_id, nonce + 1):
+				self._admit_transaction(promoted_str, user_id, promoted_nonce, promoted_amount)
+			return True
+
+
+	def process_transaction_batch(self, transactions: list[tuple[str, str]]) -> tuple[list[bool], int]:
+		'''
+		Process transactions in order, until the network is overloaded
+
+		Returns
+			Result of each transaction processed, and seconds to wait before resending the rest, -1 if none are left
+		'''
+		results: list[bool] = []
+		for transaction_str, signature_hex in transactions:
+			try:
+				results.append(self.process_transaction_request(transaction_str, signature_hex))
+			except AdmissionRejected as rejected:
+				return results, rejected.retry_after
+		return results, -1
+
+
+	def _stale_nonce(self, transaction_str: str, sender_tokens: list[str]) -> bool:
+		""" Cheap check that transaction nonce was already used by its sender, without full parsing """
+		if len(sender_tokens) < 2 or sender_tokens[1] not in self._wallets:
+			return False
+		try:
+			nonce = int(transaction_str.rsplit(':', 1)[1])
+		except ValueError:
 			return False
+		return nonce < self._wallets[sender_tokens[1]].nonce
 
-		# Transaction is verified - Try to add to mempool
-		self._queue_transaction(transaction_str)
 
-		# Transaction is in queue - Prevent payer from double-spending before confirmation
-		self._decrement_pending_transaction_value(transaction_str)
-		return True
+	def _admit_transaction(self, transaction_str: str, user_id: str, nonce: int, amount: int) -> None:
+		""" Append transaction to mempool, and keep its amount reserved until it is confirmed """
+		self._queue_transaction(transaction_str)
+		self._pending.admit(user_id, nonce, amount, self._chain.confirmed_nonce(user_id))
+		self.get_user(user_id).increment_transaction()
+		self._wallet_changed(user_id)
+		if not events.bus.idle:
+			events.bus.publish([events.shard_topic(self._shard_id), events.wallet_topic(self._shard_id, user_id)], {
+				'type': 'admitted',
+				'shardId': self._shard_id,
+				'user': user_id,
+				'nonce': nonce,
+				'amount': amount,
+				'txid': hash_leaf(Transaction.convert_to_bytes(transaction_str)).hex()
+			})
+			self._publish_balance(user_id)
+
+
+	def _publish_balance(self, username: str) -> None:
+		events.bus.publish([events.wallet_topic(self._shard_id, username)], {
+			'type': 'balance',
+			'shardId': self._shard_id,
+			'user': username,
+			'balance': self.available_balance(username),
+			'confirmedBalance': self.confirmed_balance(username)
+		})
+
+
+	def _on_tip_change(self, disconnected: list['Block'], connected: list['Block']) -> None:
+		""" Publish blocks leaving and joining the active chain, and balances of wallets they touch """
+		if events.bus.idle:
+			return
+		touched: set[str] = set()
+		fork_height = self._chain.height - len(connected)
+		for kind, blocks in (('reverted', disconnected), ('confirmed', connected)):
+			for offset, block in enumerate(blocks):
+				for transaction in block.transactions:
+					try:
+						_, user_id, _, payee, _ = Transaction.parse_string(transaction.decode('utf8'))
+					except (ValueError, UnicodeDecodeError):
+						continue
+					touched.update(user for user in (user_id, payee) if user in self._wallets)
+				events.bus.publish([events.shard_topic(self._shard_id)], {
+					'type': kind,
+					'shardId': self._shard_id,
+					'height': fork_height + offset + 1,
+					'blockHash': block.block_hash.hex(),
+					'transactions': [hash_leaf(transaction).hex() for transaction in block.transactions]
+				})
+		for username in touched:
+			self._publish_balance(username)
 
 
 	def _queue_transaction(self, validated_transaction_str: str) -> None:
@@ -198,33 +444,36 @@ class WalletController():
 		self._chain.append_unconfirmed(Transaction.convert_to_bytes(validated_transaction_str))
 
 
-	def _decrement_pending_transaction_value(self, valid_transaction_str: str) -> None:
-		""" Decrement transaction amount from payer's wallet balance """
-		amount, user_id, _, _, _ = Transaction.parse_string(valid_transaction_str)
-		user_wallet = self.get_user(user_id) # Index of username in transaction
-		user_wallet.increment_transaction()
-		user_wallet.pay(amount)
-
-
 	def check_mempool_not_full(self) -> bool:
 		""" Check mempool is not full"""
 		return not self._chain.unconfirmed_full()
 
 
+class ShardController():
 	'''
-	Class simulating sharded blockchain network
+	Class splitting wallets between shard networks.
+	Shards live in this process until start_actors is called. Afterwards each shard is owned by a
+	long-lived actor process, and every shard request is routed to it over a pipe
 
-	Attributes:
+	Attributes
 		_num_shards: int
-			Number of sharded networks. 
+			Number of sharded networks.
 			Maximum of 3, Minimum of 1 (Network has only one user)
+		_max_body_bytes: int
+			Block body memory budget shared evenly between shards. -1 for no budget
 		_shards: list[WalletController]
-			List of shard networks
+			Shard networks. Stale copies once actors are running
+		_actors: list[ShardActor]
+			Actor owning each shard. Empty while shards are local
+		_directory: dict[str, int]
+			Shard of each wallet ID
 	'''
-class ShardController():
-	def __init__(self, wallets: list[str]) -> None:
+	def __init__(self, wallets: list[str], max_body_bytes: int = -1) -> None:
 		self._num_shards = min(3, len(wallets))
+		self._max_body_bytes = max_body_bytes
+		self._directory: dict[str, int] = {}
 		self._shards = self._allocate_wallets(wallets)
+		self._actors: list[ShardActor] = []
 
 
 	def _allocate_wallets(self, wallets: tuple[str]) -> list[WalletController]:
@@ -240,11 +489,13 @@ class ShardController():
 		num_shards = self.num_shards
 		wallets_per_shard = len(wallets) // num_shards
 		rem_wallets = len(wallets) % num_shards
+		shard_body_bytes = -1 if self._max_body_bytes == -1 else self._max_body_bytes // num_shards
 		start_index = 0
 
 		for shard_id in range(num_shards):
-			shards_list.append(WalletController(wallets[start_index: \
-				start_index + wallets_per_shard + (1 if rem_wallets else 0)], shard_id))
+			shard_wallets = wallets[start_index: start_index + wallets_per_shard + (1 if rem_wallets else 0)]
+			shards_list.append(WalletController(shard_wallets, shard_id, shard_body_bytes))
+			self._directory.update((wallet, shard_id) for wallet in shard_wallets)
 			start_index += wallets_per_shard + (1 if rem_wallets else 0)
 			if rem_wallets: rem_wallets -= 1
 		return shards_list
@@ -257,6 +508,72 @@ class ShardController():
 			shard_id < self.num_shards
 
 
+	def shard_of(self, username: str) -> int:
+		''' Shard wallet was allocated to
+
+			Raises
+				KeyError if wallet does not exist
+		'''
+		return self._directory[username]
+
+
+	def route(self, transaction_str: str) -> int:
+		''' Shard of transaction sender, read from the transaction without parsing it
+
+			Raises
+				KeyError if sender does not exist
+		'''
+		sender_tokens = transaction_str.split(':', 2)
+		if len(sender_tokens) < 2:
+			raise KeyError
+		return self._directory[sender_tokens[1]]
+
+
+	def route_batch(self, transactions: list[tuple[str, str]]) -> tuple[dict[int, list[int]], list[int]]:
+		'''
+		Split mixed submission into per-shard batches in one pass, keeping submission order within each shard
+
+		Returns
+			Positions of transactions sent by each shard's wallets, and positions of transactions with an unknown sender
+		'''
+		batches: dict[int, list[int]] = {}
+		unroutable: list[int] = []
+		for index, (transaction_str, _) in enumerate(transactions):
+			sender_tokens = transaction_str.split(':', 2)
+			shard_id = self._directory.get(sender_tokens[1]) if len(sender_tokens) > 1 else None
+			if shard_id is None:
+				unroutable.append(index)
+			else:
+				batches.setdefault(shard_id, []).append(index)
+		return batches, unroutable
+
+
+	def submit_batch(self, transactions: list[tuple[str, str]]) -> tuple[list, int]:
+		'''
+		Route transactions to their sender's shard, and process every shard's batch concurrently
+
+		Arguments
+			transactions: list[tuple[str, str]]
+				Transaction and hex signature pairs, from any shards
+
+		Returns
+			Result of each transaction, None if it was not processed because its shard is overloaded,
+			and seconds to wait before resending those, -1 if every transaction was processed
+		'''
+		batches, unroutable = self.route_batch(transactions)
+		results: list = [None] * len(transactions)
+		for index in unroutable:
+			results[index] = False
+		replies = self._broadcast('process_transaction_batch',
+			{shard_id: ([transactions[index] for index in indexes],) for shard_id, indexes in batches.items()})
+		retry_after = -1
+		for shard_id, (shard_results, shard_retry_after) in replies.items():
+			for index, result in zip(batches[shard_id], shard_results):
+				results[index] = result
+			retry_after = max(retry_after, shard_retry_after)
+		return results, retry_after
+
+
 	def get_shard_users(self, shard_id: int) -> list[str]:
 		""" Get list of wallet IDs in shard_id """
 		return self._shards[shard_id].users()
@@ -264,12 +581,109 @@ class ShardController():
 
 	def get_user_wallet_info(self, shard_id: int, username: str) -> dict[str, str]:
 		""" Get public wallet information of user in shard_id """
-		return self._shards[shard_id].get_user_wallet_info(username)
+		return self.call(shard_id, 'get_user_wallet_info', username)
+
+
+	def provision_keys(self, shard_id: int, username: str) -> dict[str, str]:
+		""" Generate new key pair for user in shard_id """
+		return self.call(shard_id, 'provision_keys', username)
 
 
 	def send_transaction_request(self, shard_id: int, transaction_str: str, signature_hex: str) -> bool:
 		""" Send transaction request data to shard """
-		return self._shards[shard_id].process_transaction_request(transaction_str, signature_hex)
+		return self.call(shard_id, 'process_transaction_request', transaction_str, signature_hex)
+
+
+	def start_actors(self, miner: Callable) -> None:
+		''' Move every shard into its own actor process. Does nothing if actors are running
+
+			Arguments
+				miner: Callable
+					Called in the actor as miner(*args, network, shard_id, on_block) to mine its mempool, with the args passed to mine
+		'''
+		if not self._actors:
+			self._actors = start_actors(self._shards, miner)
+
+
+	def stop_actors(self) -> None:
+		""" Stop actor processes. Shard state owned by the actors is discarded """
+		for actor in self._actors:
+			actor.stop()
+		self._actors = []
+
+
+	@property
+	def actors_running(self) -> bool:
+		""" Getter for whether shards are owned by actor processes """
+		return bool(self._actors)
+
+
+	def call(self, shard_id: int, command: str, *args):
+		'''
+		Run a shard network method, in its actor if actors are running
+
+		Arguments
+			command: str
+				Dotted path of WalletController method, e.g. 'chain.headers'
+
+		Raises
+			Exception raised by the method
+		'''
+		if self._actors:
+			return self._actors[shard_id].request(command, *args)
+		return functools.reduce(getattr, command.split('.'), self._shards[shard_id])(*args)
+
+
+	def mine(self, allocations: dict[int, tuple]) -> dict:
+		'''
+		Mine shard mempools concurrently in their actors
+
+		Arguments
+			allocations: dict[int, tuple]
+				Arguments passed to the actor's miner, for each shard that should mine
+
+		Returns
+			Result of the actor's miner for each shard
+
+		Raises
+			RuntimeError if actors are not running
+		'''
+		if not self._actors:
+			raise RuntimeError('Shard actors are not running')
+		return self._broadcast('mine', allocations)
+
+
+	def _broadcast(self, command: str, args_by_shard: dict[int, tuple]) -> dict:
+		""" Run command on several shards, concurrently if actors are running. Returns result of each shard """
+		if not self._actors:
+			return {shard_id: self.call(shard_id, command, *args) for shard_id, args in args_by_shard.items()}
+		for shard_id, args in args_by_shard.items():
+			self._actors[shard_id].send(command, *args)
+		# Wait for every actor before raising, so no pipe is left with a reply pending
+		results = {}
+		failure = None
+		for shard_id in args_by_shard:
+			try:
+				results[shard_id] = self._actors[shard_id].receive(command)
+			except Exception as error:
+				failure = failure or error
+		if failure:
+			raise failure
+		return results
+
+
+	def heads(self) -> list[dict]:
+		""" Chain head of each shard, read from shared memory without messaging actors """
+		if self._actors:
+			return [actor.head() for actor in self._actors]
+		return [{
+			'height': shard.chain.height,
+			'tipVersion': shard.chain.tip_version,
+			'confirmed': shard.chain.confirmed_count,
+			'mempool': shard.chain.unconfirmed_count(),
+			'tipHash': shard.chain.last_transaction().block_hash.hex(),
+			'stateRoot': shard.chain.state_root.hex()
+		} for shard in self._shards]
 
 
 	@property
@@ -377,13 +791,104 @@ class Transaction:
 
 	def validate_amount(self, amount: int, user_id: str, nonce: int) -> bool:
 		''' Checks:
-		-- Nonce was not previously used
-		-- Amount is not negative, 0, or exceeds balance
+		-- Nonce was not previously used, and is not too far ahead
+		-- Amount is not negative, 0, or exceeds available balance
 		'''
-		user_wallet = self.network.get_user(user_id)
 		return amount > 0 and \
-			user_wallet.correct_nonce(nonce) and \
-			user_wallet.enough_balance(amount)
+			self.network.nonce_acceptable(user_id, nonce) and \
+			self.network.available_balance(user_id) >= amount
+
+
+class BlockHeader:
+	'''
+	Class storing compact block header. Enough to check proof of work and chain linkage
+	without downloading block transactions
+
+	Attributes
+		_prev_hash: bytes
+			Hash of previous block
+		_merkle_root: bytes
+			Merkle root of block transactions
+		_state_root: bytes
+			Root of the account state tree after the block is applied
+		_nonce: bytes
+			Random bytes modified to change hash of block
+		_block_hash: bytes
+			Hash of the header, which is the hash of the block
+	'''
+	_hash_size = 32
+
+	def __init__(self, prev_hash: bytes, merkle_root: bytes, state_root: bytes, nonce: bytes) -> None:
+		self._prev_hash = prev_hash
+		self._merkle_root = merkle_root
+		self._state_root = state_root
+		self._nonce = nonce
+		self._block_hash = BlockHeader.compute_hash(prev_hash, merkle_root, state_root, nonce)
+
+
+	@staticmethod
+	def compute_hash(prev_hash: bytes, merkle_root: bytes, state_root: bytes, nonce: bytes) -> bytes:
+		""" Hash of header fields """
+		message = SHA256.new()
+		message.update(prev_hash)
+		message.update(merkle_root)
+		message.update(state_root)
+		message.update(nonce)
+		return message.digest()
+
+
+	@staticmethod
+	def hash_meets_difficulty(block_hash: bytes, difficulty: int) -> bool:
+		""" Checks hash has at least difficulty leading 0 bytes """
+		return not any(block_hash[byte_index] != 0 for byte_index in range(difficulty))
+
+
+	@property
+	def block_hash(self) -> bytes:
+		""" Getter for header hash """
+		return self._block_hash
+
+
+	@property
+	def prev_hash(self) -> bytes:
+		""" Getter for hash of parent block """
+		return self._prev_hash
+
+
+	@property
+	def merkle_root(self) -> bytes:
+		""" Getter for Merkle root of block transactions """
+		return self._merkle_root
+
+
+	@property
+	def state_root(self) -> bytes:
+		""" Getter for root of account state tree after the block """
+		return self._state_root
+
+
+	def meets_difficulty(self, difficulty: int) -> bool:
+		""" Checks header hash has at least difficulty leading 0 bytes """
+		return BlockHeader.hash_meets_difficulty(self._block_hash, difficulty)
+
+
+	def to_bytes(self) -> bytes:
+		""" Serialises header as <PREV_HASH><MERKLE_ROOT><STATE_ROOT><NONCE_LENGTH><NONCE> """
+		return self._prev_hash + self._merkle_root + self._state_root + bytes([len(self._nonce)]) + self._nonce
+
+
+	@staticmethod
+	def from_bytes(header_bytes: bytes) -> 'BlockHeader':
+		'''
+		Parses header serialised by to_bytes
+
+		Raises
+			ValueError if header_bytes is malformed
+		'''
+		size = BlockHeader._hash_size
+		if len(header_bytes) < 3 * size + 1 or len(header_bytes) != 3 * size + 1 + header_bytes[3 * size]:
+			raise ValueError
+		return BlockHeader(header_bytes[:size], header_bytes[size:2 * size], header_bytes[2 * size:3 * size], header_bytes[3 * size + 1:])
 
 
 class Block:
@@ -393,16 +898,31 @@ class Block:
 	Attributes
 		_prev_hash: bytes
 			Hash of previous block
-		_transaction: bytes
-			Encoded associated transaction string. Can be extended to be a list of transactions
+		_transactions: list[bytes]
+			Encoded transaction strings included in the block. None once body is pruned to cold storage
+		_body_size: int
+			Number of bytes of encoded transactions
+		_merkle_root: bytes
+			Merkle root of _transactions, committed to by the block hash
+		_state_root: bytes
+			Root of the account state tree after the block is applied. Chains reject blocks whose root is wrong
 		_nonce: bytes
 			Random bytes to be modified to change hash of block
 		_block_hash: bytes
-			Hash of the block. For block to be accepted, must have appropriate number of leading 0's.
+			Hash of the block header. For block to be accepted, must have appropriate number of leading 0's.
 	'''
-	def __init__(self, prev_proof_of_work: bytes, transaction: bytes) -> None:
+	def __init__(self, prev_proof_of_work: bytes, transactions: list[bytes], state_root: bytes = bytes(32)) -> None:
+		'''
+		Arguments
+			state_root: bytes
+				Root of the account state tree after the block, from BlockChain.state_root_after.
+				Defaults to the root of a tree with no accounts
+		'''
 		self._prev_hash = prev_proof_of_work
-		self._transaction = transaction
+		self._transactions = list(transactions)
+		self._body_size = sum(map(len, self._transactions))
+		self._merkle_root = merkle_root(self._transactions)
+		self._state_root = state_root
 		self._nonce = b''
 		self._block_hash = b''
 		self.calculate_block_hash()
@@ -413,6 +933,54 @@ class Block:
 		""" Getter for current block hash """
 		return self._block_hash
 
+
+	@property
+	def prev_hash(self) -> bytes:
+		""" Getter for hash of parent block """
+		return self._prev_hash
+
+
+	@property
+	def state_root(self) -> bytes:
+		""" Getter for root of account state tree after the block """
+		return self._state_root
+
+
+	@property
+	def transactions(self) -> list[bytes]:
+		''' Getter for encoded block transactions
+
+		Raises
+			KeyError if body was pruned. Read it through BlockChain.block_body instead
+		'''
+		if self._transactions is None:
+			raise KeyError
+		return self._transactions
+
+
+	@property
+	def has_body(self) -> bool:
+		""" Checks block transactions are still held in memory """
+		return self._transactions is not None
+
+
+	@property
+	def body_size(self) -> int:
+		""" Getter for number of bytes of encoded transactions """
+		return self._body_size
+
+
+	def prune_body(self) -> None:
+		""" Drop block transactions, keeping only the header """
+		self._transactions = None
+
+
+	@property
+	def header(self) -> BlockHeader:
+		""" Getter for compact block header """
+		return BlockHeader(self._prev_hash, self._merkle_root, self._state_root, self._nonce)
+
+
 	@property
 	def nonce(self) -> bytes:
 		""" Getter for current block nonce """
@@ -430,38 +998,461 @@ class Block:
 
 	def calculate_block_hash(self) -> None:
 		""" Calculates new block hash and updates existing block_hash attribute """
-		message = SHA256.new()
-		message.update(self._prev_hash)
-		message.update(self._transaction)
-		message.update(self._nonce)
-		self._block_hash = message.digest()
+		self._block_hash = BlockHeader.compute_hash(self._prev_hash, self._merkle_root, self._state_root, self._nonce)
+
+
+	def meets_difficulty(self, difficulty: int) -> bool:
+		""" Checks block hash has at least difficulty leading 0 bytes """
+		return BlockHeader.hash_meets_difficulty(self._block_hash, difficulty)
 
 
 class BlockChain:
 	'''
-	Class representing blockchain
+	Class representing blockchain as a tree of blocks.
+	The active chain is the branch with the most cumulative work. Ties are broken by first seen.
+	Headers are kept for the whole chain, but block bodies are only kept in memory for the last
+	_retain_bodies blocks, above the checkpoint, and within the body memory budget.
+	Older bodies are moved to compressed cold storage, and read back on demand.
 
 	Attributes
+		_difficulty: int
+			Number of leading 0 bytes a block hash needs to be accepted
 		_chain: list[Block]
-			List of accepted blocks
+			Active branch, indexed by height
 			Blockchain always contains 'Genesis' block for other blocks to build off of
+		_blocks: dict[bytes, Block]
+			Every block connected to the tree, keyed by block hash
+		_heights: dict[bytes, int]
+			Height of each connected block
+		_work: dict[bytes, int]
+			Cumulative work of each connected block, from Genesis up to and including the block
+		_by_height: dict[int, list[bytes]]
+			Hashes of connected blocks at each height, used to prune stale side branches
+		_pruned_height: int
+			Every side branch block at or below this height has been pruned
+		_orphans: OrderedDict[bytes, Block]
+			Valid blocks whose parent is not known yet, oldest first
+		_orphans_by_parent: dict[bytes, list[bytes]]
+			Orphan hashes waiting on each missing parent hash
+		_tip_version: Value
+			Incremented every time the active chain tip changes
+			Lives in shared memory, so miner processes can tell their block template went stale
+		_confirmed_count: int
+			Number of transactions confirmed in the active chain
+		_unconfirmed_count: int
+			Number of transactions in the mempool
+		_retain_bodies: int
+			Number of most recent active chain blocks that keep their body in memory
+		_checkpoint: int
+			Active chain blocks above this height keep their body in memory. -1 for no checkpoint
+		_max_body_bytes: int
+			Memory budget of block bodies. -1 for no budget
+		_body_bytes: int
+			Size of block bodies held in memory
+		_bodies_pruned_to: int
+			Every active chain block at or below this height had its body moved to cold storage
+		_cold_store: ColdStore
+			Compressed segment files of pruned block bodies
+		_tx_index: dict[bytes, tuple[bytes, int]]
+			Block hash and position of each transaction confirmed in the active branch, keyed by transaction hash
 		_unconfirmed_transactions: Queue[Transaction]
 			Mempool of validated transactions
 			Transaction must be pushed into Block and mined before it is accepted into the Blockchain
+		_snapshot: LedgerSnapshot
+			Confirmed state at the current tip. Replaced, never modified, at every tip change
+		_states: dict[bytes, StateTree]
+			Account state tree after each connected block within reorg reach. Trees share untouched subtrees.
+			The tree of the active tip is the only copy of confirmed balances and nonces
+		_listener: Callable[[list[Block], list[Block]], None]
+			Called with blocks disconnected from and connected to the active chain, every time the tip changes
+		_simulated: bool
+			Blocks are accepted without checking proof of work. Tip version and mempool stay in process,
+			so thousands of simulated chains do not each hold shared memory, a pipe and a feeder thread
 	'''
-	def __init__(self) -> None:
-		self._chain = [Block(b'', b'Genesis')]
-		self._unconfirmed_transactions: Queue[Transaction] = Queue()
+	_max_orphans = 64
+	_max_fork_depth = 6
+
+	def __init__(self, difficulty: int = -1, retain_bodies: int = 1000, checkpoint: int = -1, max_body_bytes: int = -1,
+			cold_store: ColdStore = None, simulated: bool = False) -> None:
+		self._difficulty = Miner.mining_difficulty if difficulty == -1 else difficulty
+		self._simulated = simulated
+		self._listener = None
+		# Bodies within reorg reach are always needed to undo blocks
+		self._retain_bodies = max(retain_bodies, self._max_fork_depth + 1)
+		self._checkpoint = checkpoint
+		self._max_body_bytes = max_body_bytes
+		self._bodies_pruned_to = -1
+		self._cold_store = ColdStore() if cold_store is None else cold_store
+		genesis = Block(bytes(32), [b'Genesis'])
+		self._chain = [genesis]
+		self._blocks = {genesis.block_hash: genesis}
+		self._heights = {genesis.block_hash: 0}
+		self._work = {genesis.block_hash: 0}
+		self._by_height: dict[int, list[bytes]] = {0: [genesis.block_hash]}
+		self._body_bytes = genesis.body_size
+		self._pruned_height = -1
+		self._orphans: OrderedDict[bytes, Block] = OrderedDict()
+		self._orphans_by_parent: dict[bytes, list[bytes]] = {}
+		self._tip_version = c_uint64(0) if simulated else Value('Q', 0, lock=False)
+		self._confirmed_count = 0
+		self._unconfirmed_count = 0
+		self._tx_index: dict[bytes, tuple[bytes, int]] = {}
+		self._unconfirmed_transactions: Queue[Transaction] = queue.Queue() if simulated else Queue()
+		self._states: dict[bytes, StateTree] = {genesis.block_hash: StateTree()}
+		self._snapshot = LedgerSnapshot(0, 0, genesis.block_hash, 0, self._states[genesis.block_hash])
 	
 
+	@property
+	def snapshot(self) -> LedgerSnapshot:
+		""" Getter for confirmed state at the current tip. Safe to read while the chain changes """
+		return self._snapshot
+
+
+	def _publish_snapshot(self) -> None:
+		""" Replace snapshot with the state of the new tip """
+		self._snapshot = LedgerSnapshot(self.tip_version, self.height, self._chain[-1].block_hash, self._confirmed_count,
+			self._states[self._chain[-1].block_hash])
+
+
+	def listen(self, listener: Callable[[list[Block], list[Block]], None]) -> None:
+		""" Call listener(disconnected, connected) with blocks in height order every time the tip changes """
+		self._listener = listener
+
+
 	def last_transaction(self) -> Block:
 		""" Getter for last transaction in blockchain """
 		return self._chain[-1]
 
+
+	@property
+	def height(self) -> int:
+		""" Getter for height of active chain tip """
+		return len(self._chain) - 1
+
+
+	@property
+	def block_work(self) -> int:
+		""" Expected number of hashes needed to mine one block """
+		return 256 ** self._difficulty
+
+
+	@property
+	def tip_version(self) -> int:
+		""" Getter for number of times the active chain tip changed """
+		return self._tip_version.value
+
+
+	@property
+	def shared_tip_version(self) -> Value:
+		""" Getter for shared memory tip version counter, to pass to miner processes """
+		return self._tip_version
+
+
+	@property
+	def confirmed_count(self) -> int:
+		""" Getter for number of transactions confirmed in the active chain """
+		return self._confirmed_count
+
+
+	def confirmed_delta(self, username: str) -> int:
+		""" Net balance change of account confirmed in the active chain """
+		return self._states[self._chain[-1].block_hash].get(username)[0]
+
+
+	def confirmed_nonce(self, username: str) -> int:
+		""" Number of transactions from account confirmed in the active chain """
+		return self._states[self._chain[-1].block_hash].get(username)[1]
+
+
+	@property
+	def state_root(self) -> bytes:
+		""" Getter for root of account state tree at the active chain tip """
+		return self._states[self._chain[-1].block_hash].root
+
+
+	def state_root_after(self, prev_hash: bytes, transactions: list[bytes]) -> bytes:
+		'''
+		Root of the account state tree after transactions are applied on top of block prev_hash.
+		Miners put it in block templates
+
+		Raises
+			KeyError if prev_hash is unknown, or too far below the tip to build on
+			ValueError if a sender nonce does not follow on from its confirmed nonce
+		'''
+		state = self._states[prev_hash]
+		return state.updated(self._account_changes(state, transactions)).root
+
+
+	@staticmethod
+	def _account_changes(state: StateTree, transactions: list[bytes]) -> dict[str, tuple[int, int]]:
+		'''
+		New (balance change, nonce) of each account transactions touch, applied on top of state
+
+		Raises
+			ValueError if a sender nonce does not follow on from its nonce in state, e.g. a transaction confirmed twice
+		'''
+		changes: dict[str, tuple[int, int]] = {}
+		for transaction in transactions:
+			try:
+				amount, user_id, _, payee, transaction_nonce = Transaction.parse_string(transaction.decode('utf8'))
+			except (ValueError, UnicodeDecodeError):
+				continue
+			delta, nonce = changes.get(user_id) or state.get(user_id)
+			if transaction_nonce != nonce:
+				raise ValueError
+			changes[user_id] = (delta - amount, nonce + 1)
+			delta, nonce = changes.get(payee) or state.get(payee)
+			changes[payee] = (delta + amount, nonce)
+		return changes
+
+
+	def account_proof(self, username: str) -> tuple[bytes, int, tuple[int, int], tuple]:
+		'''
+		Proof of account's confirmed state against the state root of the active chain tip
+
+		Returns
+			Tuple of tip block hash, tip height, (balance change, nonce) of account and proof.
+			State is EMPTY_ACCOUNT, proven absent, if nothing from or to the account is confirmed
+		'''
+		snapshot = self._snapshot
+		return snapshot.tip_hash, snapshot.height, snapshot.state.get(username), snapshot.state.prove(username)
+
+
+	def orphan_count(self) -> int:
+		""" Number of buffered blocks waiting on their parent """
+		return len(self._orphans)
+
 	
-	def append_to_chain(self, block: Block) -> None:
-		""" Setter to append Block to blockchain """
-		self._chain.append(block)
+	def append_to_chain(self, block: Block) -> bool:
+		'''
+		Adds mined Block to the block tree, and switches the active chain if the
+		Block's branch now has the most cumulative work.
+		Blocks with an unknown parent are buffered until the parent arrives.
+
+		Returns
+			True if block was accepted into the tree or orphan buffer
+			False if block is a duplicate, does not meet difficulty, has a sender nonce that does not follow on
+			from its parent, or has a state root that does not match its transactions.
+			Difficulty is not checked on simulated chains
+		'''
+		block_hash = block.block_hash
+		if block_hash in self._blocks or block_hash in self._orphans or \
+			not (self._simulated or block.meets_difficulty(self._difficulty)):
+			return False
+		if block.prev_hash not in self._blocks:
+			self._add_orphan(block)
+			return True
+
+		if not self._connect(block):
+			return False
+		# Connect orphans that were waiting on this block
+		parents = [block_hash]
+		while parents:
+			for orphan_hash in self._orphans_by_parent.pop(parents.pop(), []):
+				if self._connect(self._orphans.pop(orphan_hash)):
+					parents.append(orphan_hash)
+		return True
+
+
+	def _add_orphan(self, block: Block) -> None:
+		""" Buffer block until its parent is connected, evicting the oldest orphan if full """
+		if len(self._orphans) >= self._max_orphans:
+			evicted_hash, evicted = self._orphans.popitem(last=False)
+			siblings = self._orphans_by_parent[evicted.prev_hash]
+			siblings.remove(evicted_hash)
+			if not siblings:
+				del self._orphans_by_parent[evicted.prev_hash]
+		self._orphans[block.block_hash] = block
+		self._orphans_by_parent.setdefault(block.prev_hash, []).append(block.block_hash)
+
+
+	def _connect(self, block: Block) -> bool:
+		'''
+		Attach block to its parent in the tree, and run fork choice.
+		Only the accounts the block touches are updated to check its state root
+
+		Returns
+			False if state root is wrong, a sender nonce does not follow on from the parent state,
+			or parent is too far below the tip to have its state kept
+		'''
+		parent_state = self._states.get(block.prev_hash)
+		if parent_state is None:
+			return False
+		try:
+			state = parent_state.updated(self._account_changes(parent_state, block.transactions))
+		except ValueError:
+			return False
+		if state.root != block.state_root:
+			return False
+		block_hash = block.block_hash
+		self._states[block_hash] = state
+		height = self._heights[block.prev_hash] + 1
+		self._blocks[block_hash] = block
+		self._heights[block_hash] = height
+		self._work[block_hash] = self._work[block.prev_hash] + self.block_work
+		self._by_height.setdefault(height, []).append(block_hash)
+		self._body_bytes += block.body_size
+
+		if self._work[block_hash] > self._work[self._chain[-1].block_hash]:
+			self._reorganise(block_hash)
+		self._enforce_retention()
+		return True
+
+
+	def _on_active_chain(self, block_hash: bytes) -> bool:
+		""" Checks block is part of the active chain """
+		height = self._heights[block_hash]
+		return height < len(self._chain) and self._chain[height].block_hash == block_hash
+
+
+	def _reorganise(self, new_tip: bytes) -> None:
+		'''
+		Switch active chain to end at new_tip.
+		Only the blocks between the fork point and each tip are undone or applied on the transaction index,
+		so the cost is proportional to the reorg depth instead of the chain length. Confirmed state switches
+		to the new tip's state tree.
+		Reorgs deeper than _max_fork_depth are refused.
+		'''
+		branch: list[Block] = []
+		cursor = new_tip
+		while cursor in self._blocks and not self._on_active_chain(cursor):
+			branch.append(self._blocks[cursor])
+			cursor = self._blocks[cursor].prev_hash
+		# Branch forked below pruned side blocks, or deeper than allowed
+		if cursor not in self._blocks or self.height - self._heights[cursor] > self._max_fork_depth:
+			return
+		fork_height = self._heights[cursor]
+
+		disconnected = self._chain[fork_height + 1:]
+		for old_block in reversed(disconnected):
+			self._apply_block(old_block, -1)
+		del self._chain[fork_height + 1:]
+		for new_block in reversed(branch):
+			self._apply_block(new_block, 1)
+			self._chain.append(new_block)
+
+		if disconnected:
+			self._rebuild_mempool([transaction for old_block in disconnected for transaction in old_block.transactions])
+		self._tip_version.value += 1
+		self._publish_snapshot()
+		self._prune_side_branches()
+		if self._listener:
+			self._listener(disconnected, list(reversed(branch)))
+
+
+	def _rebuild_mempool(self, requeued: list[bytes]) -> None:
+		'''
+		Put transactions of an abandoned branch back at the front of the mempool, ahead of later nonces of
+		their senders. Drops every transaction the active chain confirms, including transactions requeued by
+		an earlier reorg that the new branch confirms again, so no transaction is mined twice
+		'''
+		waiting = [self._unconfirmed_transactions.get() for _ in range(self._unconfirmed_count)]
+		self._unconfirmed_count = 0
+		for transaction in requeued + waiting:
+			if hash_leaf(transaction) not in self._tx_index:
+				self._unconfirmed_transactions.put(transaction)
+				self._unconfirmed_count += 1
+
+
+	def _apply_block(self, block: Block, direction: int) -> None:
+		''' Apply (direction 1) or undo (direction -1) block transactions on the transaction index.
+		Balances and nonces need no undo, since every connected block keeps its own state tree
+		'''
+		self._confirmed_count += direction * len(block.transactions)
+		for index, transaction in enumerate(block.transactions):
+			transaction_hash = hash_leaf(transaction)
+			if direction > 0:
+				self._tx_index[transaction_hash] = (block.block_hash, index)
+			else:
+				self._tx_index.pop(transaction_hash, None)
+
+
+	def _enforce_retention(self) -> None:
+		""" Move bodies outside the retention window to cold storage, then keep pruning until under memory budget """
+		prune_to = self.height - self._retain_bodies
+		if self._checkpoint != -1:
+			prune_to = min(prune_to, self._checkpoint)
+		self._prune_bodies_to(prune_to)
+		if self._max_body_bytes == -1:
+			return
+		reorg_safe_height = self.height - self._max_fork_depth - 1
+		while self._body_bytes > self._max_body_bytes and self._bodies_pruned_to < reorg_safe_height:
+			self._prune_bodies_to(self._bodies_pruned_to + 1)
+
+
+	def _prune_bodies_to(self, height: int) -> None:
+		""" Move bodies of active chain blocks up to height to cold storage """
+		while self._bodies_pruned_to < height:
+			self._bodies_pruned_to += 1
+			block = self._chain[self._bodies_pruned_to]
+			if block.has_body:
+				self._cold_store.put(block.block_hash, block.transactions)
+				self._body_bytes -= block.body_size
+				block.prune_body()
+
+
+	def body_memory(self) -> int:
+		""" Bytes of block bodies held in memory, including bodies buffered for the next cold segment """
+		return self._body_bytes + self._cold_store.memory_bytes
+
+
+	def block_body(self, block_hash: bytes) -> list[bytes]:
+		'''
+		Transactions of block, read back from cold storage if pruned
+
+		Raises
+			KeyError if block is unknown
+		'''
+		block = self._blocks[block_hash]
+		return block.transactions if block.has_body else self._cold_store.get(block_hash)
+
+
+	def headers(self, locator: list[bytes], max_count: int = 2000) -> list[BlockHeader]:
+		'''
+		Headers of active chain following the first locator hash found in the active chain.
+		Starts from Genesis if no locator hash is found
+
+		Arguments
+			locator: list[bytes]
+				Block hashes known to the caller, newest first
+			max_count: int
+				Maximum number of headers to return
+		'''
+		start = 0
+		for block_hash in locator:
+			if block_hash in self._heights and self._on_active_chain(block_hash):
+				start = self._heights[block_hash] + 1
+				break
+		return [block.header for block in self._chain[start:start + max_count]]
+
+
+	def transaction_proof(self, transaction_hash: bytes) -> tuple[bytes, int, list[tuple[bytes, bool]]]:
+		'''
+		Merkle inclusion proof of transaction confirmed in the active chain
+
+		Returns
+			Tuple of block hash, block height and proof
+
+		Raises
+			KeyError if transaction is not confirmed in the active chain
+		'''
+		block_hash, index = self._tx_index[transaction_hash]
+		return block_hash, self._heights[block_hash], merkle_proof(self.block_body(block_hash), index)
+
+
+	def _prune_side_branches(self) -> None:
+		""" Drop side branch blocks, and state trees of every block, too deep below the tip to ever be reorganised to """
+		prune_to = self.height - self._max_fork_depth - 1
+		while self._pruned_height < prune_to:
+			self._pruned_height += 1
+			for block_hash in self._by_height.pop(self._pruned_height, []):
+				self._states.pop(block_hash, None)
+				if not self._on_active_chain(block_hash):
+					if self._blocks[block_hash].has_body:
+						self._body_bytes -= self._blocks[block_hash].body_size
+					del self._blocks[block_hash]
+					del self._heights[block_hash]
+					del self._work[block_hash]
 
 
 	def unconfirmed_full(self) -> bool:
@@ -471,13 +1462,21 @@ class BlockChain:
 
 	def unconfirmed_empty(self) -> bool:
 		""" Checks if mempool is empty """
-		return self._unconfirmed_transactions.empty()
+		# Counted locally, since a multiprocessing queue reports empty until its feeder thread flushes a put
+		return self._unconfirmed_count == 0
+
+
+	def unconfirmed_count(self) -> int:
+		""" Number of transactions in mempool """
+		return self._unconfirmed_count
 
 
 	def unconfirmed_head(self) -> Transaction:
 		""" Fetches transaction from mempool """
-		if self._unconfirmed_transactions.empty():
+		if self._unconfirmed_count == 0:
 			raise IndexError
+		self._unconfirmed_count -= 1
+		# Waits for the feeder thread if the transaction was only just put
 		return self._unconfirmed_transactions.get()
 
 
@@ -486,6 +1485,12 @@ class BlockChain:
 		if self._unconfirmed_transactions.full():
 			raise IndexError
 		self._unconfirmed_transactions.put(transaction)
+		self._unconfirmed_count += 1
+
+
+	def requeue_unconfirmed(self, transactions: list[Transaction]) -> None:
+		""" Puts transactions fetched from mempool back at its front, e.g. when their block could not be mined """
+		self._rebuild_mempool(transactions)
 
 
 # class Shard(WalletController):
@@ -519,28 +1524,85 @@ class BlockChain:
 
 class Miner:
 	''' 
-	Miner class modifies nonce of block until accepted hash is found
+	Miner class modifies nonce of block until accepted hash is found.
+	Gives up on the block template as soon as the chain tip moves past the tip it was built on.
 	'''
 	_mining_difficulty = 2
+	_stale_check_interval = 64
 
 	@staticmethod
-	def mine(id: int, block: Block, queue: Queue, quit_signal: Event) -> None:
+	def mine(id: int, block: Block, queue: Queue, tip_version: Value, template_version: int) -> None:
+		'''
+		Search nonces until block meets mining difficulty, or template goes stale.
+		Puts ('block', block) on queue if mined, then always ('stats', MinerStats)
+
+		Arguments
+			id: int
+				Miner ID
+			block: Block
+				Block template to mine
+			queue: Queue
+				Queue to send results to coordinator
+			tip_version: Value
+				Shared chain tip version, checked every _stale_check_interval hashes
+			template_version: int
+				Tip version block template was built on
+		'''
+		start = time.monotonic()
 		iterations = 0
-		mined = False
-		while not (quit_signal.is_set() or mined):
-			# Check number of leading 0's is equal to mining difficulty
-			if (any(block.block_hash[byte_index] != 0 \
-				for byte_index in range(Miner.mining_difficulty))): 
+		mined = stale = False
+		while not (mined or stale):
+			if iterations % Miner._stale_check_interval == 0 and tip_version.value != template_version:
+				stale = True
+			elif not Miner.attempt(block):
 				iterations += 1
-				# block.nonce = os.urandom(5)
-				block.nonce = random.randbytes(10)
 			else:
-				queue.put(block)
+				queue.put(('block', block))
 				print(f'Miner 👷 #{id} mined in {iterations} iterations!')
 				mined = True
-		return
+		queue.put(('stats', MinerStats(id, iterations, stale, start, time.monotonic())))
+
+
+	@staticmethod
+	def attempt(block: Block) -> bool:
+		""" One step of the nonce search. True if block meets mining difficulty, otherwise moves block to a new random nonce """
+		# Check number of leading 0's is equal to mining difficulty
+		if block.meets_difficulty(Miner.mining_difficulty):
+			return True
+		# block.nonce = os.urandom(5)
+		block.nonce = random.randbytes(10)
+		return False
 
 
 	@classproperty
 	def mining_difficulty(self) -> int:
-		return self._mining_difficulty
\ No newline at end of file
+		return self._mining_difficulty
+
+
+class MinerStats:
+	'''
+	Class storing outcome of one mining attempt
+
+	Attributes
+		id: int
+			Miner ID
+		iterations: int
+			Number of hashes tried
+		stale: bool
+			Miner stopped because its template went stale
+		start: float
+			Monotonic time mining started
+		end: float
+			Monotonic time mining stopped
+	'''
+	def __init__(self, id: int, iterations: int, stale: bool, start: float, end: float) -> None:
+		self.id = id
+		self.iterations = iterations
+		self.stale = stale
+		self.start = start
+		self.end = end
+
+
+	def hash_rate(self) -> float:
+		""" Hashes per second while mining """
+		return self.iterations / max(self.end - self.start, 1e-9)
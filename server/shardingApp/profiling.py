@@ -0,0 +1,259 @@
+'''
+On-demand profiling of requests, benchmark runs and miner processes.
+
+Profiling is off by default, and costs one flag check per scope while off. It can be switched
+on at runtime with enable(), the /profiling/ endpoint, or the SHARDING_PROFILE environment variable,
+in one of two modes:
+	deterministic -- cProfile. Exact call counts, higher overhead. Writes <NAME>-<PID>-<N>.prof
+	sampling -- Samples the profiled thread's stack every few ms. Low overhead. Writes <NAME>-<PID>-<N>.collapsed
+
+Every switch from off to on starts a run, whose profiles go to a new run-* subdirectory of the
+profile directory. Miner processes are forked with the parent's settings, so they profile into the
+same run, and shard actors follow() the coordinator's run. merge() combines every profile of the
+current run into merged.prof (for pstats/snakeviz) and merged.collapsed (for flamegraph.pl/speedscope).
+'''
+import cProfile
+import itertools
+import os
+import pstats
+import sys
+import tempfile
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from typing import Callable, Iterator
+from django.conf import settings
+
+MODES = ('off', 'deterministic', 'sampling')
+
+_mode = os.environ.get('SHARDING_PROFILE', 'off')
+if _mode not in MODES:
+	raise ValueError
+_directory = os.environ.get('SHARDING_PROFILE_DIR', '')
+_run_directory = ''
+_interval = 0.005
+_counter = itertools.count()
+
+
+class StackSampler:
+	'''
+	Class sampling the stack of one thread from a background thread
+
+	Attributes
+		_thread_id: int
+			Identifier of sampled thread
+		_interval: float
+			Seconds between samples
+		_stacks: Counter[str]
+			Number of samples of each collapsed stack, root first and separated by ';'
+		_stop: threading.Event
+			Set to stop sampling
+	'''
+	def __init__(self, thread_id: int, interval: float) -> None:
+		self._thread_id = thread_id
+		self._interval = interval
+		self._stacks: Counter[str] = Counter()
+		self._stop = threading.Event()
+		self._sampler = threading.Thread(target=self._sample, daemon=True)
+
+
+	@property
+	def stacks(self) -> Counter:
+		""" Getter for collapsed stack sample counts """
+		return self._stacks
+
+
+	def start(self) -> None:
+		self._sampler.start()
+
+
+	def stop(self) -> None:
+		self._stop.set()
+		self._sampler.join()
+
+
+	def _sample(self) -> None:
+		""" Record sampled thread's stack until stopped """
+		while not self._stop.wait(self._interval):
+			frame = sys._current_frames().get(self._thread_id)
+			frames: list[str] = []
+			while frame is not None:
+				code = frame.f_code
+				frames.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+				frame = frame.f_back
+			if frames:
+				self._stacks[';'.join(reversed(frames))] += 1
+
+
+def enable(mode: str, directory: str = '') -> str:
+	'''
+	Switch profiling mode for scopes entered from now on, in this process and processes it forks.
+	Switching on from off, or to another directory, starts a new run
+
+	Arguments
+		mode: str
+			One of MODES
+		directory: str
+			Directory runs are written to. Keeps current directory, or creates a temporary one when needed, if empty
+
+	Returns
+		Run directory, '' if no run was started yet
+
+	Raises
+		ValueError if mode is unknown
+	'''
+	global _mode, _directory, _run_directory
+	if mode not in MODES:
+		raise ValueError
+	moved = directory not in ('', _directory)
+	new_run = mode != 'off' and (_mode == 'off' or moved)
+	_mode = mode
+	if moved:
+		_directory = directory
+		_run_directory = ''
+	if new_run:
+		_start_run()
+	return _run_directory
+
+
+def _start_run() -> None:
+	""" Create run directory profiles are written to from now on """
+	global _directory, _run_directory
+	if not _directory:
+		_directory = tempfile.mkdtemp(prefix='sharding-profile-')
+	os.makedirs(_directory, exist_ok=True)
+	_run_directory = tempfile.mkdtemp(prefix='run-', dir=_directory)
+
+
+def disable() -> None:
+	""" Stop profiling new scopes. The current run stays the one merge() combines """
+	global _mode
+	_mode = 'off'
+
+
+def follow(mode: str, run_directory: str) -> None:
+	''' Profile into another process's run, in its mode. Used by shard actors, forked before the run started
+
+	Raises
+		ValueError if mode is unknown
+	'''
+	global _mode, _run_directory
+	if mode not in MODES:
+		raise ValueError
+	_mode = mode
+	_run_directory = run_directory
+
+
+def mode() -> str:
+	""" Current profiling mode """
+	return _mode
+
+
+def directory() -> str:
+	""" Directory of the current run, '' if no run was started yet """
+	return _run_directory
+
+
+@contextmanager
+def profiled(name: str, scope_mode: str = '') -> Iterator[None]:
+	'''
+	Profile the enclosed block in the current mode, or in scope_mode if given
+
+	Arguments
+		name: str
+			Prefix of profile file name
+		scope_mode: str
+			Mode to use for this scope only
+	'''
+	active_mode = scope_mode or _mode
+	if active_mode == 'off':
+		yield
+		return
+	if not _run_directory:
+		# Scope asked for a mode while profiling is off
+		_start_run()
+	path = os.path.join(_run_directory, f'{name}-{os.getpid()}-{next(_counter)}')
+	if active_mode == 'deterministic':
+		profiler = cProfile.Profile()
+		profiler.enable()
+		try:
+			yield
+		finally:
+			profiler.disable()
+			profiler.dump_stats(f'{path}.prof')
+	else:
+		sampler = StackSampler(threading.get_ident(), _interval)
+		sampler.start()
+		try:
+			yield
+		finally:
+			sampler.stop()
+			_write_collapsed(f'{path}.collapsed', sampler.stacks)
+
+
+def profiled_call(name: str, func: Callable, *args) -> None:
+	""" Call func inside a profiled scope. Used as target of child processes """
+	with profiled(name):
+		func(*args)
+
+
+def _write_collapsed(path: str, stacks: Counter) -> None:
+	""" Write stacks in collapsed format, one '<STACK> <COUNT>' per line """
+	with open(path, 'w') as collapsed_file:
+		for stack, count in stacks.items():
+			collapsed_file.write(f'{stack} {count}\n')
+
+
+def merge(profile_directory: str = '') -> list[str]:
+	'''
+	Merge every profile written to profile_directory, from any process
+
+	Arguments
+		profile_directory: str
+			Run directory. Current run if empty
+
+	Returns
+		Paths of merged files written
+	'''
+	profile_directory = profile_directory or _run_directory
+	if not profile_directory:
+		return []
+	names = [name for name in sorted(os.listdir(profile_directory)) if not name.startswith('merged.')]
+	merged: list[str] = []
+
+	prof_paths = [os.path.join(profile_directory, name) for name in names if name.endswith('.prof')]
+	if prof_paths:
+		stats = pstats.Stats(*prof_paths)
+		stats.dump_stats(os.path.join(profile_directory, 'merged.prof'))
+		merged.append(os.path.join(profile_directory, 'merged.prof'))
+
+	stacks: Counter[str] = Counter()
+	for name in names:
+		if name.endswith('.collapsed'):
+			with open(os.path.join(profile_directory, name)) as collapsed_file:
+				for line in collapsed_file:
+					stack, _, count = line.rstrip('\n').rpartition(' ')
+					stacks[stack] += int(count)
+	if stacks:
+		_write_collapsed(os.path.join(profile_directory, 'merged.collapsed'), stacks)
+		merged.append(os.path.join(profile_directory, 'merged.collapsed'))
+	return merged
+
+
+class ProfilingMiddleware:
+	'''
+	Django middleware profiling whole requests.
+	Every request is profiled while profiling is enabled. With DEBUG on, a single request can
+	also ask for a mode with the ?profile=<MODE> query parameter
+	'''
+	def __init__(self, get_response: Callable) -> None:
+		self.get_response = get_response
+
+
+	def __call__(self, request):
+		request_mode = request.GET.get('profile', '') if settings.DEBUG else ''
+		if _mode == 'off' and request_mode not in MODES[1:]:
+			return self.get_response(request)
+		name = 'request' + request.path.replace('/', '-').rstrip('-')
+		with profiled(name, request_mode if request_mode in MODES else ''):
+			return self.get_response(request)
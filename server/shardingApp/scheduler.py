@@ -0,0 +1,149 @@
+import multiprocessing as mp
+import os
+
+
+def available_cores() -> list[int]:
+	""" Cores this process may run on """
+	if hasattr(os, 'sched_getaffinity'):
+		return sorted(os.sched_getaffinity(0))
+	return list(range(mp.cpu_count()))
+
+
+def pin(pid: int, cores: list[int]) -> bool:
+	''' Restrict process to cores, where the platform supports it
+
+		Returns
+			True if process was pinned
+	'''
+	if not cores or not hasattr(os, 'sched_setaffinity'):
+		return False
+	try:
+		os.sched_setaffinity(pid, cores)
+	except OSError:
+		# Process already exited, or cores are outside our cgroup
+		return False
+	return True
+
+
+class CoreScheduler:
+	'''
+	Class sharing a fixed budget of cores between shards that mine at the same time.
+	Cores are reassigned every round in proportion to each shard's mempool depth, so cores of
+	shards that ran out of work go to shards that still have a backlog. Each shard mines a number of
+	blocks proportional to its cores, so shards reach the end of a round at about the same time.
+	One core is kept for the coordinator and shard actors when more than one is available.
+
+	Attributes
+		_cores: list[int]
+			Core IDs miners may be pinned to
+		_round_blocks: int
+			Blocks a shard mines per allocated core before cores are reassigned
+		_rounds: int
+			Number of rounds scheduled
+		_wall_seconds: float
+			Total duration of recorded rounds
+		_allocated_seconds: float
+			Core seconds handed to shards
+		_busy_seconds: float
+			Core seconds miners actually spent hashing
+	'''
+	def __init__(self, max_cores: int = -1, round_blocks: int = 4) -> None:
+		cores = available_cores()
+		if len(cores) > 1:
+			cores = cores[1:]
+		self._cores = cores if max_cores == -1 else cores[:max(max_cores, 1)]
+		self._round_blocks = round_blocks
+		self._rounds = 0
+		self._wall_seconds = 0.0
+		self._allocated_seconds = 0.0
+		self._busy_seconds = 0.0
+
+
+	@property
+	def cores(self) -> list[int]:
+		""" Getter for core budget """
+		return self._cores
+
+
+	def blocks(self, cores: list[int]) -> int:
+		''' Blocks a shard mines this round. Proof of work time falls with the number of miners,
+		so a shard with twice the cores mines twice the blocks in the same time
+
+			Arguments
+				cores -- Cores allocated to the shard
+
+			Returns
+				Number of blocks, 0 if the shard has no cores
+		'''
+		return self._round_blocks * len(cores)
+
+
+	def allocate(self, depths: list[int]) -> list[list[int]]:
+		'''
+		Divide core budget between shards by largest remainder, in proportion to mempool depth.
+		Every shard with work gets at least one core, unless there are more busy shards than cores,
+		in which case the deepest shards are served first. Idle shards get no cores
+
+		Arguments
+			depths: list[int]
+				Mempool depth of each shard
+
+		Returns
+			Cores assigned to each shard
+		'''
+		busy = sorted((shard_id for shard_id, depth in enumerate(depths) if depth > 0), key=lambda shard_id: -depths[shard_id])
+		counts = [0] * len(depths)
+		if not busy:
+			return [[] for _ in depths]
+		if len(busy) >= len(self._cores):
+			for shard_id in busy[:len(self._cores)]:
+				counts[shard_id] = 1
+		else:
+			spare = len(self._cores) - len(busy)
+			total = sum(depths[shard_id] for shard_id in busy)
+			shares = {shard_id: spare * depths[shard_id] / total for shard_id in busy}
+			for shard_id in busy:
+				counts[shard_id] = 1 + int(shares[shard_id])
+			leftover = len(self._cores) - sum(counts)
+			for shard_id in sorted(busy, key=lambda shard_id: int(shares[shard_id]) - shares[shard_id])[:leftover]:
+				counts[shard_id] += 1
+
+		allocation: list[list[int]] = []
+		next_core = 0
+		for count in counts:
+			allocation.append(self._cores[next_core:next_core + count])
+			next_core += count
+		self._rounds += 1
+		return allocation
+
+
+	def record(self, wall_seconds: float, allocated_cores: int, busy_seconds: float) -> None:
+		''' Record outcome of a round
+
+			Arguments
+				wall_seconds -- Duration of round
+				allocated_cores -- Number of cores handed out for the round
+				busy_seconds -- Core seconds miners spent hashing during the round
+		'''
+		self._wall_seconds += wall_seconds
+		self._allocated_seconds += allocated_cores * wall_seconds
+		self._busy_seconds += busy_seconds
+
+
+	def report(self) -> dict:
+		''' Summary of core usage across recorded rounds
+
+			Returns
+				Dictionary with
+					cores -- Size of core budget
+					rounds -- Number of rounds scheduled
+					allocation -- Share of budget handed to shards
+					utilisation -- Share of budget spent hashing
+		'''
+		capacity = len(self._cores) * self._wall_seconds
+		return {
+			'cores': len(self._cores),
+			'rounds': self._rounds,
+			'allocation': self._allocated_seconds / capacity if capacity else 0.0,
+			'utilisation': min(self._busy_seconds / capacity, 1.0) if capacity else 0.0
+		}
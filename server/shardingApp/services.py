@@ -1,12 +1,17 @@
-from multiprocessing import Event, synchronize
-from .models import Block, Miner, ShardController, WalletController
+from .models import Block, Miner, MinerStats, ShardController, WalletController
 from Crypto.Hash import SHA256
 from Crypto.Signature import pkcs1_15
 from Crypto.PublicKey import RSA
-from time import sleep
 import multiprocessing as mp
+import functools
+import queue
+import threading
+import time
+from typing import Callable
 from .decorators import timeit
-import random
+from .loadgen import plan_workload, sign_workload
+from . import profiling
+from .scheduler import CoreScheduler, pin
 
 users = ['Alice', 'Bob', 'Chris', 'David', 'Edgar', 'Phoebe']
 # 'Chris', 'David', 'Edgar', 'Phoebe', 'Greg', \
@@ -18,16 +23,37 @@ wallets = WalletController( users )
 """ Global Sharded network """
 shards = ShardController( users )
 
+""" Held while a background mining run is in progress """
+_mining = threading.Lock()
 
-def get_user_wallets() -> list[dict[str, str]]:
+""" Seconds to wait for a miner result before checking for miners that died """
+_miner_poll_seconds = 1.0
+
+
+def get_user_wallets(offset: int = 0, limit: int = -1) -> tuple[int, list[dict[str, str]]]:
 	''' 
-	Generates new RSA key pair for global wallets, and returns Wallet information and new key pair
-	Saves new public key to global wallets, but does NOT save private key
+	Returns public Wallet information of global wallets, without modifying them
 
 		Returns
-			Dictionary with Wallet information, and key pair
+			Tuple of wallet state version, and list of Wallet information in [offset, offset + limit)
+	'''
+	return wallets.version, wallets.get_wallets_page(offset, limit)
+
+
+def provision_user_keys(data: dict) -> dict[str, str]:
+	''' 
+	Generates new RSA key pair for a wallet, and returns Wallet information and new key pair
+	Saves new public key to wallet, but does NOT save private key
+
+		Arguments
+			data['user'] -- Wallet ID
+			data['shardId'] -- Optional shard of wallet
+
+		Raises
+			ValueError if shardId is invalid
+			KeyError if user does not exist
 	'''
-	return list(map(wallets.get_user_wallet_info, wallets.users()))
+	return _call_network(data, 'provision_keys', data['user'])
 
 
 def process_serial_transaction_request(data: dict) -> bool:
@@ -42,23 +68,139 @@ def process_serial_transaction_request(data: dict) -> bool:
 	return wallets.process_transaction_request(transaction_str, signatureHex)
 
 
+def process_transaction_request(data: dict) -> bool:
+	""" Send transaction request to shard if it has a shardId, otherwise to serial network """
+	if _shard_id_param(data) in ('', '-1'):
+		return process_serial_transaction_request(data)
+	return process_sharded_transaction_request(data)
+
+
 def process_sharded_transaction_request(data: dict) -> bool:
-	''' Validates transaction request and add to shard mempool '''
+	''' Validates transaction request and add to mempool of sender's shard
+	shardId is optional. If given, it must be the sender's shard
+	'''
 	transaction_str: str = data['transaction']
 	signature_hex: str = data['signature']
-	str_shard_id: str = data['shardId']
-	if not (transaction_str and signature_hex and str_shard_id):
+	if not (transaction_str and signature_hex):
 		return False
 	try:
-		shard_id = int(str_shard_id)
-	except ValueError:
+		shard_id = shards.route(transaction_str)
+	except KeyError:
 		return False
-	if not shards.valid_shard_id(shard_id):
+	if _shard_id_param(data) not in ('', str(shard_id)):
 		return False
 	return shards.send_transaction_request(shard_id, transaction_str, signature_hex)
 
 
-def serial_transaction_request(allocated_miners: int, network: WalletController, shard_id: int = -1) -> dict:
+def submit_transactions(data: list[dict]) -> tuple[list, int]:
+	''' Route mixed batch of transaction requests to their senders' shards, which process their part concurrently
+
+		Returns
+			Result of each request, None if its shard was overloaded, and seconds to wait before resending those, -1 if none
+
+		Raises
+			KeyError if a request is malformed
+	'''
+	return shards.submit_batch([(request['transaction'], request['signature']) for request in data])
+
+
+def _shard_id_param(data: dict) -> str:
+	""" shardId of request as a string, '' if absent. JSON bodies may give it as a number """
+	shard_id = data.get('shardId')
+	return '' if shard_id is None else str(shard_id)
+
+
+def _call_network(data: dict, command: str, *args):
+	''' Run WalletController method on serial network, or on shard network if request has a shardId.
+	Shard methods run in the shard's actor once actors are running
+
+		Arguments
+			command -- Dotted path of method, e.g. 'chain.headers'
+
+		Raises
+			ValueError if shardId is not a valid shard
+	'''
+	str_shard_id = _shard_id_param(data)
+	if str_shard_id == '':
+		return functools.reduce(getattr, command.split('.'), wallets)(*args)
+	shard_id = int(str_shard_id)
+	if not shards.valid_shard_id(shard_id):
+		raise ValueError
+	return shards.call(shard_id, command, *args)
+
+
+def get_headers(data: dict) -> list[str]:
+	''' Get hex encoded compact headers following the client's block locator
+
+		Arguments
+			data['locator'] -- Comma separated hex block hashes known to client, newest first
+			data['count'] -- Maximum number of headers to return
+			data['shardId'] -- Optional shard to sync headers of
+
+		Raises
+			ValueError if request is malformed
+	'''
+	locator = [bytes.fromhex(block_hash) for block_hash in data.get('locator', '').split(',') if block_hash]
+	count = min(int(data.get('count', 2000)), 2000)
+	return [header.to_bytes().hex() for header in _call_network(data, 'chain.headers', locator, count)]
+
+
+def get_transaction_proof(data: dict) -> dict:
+	''' Get Merkle inclusion proof of confirmed transaction
+
+		Arguments
+			data['txid'] -- Hex transaction hash
+			data['shardId'] -- Optional shard transaction was sent to
+
+		Raises
+			ValueError if request is malformed
+			KeyError if transaction is not confirmed
+	'''
+	block_hash, height, proof = _call_network(data, 'chain.transaction_proof', bytes.fromhex(data['txid']))
+	return {
+		'blockHash': block_hash.hex(),
+		'height': height,
+		'proof': [[sibling.hex(), sibling_is_left] for sibling, sibling_is_left in proof]
+	}
+
+
+def get_account_proof(data: dict) -> dict:
+	''' Get proof of account's confirmed state against the state root of the chain tip
+
+		Arguments
+			data['user'] -- Account to prove
+			data['shardId'] -- Optional shard account belongs to
+
+		Raises
+			ValueError if request is malformed
+	'''
+	username = data.get('user')
+	if not username:
+		raise ValueError
+	block_hash, height, (balance_change, nonce), (siblings, leaf) = _call_network(data, 'chain.account_proof', username)
+	return {
+		'blockHash': block_hash.hex(),
+		'height': height,
+		'balanceChange': balance_change,
+		'nonce': nonce,
+		'proof': {
+			'siblings': [sibling.hex() for sibling in siblings],
+			'leaf': None if leaf is None else [leaf[0].hex(), list(leaf[1])]
+		}
+	}
+
+
+def get_seen_filter_report(data: dict) -> dict:
+	''' Get duplicate filter statistics of serial network, or of shard network if request has a shardId
+
+		Raises
+			ValueError if shardId is not a valid shard
+	'''
+	return _call_network(data, 'seen.report')
+
+
+def serial_transaction_request(allocated_miners: int, network: WalletController, shard_id: int = -1, on_block: Callable = None,
+		cores: list[int] = None, max_blocks: int = -1) -> dict:
 	''' Start validating blocks
 	-- Create Block with Proof_of_Work of tail of BlockChain
 	-- Instantiate 10 miners in parallel (Pretend like they're nodes in the network)
@@ -76,56 +218,213 @@ def serial_transaction_request(allocated_miners: int, network: WalletController,
 			blockchain. This makes a server implementation a good approximation 
 			of how the actual blockchain works, ASSUMING all nodes are non-adversarial. 
 
-			With adversarial nodes, multiple techniques exist to buffer mined blocks before
-			they are accepted, but generally depend on the distributed nature of an actual
-			blockchain, and is out of scope for this basic implementation
+			Mined blocks are added to the block tree of the chain, which buffers orphans and
+			follows the branch with most cumulative work, so competing blocks at the same height
+			are kept as side branches instead of being dropped.
+
+	NOTE: Miners watch the chain's shared tip version, and abort within a few hashes once the
+		tip moves past the tip their template was built on. No quit event or polling is needed.
+
+	NOTE: on_block is called after every consensus. Shard actors use it to publish their chain head
+
+	NOTE: One miner runs on each core in cores, pinned to it. Without cores, allocated_miners is capped by
+		the core budget of a CoreScheduler. Mining stops after max_blocks blocks, so a scheduler can
+		reassign cores between rounds
+
+	NOTE: Miners that die are counted as finished. If fewer than a majority mined, the blocks of the
+		miners left are appended, or the transaction is put back in the mempool if none mined
 
 	NOTE: Ditching mp.pool approach, since we there is no good way to terminate processes cleanly:
 		https://stackoverflow.com/questions/36962462/terminate-a-python-multiprocessing-program-once-a-one-of-its-workers-meets-a-cer
+
+		Raises
+			KeyError or ValueError if a block template cannot be built on the tip
+			RuntimeError if every miner of a block died
 	'''
 	if shard_id == -1:
 		print("⛏️  Starting Mining... ⛏️")
 	else:
 		print(f"⛏️  Shard #{shard_id} Starting Mining... ⛏️")
 	transactions = 0
-	miner_count = min(allocated_miners, mp.cpu_count() - 1)
+	cores = cores or CoreScheduler(allocated_miners).cores
+	miner_count = len(cores)
 	majority = miner_count // 2 + 1
-	while not network.chain.unconfirmed_empty():
-		quit_event: synchronize.Event = mp.Event()
+	stale_miners = stale_hashes = avoided_hashes = 0
+	max_abort_latency = miner_seconds = 0.0
+	while not network.chain.unconfirmed_empty() and (max_blocks == -1 or transactions < max_blocks):
+		# Requests admit into the mempool while it is mined
+		with network.lock:
+			template_version = network.chain.tip_version
+			prev_hash = network.chain.last_transaction().block_hash
+			block_transactions = [network.chain.unconfirmed_head()]
+			try:
+				state_root = network.chain.state_root_after(prev_hash, block_transactions)
+			except (KeyError, ValueError):
+				# Keep the transaction, rather than lose it with the mining run
+				network.chain.requeue_unconfirmed(block_transactions)
+				raise
+			new_block = Block(prev_hash, block_transactions, state_root)
 		ret_queue = mp.Queue()
-		new_block = Block(network.chain.last_transaction().block_hash, network.chain.unconfirmed_head())
+		jobs: list[mp.Process] = []
 		for miner_index in range(miner_count):
-			p = mp.Process(target=Miner.mine, args=(miner_index, new_block, ret_queue, quit_event))
+			p = mp.Process(target=profiling.profiled_call, args=('miner', Miner.mine,
+				miner_index, new_block, ret_queue, network.chain.shared_tip_version, template_version))
 			p.start()
-
-		while (ret_queue.qsize() < majority): # Wait for consensus
-			pass
-		quit_event.set()
-		sleep(0.1)
-		network.chain.append_to_chain(ret_queue.get())
+			pin(p.pid, [cores[miner_index]])
+			jobs.append(p)
+
+		# Wait for consensus. Appending moves the tip, so miners still on this template abort
+		mined: list[Block] = []
+		miner_stats: list[MinerStats] = []
+		finished: set[int] = set()
+		tip_changed = 0.0
+		while len(finished) < miner_count:
+			try:
+				kind, result = ret_queue.get(timeout=_miner_poll_seconds)
+			except queue.Empty:
+				# A miner that died never sends its stats
+				finished.update(miner_index for miner_index, job in enumerate(jobs) if job.exitcode not in (None, 0))
+				continue
+			if kind == 'stats':
+				miner_stats.append(result)
+				finished.add(result.id)
+				continue
+			# Every result is a competing block at the same height - fork choice keeps one as tip
+			mined.append(result)
+			if len(mined) == majority:
+				with network.lock:
+					for block in mined:
+						network.chain.append_to_chain(block)
+				tip_changed = time.monotonic()
+			elif len(mined) > majority:
+				with network.lock:
+					network.chain.append_to_chain(result)
+		for job in jobs:
+			job.join()
+		if len(mined) < majority:
+			# Too many miners died to reach a majority
+			with network.lock:
+				if not mined:
+					network.chain.requeue_unconfirmed(block_transactions)
+					raise RuntimeError
+				for block in mined:
+					network.chain.append_to_chain(block)
+
+		for stats in miner_stats:
+			miner_seconds += stats.end - stats.start
+			if stats.stale:
+				abort_latency = max(stats.end - tip_changed, 0)
+				max_abort_latency = max(max_abort_latency, abort_latency)
+				stale_miners += 1
+				stale_hashes += int(stats.hash_rate() * abort_latency)
+				# Hashing is memoryless, so a stale miner would have needed a full block's work to finish
+				avoided_hashes += network.chain.block_work
 		print(f'Consensus ({majority} nodes) reached! 🧑‍⚖️')
 		transactions += 1
+		if on_block:
+			on_block()
 	print('====================')
 	if shard_id == -1:
 		print(f'Network processed 💸 {transactions} 💸 transactions! 💸')
 	else:
 		print(f'Shard ID {shard_id} processed 💸 {transactions} 💸 transactions! 💸')
+	print(f'{stale_miners} stale miners aborted within {max_abort_latency * 1000:.1f}ms, ' \
+		f'{stale_hashes} stale hashes, ~{avoided_hashes} hashes avoided')
 	print('====================')
+	return {
+		'transactions': transactions,
+		'staleMiners': stale_miners,
+		'staleHashes': stale_hashes,
+		'avoidedHashes': avoided_hashes,
+		'maxAbortLatency': max_abort_latency,
+		'minerSeconds': miner_seconds
+	}
+
+
+def _mine_shard(cores: list[int], max_blocks: int, profile_mode: str, profile_directory: str, network: WalletController, shard_id: int,
+		on_block: Callable) -> dict:
+	''' Mine up to max_blocks of shard mempool inside its actor, one miner per core
+
+		Arguments
+			profile_mode, profile_directory: str
+				Coordinator's current profiling mode and run. Actors keep the settings they were forked with otherwise
+	'''
+	if (profile_mode, profile_directory) != (profiling.mode(), profiling.directory()):
+		profiling.follow(profile_mode, profile_directory)
+	with profiling.profiled(f'shard{shard_id}'):
+		return serial_transaction_request(len(cores), network, shard_id, on_block, cores, max_blocks)
 
 
 @timeit
-def shard_transaction_request(miners: int) -> None:
-	""" Instantiate one process per shard to process shard transactions """
-	divided_miners = miners // len(shards.shards)
-	rem_miners = miners % len(shards.shards)
-	jobs:list[mp.Process] = []
-	for index, shard in enumerate(shards.shards):
-		p = mp.Process(target=serial_transaction_request, args=(divided_miners + 1 if index < rem_miners else divided_miners, shard, index))
-		p.start()
-		jobs.append(p)
-	for job in jobs:
-		job.join()
-	return
+def shard_transaction_request(miners: int) -> dict:
+	''' Mine every shard concurrently in its actor process. Actors are started on first use, and keep
+	their ledger, mempool and chain between runs.
+	Shards share a budget of at most miners cores. Cores are reassigned every round by mempool depth,
+	so shards that drained their mempool hand their cores to shards that still have work. Each shard
+	mines blocks in proportion to its cores, so no shard idles long at the end of a round
+
+		Returns
+			Core usage report of the scheduler, and transactions processed by each shard
+	'''
+	shards.start_actors(_mine_shard)
+	scheduler = CoreScheduler(miners)
+	processed = [0] * shards.num_shards
+	while True:
+		depths = [head['mempool'] for head in shards.heads()]
+		if not any(depths):
+			break
+		allocation = scheduler.allocate(depths)
+		start = time.perf_counter()
+		results = shards.mine({shard_id: (cores, scheduler.blocks(cores), profiling.mode(), profiling.directory())
+			for shard_id, cores in enumerate(allocation) if cores})
+		scheduler.record(time.perf_counter() - start, sum(map(len, allocation)),
+			sum(result['minerSeconds'] for result in results.values()))
+		for shard_id, result in results.items():
+			processed[shard_id] += result['transactions']
+		if not any(result['transactions'] for result in results.values()):
+			break
+	report = scheduler.report()
+	report['transactions'] = processed
+	print(f"Scheduler used {report['utilisation']:.0%} of {report['cores']} cores over {report['rounds']} rounds")
+	return report
+
+
+def get_shard_heads() -> list[dict]:
+	""" Latest chain head of every shard """
+	return shards.heads()
+
+
+def start_mining(sharded: bool, miners: int = 9) -> bool:
+	''' Mine mempool in a background thread, so requests do not wait for mining.
+	Progress is pushed to /events/ subscribers
+
+		Returns
+			False if a mining run is already in progress. It mines transactions queued meanwhile
+	'''
+	if not _mining.acquire(blocking=False):
+		return False
+	def run() -> None:
+		while True:
+			try:
+				if sharded:
+					shard_transaction_request(miners)
+				else:
+					serial_transaction_wrapper(miners)
+			finally:
+				_mining.release()
+			# A transaction queued after the run's last mempool check found mining in progress and started
+			# nothing. Mine it, unless a request started a new run since the release
+			if not _mempool_waiting(sharded) or not _mining.acquire(blocking=False):
+				return
+	threading.Thread(target=run, daemon=True, name='mining').start()
+	return True
+
+
+def _mempool_waiting(sharded: bool) -> bool:
+	""" Checks serial mempool, or any shard mempool, still has transactions """
+	if sharded:
+		return any(head['mempool'] for head in shards.heads())
+	return not wallets.chain.unconfirmed_empty()
 
 
 def create_transaction_req(payer: dict[str, str], payee: dict[str, str]):
@@ -149,64 +448,57 @@ def serial_transaction_wrapper(miners: int) -> None:
 	serial_transaction_request(miners, wallets)
 
 
+def _sign_test_workload(users_res: list[dict[str, str]], transactions: int) -> list[dict[str, str]]:
+	""" Plan random transactions between users and sign them in parallel """
+	workload = plan_workload(users_res, transactions)
+	priv_keys = {user['user']: user['privKey'] for user in users_res}
+	return [
+		{'transaction': transaction.decode('utf8'), 'signature': signature.hex(), 'shardId': str(shard_id)}
+		for shard_id, transaction, signature in sign_workload(workload, priv_keys)
+	]
+
+
 def test_serial(transactions: int) -> int:
 	""" Generate transactions in serial network, then mine all at once """
-	users_res = get_user_wallets()
-	for _ in range(transactions):
-		# Randonly choose payer and payee from network users
-		payer_index = random.randrange(0, len(users_res))
-		payee_index = random.randrange(0, len(users_res)-1)
-		if payee_index >= payer_index:
-			payee_index += 1
-		# Get payer/payee pair
-		payer = users_res[payer_index]
-		payee = users_res[payee_index]
-
-		# Increment payer nonce
-		payer['nonce'] = payer.setdefault('nonce', -1) + 1
-
-		# Create transaction encoding and signature pair
-		transaction, signatureHex = create_transaction_req(payer, payee)
-
-		# Add transaction to mempool
-		process_serial_transaction_request({'transaction': transaction, 'signature': signatureHex})
-	# Start mining all mempool transactions
-	mining = serial_transaction_wrapper
-	mining(9)
+	users_res = [wallets.provision_keys(user) for user in wallets.users()]
+	with profiling.profiled('serial-run'):
+		for request in _sign_test_workload(users_res, transactions):
+			# Add transaction to mempool
+			process_serial_transaction_request(request)
+		# Start mining all mempool transactions
+		mining = serial_transaction_wrapper
+		mining(9)
 	return mining.last_time
 
 
-
 def test_shard(transactions: int) -> int:
-	users_res: list[list[dict[str, str]]] = []
-	
-	# Zip all shard users into separate nested lists
+	users_res: list[dict[str, str]] = []
 	for shard_id in range(shards.num_shards):
-		users_res.append([shards.get_user_wallet_info(shard_id, user) for user in shards.get_shard_users(shard_id)])
-	
-	for _ in range(transactions):
-		# Choose random shard
-		shard_index = random.randrange(0, shards.num_shards)
-
-		# Choose random payer and payee from shard
-		payer_index = random.randrange(0, len(users_res[shard_index]))
-		payee_index = random.randrange(0, len(users_res[shard_index])-1)
-		if payee_index >= payer_index:
-			payee_index += 1
-
-		# Get payer/payee pair
-		payer = users_res[shard_index][payer_index]
-		payee = users_res[shard_index][payee_index]
-
-		# Increment payer nonce
-		payer['nonce'] = payer.setdefault('nonce', -1) + 1
-
-		# Create transaction and signature pair
-		transaction, signatureHex = create_transaction_req(payer, payee)
-
-		# Append transaction to shard mempool
-		process_sharded_transaction_request({'transaction': transaction, 'signature': signatureHex, 'shardId': str(payer['shardId'])})
-	# Create parallel processes to mine through shard transactions
-	mining = shard_transaction_request
-	mining(9)
+		users_res.extend(shards.provision_keys(shard_id, user) for user in shards.get_shard_users(shard_id))
+
+	with profiling.profiled('shard-run'):
+		# Payer and payee are always chosen from the same shard
+		for request in _sign_test_workload(users_res, transactions):
+			# Append transaction to shard mempool
+			process_sharded_transaction_request(request)
+		# Create parallel processes to mine through shard transactions
+		mining = shard_transaction_request
+		mining(9)
 	return mining.last_time
+
+
+def set_profiling(data: dict) -> dict:
+	''' Switch profiling mode at runtime. Switching on starts a new run, and switching off merges the profiles of the run.
+		Runs are written under the directory set by SHARDING_PROFILE_DIR, never one chosen by the client
+
+		Arguments
+			data['mode'] -- One of profiling.MODES
+
+		Raises
+			ValueError if mode is unknown
+	'''
+	mode = data.get('mode', 'off')
+	if mode == 'off':
+		profiling.disable()
+		return {'mode': mode, 'directory': profiling.directory(), 'merged': profiling.merge()}
+	return {'mode': mode, 'directory': profiling.enable(mode)}
@@ -0,0 +1,243 @@
+'''
+Simulated proof of work for sharding experiments at a scale one machine cannot mine.
+
+Mining is replaced by a statistical model on a virtual clock. Each shard's miners find blocks
+as a Poisson process, with rate miners * hash_rate / block_work, since every hash is an
+independent trial. Everything else stays real: transactions are signed and validated,
+admitted to the shard mempool, and mined blocks go through the shard's block tree, fork
+choice and ledger.
+
+A found block reaches the shard's chain after a propagation delay. Blocks found on the same
+template before it arrives compete at the same height, and fork choice keeps the first one seen,
+so the stale block rate grows with delay * block rate as on a real network.
+
+Usage
+	python -m shardingApp.simulation --shards 1000 --transactions 4 --miners 3 --delay 0.5
+'''
+import argparse
+import heapq
+import itertools
+import random
+import time
+from Crypto.PublicKey import RSA
+from .loadgen import plan_workload, sign_workload
+from .models import Block, Miner, WalletController
+
+
+def measure_hash_rate(hashes: int = 20000) -> float:
+	""" Block hashes per second one miner process reaches on this machine """
+	block = Block(bytes(32), [b'1:Alice:00:Bob:0'])
+	start = time.perf_counter()
+	for _ in range(hashes):
+		Miner.attempt(block)
+	return hashes / (time.perf_counter() - start)
+
+
+class ShardSimulation:
+	'''
+	Class running many shard networks on one virtual clock
+
+	Attributes
+		_networks: list[WalletController]
+			Simulated shard networks. Chains accept blocks without checking proof of work
+		_miners: int
+			Miners working on each shard
+		_hash_rate: float
+			Hashes per second of one miner
+		_delay: float
+			Virtual seconds between a block being found and reaching its shard's chain
+		_block_size: int
+			Maximum number of mempool transactions in a block
+		_rng: random.Random
+			Source of block times and nonces
+		_clock: float
+			Current virtual time
+		_events: list[tuple[float, int, str, int, object]]
+			Heap of (time, sequence, kind, shard_id, payload) events. Sequence keeps order of simultaneous events
+		_templates: list[Block]
+			Block each shard's miners are working on. None while mempool is empty
+		_template_versions: list[int]
+			Chain tip version each template was built on
+		_found: int
+			Number of blocks found
+		_stale: int
+			Number of found blocks that did not end up on the active chain
+	'''
+	def __init__(self, num_shards: int, wallets_per_shard: int = 4, miners: int = 3, hash_rate: float = -1,
+			delay: float = 0.0, block_size: int = 1, key_pool: int = 4, key_bits: int = 1024, seed: int = -1) -> None:
+		'''
+		Arguments
+			hash_rate: float
+				Hashes per second of one miner. -1 measures this machine
+			key_pool: int
+				Number of RSA key pairs shared by all wallets. Generating a key per wallet would dominate set up
+			key_bits: int
+				Size of pooled keys. Only changes client signing cost, validation is the same
+		'''
+		self._rng = random.Random(None if seed == -1 else seed)
+		self._miners = miners
+		self._hash_rate = measure_hash_rate() if hash_rate == -1 else hash_rate
+		self._delay = delay
+		self._block_size = block_size
+		self._keys = [RSA.generate(key_bits) for _ in range(key_pool)]
+		self._networks: list[WalletController] = []
+		self._priv_keys: dict[str, str] = {}
+		for shard_id in range(num_shards):
+			names = [f'user{shard_id}-{index}' for index in range(wallets_per_shard)]
+			pub_keys = {}
+			for index, name in enumerate(names):
+				key = self._keys[(shard_id * wallets_per_shard + index) % key_pool]
+				pub_keys[name] = key.public_key().export_key('PEM')
+				self._priv_keys[name] = key.export_key('PEM').hex()
+			self._networks.append(WalletController(names, shard_id, pub_keys=pub_keys, simulated=True))
+		self._clock = 0.0
+		self._sequence = itertools.count()
+		self._events: list[tuple[float, int, str, int, object]] = []
+		self._templates: list[Block] = [None] * num_shards
+		self._template_versions = [0] * num_shards
+		self._found = self._stale = 0
+
+
+	@property
+	def networks(self) -> list[WalletController]:
+		""" Getter for simulated shard networks """
+		return self._networks
+
+
+	@property
+	def clock(self) -> float:
+		""" Getter for current virtual time """
+		return self._clock
+
+
+	def block_rate(self, shard_id: int) -> float:
+		""" Expected blocks found per virtual second in shard """
+		return self._miners * self._hash_rate / self._networks[shard_id].chain.block_work
+
+
+	def submit_workload(self, transactions_per_shard: int, skew: float = 0.0, workers: int = -1) -> int:
+		'''
+		Sign random transactions between wallets of the same shard, and submit them to shard mempools.
+		Payers are drawn from every shard, so shards get transactions_per_shard transactions on average
+
+		Returns
+			Number of transactions accepted
+		'''
+		wallets = [network.get_user_wallet_info(user) for network in self._networks for user in network.users()]
+		workload = plan_workload(wallets, transactions_per_shard * len(self._networks), skew, seed=self._rng.randrange(1 << 32))
+		accepted = 0
+		for shard_id, transaction, signature in sign_workload(workload, self._priv_keys, workers):
+			accepted += self._networks[shard_id].process_transaction_request(transaction.decode('utf8'), signature.hex())
+		return accepted
+
+
+	def _schedule(self, delay: float, kind: str, shard_id: int, payload: object = None) -> None:
+		heapq.heappush(self._events, (self._clock + delay, next(self._sequence), kind, shard_id, payload))
+
+
+	def _new_template(self, shard_id: int) -> None:
+		""" Build block on shard tip from its mempool, and schedule when miners find it """
+		chain = self._networks[shard_id].chain
+		if chain.unconfirmed_empty():
+			self._templates[shard_id] = None
+			return
+		transactions = [chain.unconfirmed_head()]
+		while len(transactions) < self._block_size and not chain.unconfirmed_empty():
+			transactions.append(chain.unconfirmed_head())
+		prev_hash = chain.last_transaction().block_hash
+		try:
+			state_root = chain.state_root_after(prev_hash, transactions)
+		except (KeyError, ValueError):
+			chain.requeue_unconfirmed(transactions)
+			raise
+		self._templates[shard_id] = Block(prev_hash, transactions, state_root)
+		self._template_versions[shard_id] = chain.tip_version
+		self._schedule_find(shard_id)
+
+
+	def _schedule_find(self, shard_id: int) -> None:
+		# Hashing is memoryless, so the wait for the next block never depends on work already done
+		self._schedule(self._rng.expovariate(self.block_rate(shard_id)), 'found', shard_id, self._template_versions[shard_id])
+
+
+	def run(self, duration: float = -1) -> dict:
+		'''
+		Mine every shard's mempool on the virtual clock
+
+		Arguments
+			duration: float
+				Virtual seconds to run for. -1 runs until every mempool is empty
+
+		Returns
+			Dictionary with
+				shards -- Number of shards
+				virtualSeconds -- Virtual time elapsed
+				wallSeconds -- Real time elapsed
+				blocks -- Blocks found
+				staleBlocks -- Found blocks that did not end up on the active chain
+				confirmed -- Transactions confirmed on active chains
+				throughput -- Confirmed transactions per virtual second
+		'''
+		start = time.perf_counter()
+		for shard_id in range(len(self._networks)):
+			if self._templates[shard_id] is None:
+				self._new_template(shard_id)
+		while self._events and (duration == -1 or self._events[0][0] <= duration):
+			self._clock, _, kind, shard_id, payload = heapq.heappop(self._events)
+			chain = self._networks[shard_id].chain
+			if kind == 'found':
+				# Template went stale while its block was being found - miners already moved on
+				if payload != chain.tip_version or self._templates[shard_id] is None:
+					continue
+				template = self._templates[shard_id]
+				block = Block(template.prev_hash, template.transactions, template.state_root)
+				block.nonce = self._rng.randbytes(10)
+				self._found += 1
+				self._schedule(self._delay, 'arrived', shard_id, block)
+				# Other miners keep working on the same template until the block arrives
+				self._schedule_find(shard_id)
+			else:
+				tip = chain.last_transaction().block_hash
+				chain.append_to_chain(payload)
+				if chain.last_transaction().block_hash == tip:
+					self._stale += 1
+				else:
+					self._new_template(shard_id)
+		if duration != -1:
+			self._clock = max(self._clock, duration)
+
+		confirmed = sum(network.chain.confirmed_count for network in self._networks)
+		return {
+			'shards': len(self._networks),
+			'virtualSeconds': self._clock,
+			'wallSeconds': time.perf_counter() - start,
+			'blocks': self._found,
+			'staleBlocks': self._stale,
+			'confirmed': confirmed,
+			'throughput': confirmed / self._clock if self._clock else 0.0
+		}
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description='Simulate mining of many shards on a virtual clock')
+	parser.add_argument('--shards', type=int, default=100)
+	parser.add_argument('--wallets', type=int, default=4, help='Wallets per shard')
+	parser.add_argument('--transactions', type=int, default=4, help='Transactions per shard')
+	parser.add_argument('--miners', type=int, default=3, help='Miners per shard')
+	parser.add_argument('--hash-rate', type=float, default=-1, help='Hashes per second per miner. -1 measures this machine')
+	parser.add_argument('--delay', type=float, default=0.0, help='Block propagation delay in virtual seconds')
+	parser.add_argument('--block-size', type=int, default=1)
+	parser.add_argument('--duration', type=float, default=-1, help='Virtual seconds to run. -1 runs until mempools are empty')
+	parser.add_argument('--seed', type=int, default=-1)
+	args = parser.parse_args()
+
+	start = time.perf_counter()
+	simulation = ShardSimulation(args.shards, args.wallets, args.miners, args.hash_rate, args.delay, args.block_size, seed=args.seed)
+	accepted = simulation.submit_workload(args.transactions)
+	print(f'Set up {args.shards} shards with {accepted} transactions in {time.perf_counter() - start:.2f}s')
+	for key, value in simulation.run(args.duration).items():
+		print(f'{key}: {value}')
+
+
+if __name__ == '__main__':
+	main()
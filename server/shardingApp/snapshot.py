@@ -0,0 +1,80 @@
+'''
+Immutable ledger snapshots, published at every block boundary.
+
+The chain publishes a new snapshot by swapping one reference. Readers take the reference once
+and read a consistent state from it, without locks, while ingestion and mining carry on.
+
+A snapshot holds the tip's account state tree, which is persistent, so snapshots share every
+subtree the blocks between them did not touch, and hold no copy of the confirmed state.
+'''
+from .statetree import StateTree
+
+
+class LedgerSnapshot:
+	'''
+	Class storing confirmed state of the active chain at one block boundary. Never modified
+
+	Attributes
+		_version: int
+			Chain tip version snapshot was taken at
+		_height: int
+			Height of active chain tip
+		_tip_hash: bytes
+			Hash of active chain tip
+		_confirmed_count: int
+			Number of transactions confirmed in the active chain
+		_state: StateTree
+			Account state tree of the tip, whose root is committed to by the tip header
+	'''
+	def __init__(self, version: int, height: int, tip_hash: bytes, confirmed_count: int, state: StateTree = None) -> None:
+		self._version = version
+		self._height = height
+		self._tip_hash = tip_hash
+		self._confirmed_count = confirmed_count
+		self._state = state or StateTree()
+
+
+	@property
+	def version(self) -> int:
+		""" Getter for chain tip version of snapshot """
+		return self._version
+
+
+	@property
+	def height(self) -> int:
+		""" Getter for height of snapshot tip """
+		return self._height
+
+
+	@property
+	def tip_hash(self) -> bytes:
+		""" Getter for hash of snapshot tip """
+		return self._tip_hash
+
+
+	@property
+	def confirmed_count(self) -> int:
+		""" Getter for number of confirmed transactions """
+		return self._confirmed_count
+
+
+	@property
+	def state(self) -> StateTree:
+		""" Getter for account state tree of snapshot tip """
+		return self._state
+
+
+	@property
+	def state_root(self) -> bytes:
+		""" Getter for account state root of snapshot tip """
+		return self._state.root
+
+
+	def confirmed_delta(self, username: str) -> int:
+		""" Net balance change of account confirmed at snapshot """
+		return self._state.get(username)[0]
+
+
+	def confirmed_nonce(self, username: str) -> int:
+		""" Number of transactions from account confirmed at snapshot """
+		return self._state.get(username)[1]
@@ -0,0 +1,231 @@
+'''
+Sparse Merkle tree committing to the confirmed state of every account.
+
+Each account is a leaf at the path given by the bits of SHA256(username), committing to the
+account's net confirmed balance change and nonce. Accounts with no confirmed state are absent.
+Empty subtrees hash to all zeros, and a subtree holding a single account is replaced by that
+account's leaf, so paths are only as deep as needed to tell keys apart (about log2 of the number
+of accounts) instead of 256 levels. The root depends only on account states, never on the order
+they were updated in, so two chains with the same state have the same root.
+
+Trees are persistent. Updating one returns a new tree sharing every untouched subtree, so a chain
+can keep the tree of every block within reorg reach for the cost of the accounts each block
+touched, and diffing two trees skips every subtree whose hashes match.
+
+An account proof is (siblings, leaf): the sibling hashes from the root down to where the
+account's path ends, and the leaf found there as (key, value), or None if the path ends empty.
+A leaf of another account proves the account is absent.
+'''
+from Crypto.Hash import SHA256
+from .merkle import hash_leaf, hash_node
+
+_EMPTY = bytes(32)
+
+""" State of an account with nothing confirmed: (balance change, nonce) """
+EMPTY_ACCOUNT = (0, 0)
+
+
+def account_key(username: str) -> bytes:
+	""" Path of account in the tree """
+	return SHA256.new(username.encode('utf8')).digest()
+
+
+def _bit(key: bytes, depth: int) -> int:
+	return (key[depth >> 3] >> (7 - (depth & 7))) & 1
+
+
+def hash_account(key: bytes, value: tuple[int, int]) -> bytes:
+	""" Hash of account leaf """
+	return hash_leaf(key + f'{value[0]}:{value[1]}'.encode('utf8'))
+
+
+class _Leaf:
+	__slots__ = ('key', 'username', 'value', 'hash')
+
+	def __init__(self, key: bytes, username: str, value: tuple[int, int]) -> None:
+		self.key = key
+		self.username = username
+		self.value = value
+		self.hash = hash_account(key, value)
+
+
+class _Branch:
+	__slots__ = ('left', 'right', 'hash')
+
+	def __init__(self, left, right) -> None:
+		self.left = left
+		self.right = right
+		self.hash = hash_node(_hash(left), _hash(right))
+
+
+def _hash(node) -> bytes:
+	return _EMPTY if node is None else node.hash
+
+
+def _branch(left, right):
+	""" Inner node of two subtrees, collapsed to its only leaf or to empty so the layout stays canonical """
+	if left is None and (right is None or isinstance(right, _Leaf)):
+		return right
+	if right is None and isinstance(left, _Leaf):
+		return left
+	return _Branch(left, right)
+
+
+def _join(first: _Leaf, second: _Leaf, depth: int):
+	""" Smallest subtree at depth holding two leaves of different keys """
+	first_bit = _bit(first.key, depth)
+	if first_bit != _bit(second.key, depth):
+		return _Branch(second, first) if first_bit else _Branch(first, second)
+	child = _join(first, second, depth + 1)
+	return _Branch(None, child) if first_bit else _Branch(child, None)
+
+
+def _update(node, depth: int, leaf: _Leaf, key: bytes):
+	""" Subtree at depth with account key set to leaf, or removed if leaf is None """
+	if node is None:
+		return leaf
+	if isinstance(node, _Leaf):
+		if node.key == key:
+			return leaf
+		return node if leaf is None else _join(node, leaf, depth)
+	if _bit(key, depth):
+		return _branch(node.left, _update(node.right, depth + 1, leaf, key))
+	return _branch(_update(node.left, depth + 1, leaf, key), node.right)
+
+
+def _path(node, key: bytes) -> tuple[list[bytes], _Leaf]:
+	""" Sibling hashes along the path of key from node down, and the leaf the path ends at """
+	siblings: list[bytes] = []
+	depth = 0
+	while isinstance(node, _Branch):
+		if _bit(key, depth):
+			siblings.append(_hash(node.left))
+			node = node.right
+		else:
+			siblings.append(_hash(node.right))
+			node = node.left
+		depth += 1
+	return siblings, node
+
+
+def _leaves(node) -> list[_Leaf]:
+	if node is None:
+		return []
+	if isinstance(node, _Leaf):
+		return [node]
+	return _leaves(node.left) + _leaves(node.right)
+
+
+class StateTree:
+	'''
+	Immutable sparse Merkle tree of account states
+
+	Attributes
+		_root: _Leaf | _Branch
+			Root node. None for a tree with no accounts
+		_size: int
+			Number of accounts in the tree
+	'''
+	def __init__(self, root=None, size: int = 0) -> None:
+		self._root = root
+		self._size = size
+
+
+	@property
+	def root(self) -> bytes:
+		""" Getter for root hash. All zeros for a tree with no accounts """
+		return _hash(self._root)
+
+
+	def __len__(self) -> int:
+		return self._size
+
+
+	def get(self, username: str) -> tuple[int, int]:
+		""" (balance change, nonce) of account. EMPTY_ACCOUNT if absent """
+		key = account_key(username)
+		_, leaf = _path(self._root, key)
+		return leaf.value if leaf is not None and leaf.key == key else EMPTY_ACCOUNT
+
+
+	def updated(self, changes: dict[str, tuple[int, int]]) -> 'StateTree':
+		'''
+		New tree with account states replaced. Only the paths of changed accounts are rebuilt
+
+		Arguments
+			changes: dict[str, tuple[int, int]]
+				New (balance change, nonce) of each account. EMPTY_ACCOUNT removes the account
+		'''
+		root, size = self._root, self._size
+		for username, value in changes.items():
+			key = account_key(username)
+			_, found = _path(root, key)
+			present = found is not None and found.key == key
+			if present and found.value == value:
+				continue
+			leaf = None if value == EMPTY_ACCOUNT else _Leaf(key, username, value)
+			root = _update(root, 0, leaf, key)
+			size += (leaf is not None) - present
+		return self if root is self._root else StateTree(root, size)
+
+
+	def prove(self, username: str) -> tuple[list[bytes], tuple[bytes, tuple[int, int]]]:
+		''' Proof of the account's state, or of its absence
+
+		Returns
+			Tuple of sibling hashes from the root down, and the (key, value) leaf the path ends at, or None
+		'''
+		siblings, leaf = _path(self._root, account_key(username))
+		return siblings, None if leaf is None else (leaf.key, leaf.value)
+
+
+	def diff(self, other: 'StateTree') -> dict[str, tuple[int, int]]:
+		'''
+		Accounts whose state differs from other, visiting only subtrees whose hashes differ.
+		other.updated(self.diff(other)) has the same root as self
+
+		Returns
+			Dictionary of each differing account's state in this tree. EMPTY_ACCOUNT if absent here
+		'''
+		changes: dict[str, tuple[int, int]] = {}
+		pending = [(self._root, other._root)]
+		while pending:
+			mine, theirs = pending.pop()
+			if _hash(mine) == _hash(theirs):
+				continue
+			if isinstance(mine, _Branch) and isinstance(theirs, _Branch):
+				pending.append((mine.left, theirs.left))
+				pending.append((mine.right, theirs.right))
+				continue
+			# One side holds at most one account, so the other side's accounts all differ but one
+			my_leaves = {leaf.key: leaf for leaf in _leaves(mine)}
+			for leaf in _leaves(theirs):
+				if leaf.key not in my_leaves:
+					changes[leaf.username] = EMPTY_ACCOUNT
+				elif my_leaves[leaf.key].value == leaf.value:
+					del my_leaves[leaf.key]
+			for leaf in my_leaves.values():
+				changes[leaf.username] = leaf.value
+		return changes
+
+
+def verify_account(root: bytes, username: str, value: tuple[int, int], proof: tuple[list[bytes], tuple]) -> bool:
+	""" Checks proof shows account has state value (EMPTY_ACCOUNT for absent) in the tree with root """
+	siblings, leaf = proof
+	key = account_key(username)
+	if value == EMPTY_ACCOUNT:
+		if leaf is None:
+			node = _EMPTY
+		else:
+			# Another account's leaf on the path must share the path so far
+			leaf_key, leaf_value = leaf
+			if leaf_key == key or any(_bit(leaf_key, depth) != _bit(key, depth) for depth in range(len(siblings))):
+				return False
+			node = hash_account(leaf_key, tuple(leaf_value))
+	else:
+		if leaf is None or leaf[0] != key or tuple(leaf[1]) != tuple(value):
+			return False
+		node = hash_account(key, tuple(value))
+	for depth in reversed(range(len(siblings))):
+		node = hash_node(siblings[depth], node) if _bit(key, depth) else hash_node(node, siblings[depth])
+	return node == root
@@ -0,0 +1,141 @@
+import os
+import struct
+import tempfile
+import zlib
+
+_LENGTH = struct.Struct('<I')
+
+
+def encode_body(transactions: list[bytes]) -> bytes:
+	""" Serialises block transactions as <COUNT>(<LENGTH><TRANSACTION>)* """
+	parts = [_LENGTH.pack(len(transactions))]
+	for transaction in transactions:
+		parts.append(_LENGTH.pack(len(transaction)))
+		parts.append(transaction)
+	return b''.join(parts)
+
+
+def decode_body(body: bytes) -> list[bytes]:
+	""" Parses block transactions serialised by encode_body """
+	(count,) = _LENGTH.unpack_from(body, 0)
+	offset = _LENGTH.size
+	transactions: list[bytes] = []
+	for _ in range(count):
+		(length,) = _LENGTH.unpack_from(body, offset)
+		offset += _LENGTH.size
+		transactions.append(body[offset:offset + length])
+		offset += length
+	return transactions
+
+
+class ColdStore:
+	'''
+	Append-only store of pruned block bodies.
+	Bodies are batched into segments, and each segment is zlib compressed into its own file.
+	Reads decompress the whole segment, and keep the last decoded segment for neighbouring reads.
+
+	Attributes
+		_directory: str
+			Directory segment files are written to. Temporary directory is created on first write if empty
+		_tempdir: TemporaryDirectory
+			Temporary directory removed with the store, if no directory was given
+		_segment_size: int
+			Number of bodies per segment file
+		_pending: list[bytes]
+			Encoded bodies not yet written to a segment
+		_pending_hashes: list[bytes]
+			Block hash of each pending body
+		_pending_bytes: int
+			Size of _pending
+		_index: dict[bytes, tuple[str, int]]
+			Segment path and position in segment of each stored body. Empty path while body is pending
+		_segments: int
+			Number of segment files written
+		_disk_bytes: int
+			Compressed size of segment files written
+		_cache: tuple[str, list[bytes]]
+			Path and bodies of last decoded segment
+	'''
+	def __init__(self, directory: str = '', segment_size: int = 64) -> None:
+		self._directory = directory
+		self._tempdir = None
+		self._segment_size = segment_size
+		self._pending: list[bytes] = []
+		self._pending_hashes: list[bytes] = []
+		self._pending_bytes = 0
+		self._index: dict[bytes, tuple[str, int]] = {}
+		self._segments = 0
+		self._disk_bytes = 0
+		self._cache: tuple[str, list[bytes]] = ('', [])
+
+
+	def __contains__(self, block_hash: bytes) -> bool:
+		return block_hash in self._index
+
+
+	@property
+	def memory_bytes(self) -> int:
+		""" Getter for size of bodies buffered in memory """
+		return self._pending_bytes
+
+
+	@property
+	def disk_bytes(self) -> int:
+		""" Getter for compressed size of segment files """
+		return self._disk_bytes
+
+
+	def put(self, block_hash: bytes, transactions: list[bytes]) -> None:
+		""" Store block body, writing a segment file once enough bodies are buffered """
+		body = encode_body(transactions)
+		self._index[block_hash] = ('', len(self._pending))
+		self._pending.append(body)
+		self._pending_hashes.append(block_hash)
+		self._pending_bytes += len(body)
+		if len(self._pending) >= self._segment_size:
+			self.flush()
+
+
+	def flush(self) -> None:
+		""" Compress buffered bodies into a new segment file """
+		if not self._pending:
+			return
+		if not self._directory:
+			self._tempdir = tempfile.TemporaryDirectory(prefix='cold-store-')
+			self._directory = self._tempdir.name
+		# Name includes pid, so forked processes sharing the directory never overwrite each other
+		path = os.path.join(self._directory, f'segment-{os.getpid()}-{self._segments:06d}.zlib')
+		segment = zlib.compress(b''.join(_LENGTH.pack(len(body)) + body for body in self._pending))
+		with open(path, 'wb') as segment_file:
+			segment_file.write(segment)
+		for position, block_hash in enumerate(self._pending_hashes):
+			self._index[block_hash] = (path, position)
+		self._segments += 1
+		self._disk_bytes += len(segment)
+		self._pending = []
+		self._pending_hashes = []
+		self._pending_bytes = 0
+
+
+	def get(self, block_hash: bytes) -> list[bytes]:
+		'''
+		Reads block body back
+
+		Raises
+			KeyError if block body was never stored
+		'''
+		path, position = self._index[block_hash]
+		if not path:
+			return decode_body(self._pending[position])
+		if self._cache[0] != path:
+			with open(path, 'rb') as segment_file:
+				segment = zlib.decompress(segment_file.read())
+			bodies: list[bytes] = []
+			offset = 0
+			while offset < len(segment):
+				(length,) = _LENGTH.unpack_from(segment, offset)
+				offset += _LENGTH.size
+				bodies.append(segment[offset:offset + length])
+				offset += length
+			self._cache = (path, bodies)
+		return decode_body(self._cache[1][position])
@@ -1,6 +1,28 @@
-from django.test import TestCase
-import services
-from .models import Wallet, WalletController, Transaction
+import asyncio
+import os
+import pickle
+import tempfile
+import time
+from queue import Queue
+from django.test import TestCase, override_settings
+from . import benchmarks, loadgen, profiling, services
+from .models import Block, BlockChain, BlockHeader, Miner, ShardController, Wallet, WalletController, Transaction
+from .merkle import hash_leaf, merkle_proof, merkle_root, verify_proof
+from .lightclient import LightClient
+from .admission import AdmissionController, AdmissionRejected
+from .storage import ColdStore
+from .scheduler import CoreScheduler
+from .dedup import MAYBE_SEEN, SEEN, UNSEEN, SeenFilter
+from .simulation import ShardSimulation
+from . import events
+from .snapshot import LedgerSnapshot
+from .statetree import EMPTY_ACCOUNT, StateTree, verify_account
+
+
+def signed_request(keys: dict[str, str], transaction: str) -> tuple[str, str]:
+	""" Transaction request signed with private key of a provisioned wallet """
+	[(_, _, signature)] = loadgen.sign_workload([(keys['user'], -1, transaction)], {keys['user']: keys['privKey']}, workers=1)
+	return transaction, signature.hex()
 
 # Create your tests here.
 class GetUsersTests(TestCase):
@@ -15,6 +37,100 @@ class SingleMiningTests(TestCase):
 	def setUp(self):
 		pass
 
+class ForkChoiceTests(TestCase):
+	def setUp(self):
+		self.chain = BlockChain(difficulty=0)
+		self.genesis = self.chain.last_transaction().block_hash
+		# Sees every block as soon as it is mined, so it knows the state of parents the chain under test has not seen yet
+		self.builder = BlockChain(difficulty=0)
+
+	def mine(self, prev_hash: bytes, transaction: bytes, nonce: bytes = b'') -> Block:
+		try:
+			state_root = self.builder.state_root_after(prev_hash, [transaction])
+		except KeyError:
+			# Parent that will never arrive
+			state_root = bytes(32)
+		block = Block(prev_hash, [transaction], state_root)
+		block.nonce = nonce
+		self.builder.append_to_chain(block)
+		return block
+
+	def test_competing_block_kept_as_side_branch(self):
+		first = self.mine(self.genesis, b'5:Alice:00:Bob:0', b'a')
+		second = self.mine(self.genesis, b'5:Alice:00:Bob:0', b'b')
+		self.assertTrue(self.chain.append_to_chain(first))
+		self.assertTrue(self.chain.append_to_chain(second))
+		self.assertFalse(self.chain.append_to_chain(second))
+		self.assertEqual(self.chain.last_transaction().block_hash, first.block_hash)
+
+	def test_heavier_branch_reorgs_ledger(self):
+		main = self.mine(self.genesis, b'5:Alice:00:Bob:0')
+		self.chain.append_to_chain(main)
+		self.assertEqual(self.chain.confirmed_delta('Bob'), 5)
+
+		side = self.mine(self.genesis, b'3:Alice:00:Chris:0')
+		side_child = self.mine(side.block_hash, b'2:Chris:00:Bob:0')
+		self.chain.append_to_chain(side)
+		self.chain.append_to_chain(side_child)
+		self.assertEqual(self.chain.last_transaction().block_hash, side_child.block_hash)
+		self.assertEqual(self.chain.confirmed_delta('Alice'), -3)
+		self.assertEqual(self.chain.confirmed_delta('Bob'), 2)
+		self.assertEqual(self.chain.confirmed_delta('Chris'), 1)
+		self.assertEqual(self.chain._unconfirmed_transactions.get(timeout=1), b'5:Alice:00:Bob:0')
+
+	def test_reorg_back_does_not_confirm_twice(self):
+		transaction = b'5:Alice:00:Bob:0'
+		main = self.mine(self.genesis, transaction, b'a')
+		self.chain.append_to_chain(main)
+		side = self.mine(self.genesis, b'1:Chris:00:Bob:0', b'b')
+		for block in (side, self.mine(side.block_hash, b'1:Chris:00:Bob:1')):
+			self.chain.append_to_chain(block)
+		self.assertEqual(self.chain.unconfirmed_count(), 1)
+
+		main_child = self.mine(main.block_hash, b'2:David:00:Bob:0')
+		for block in (main_child, self.mine(main_child.block_hash, b'2:David:00:Bob:1')):
+			self.chain.append_to_chain(block)
+		self.assertEqual(self.chain.height, 3)
+		mempool = [self.chain.unconfirmed_head() for _ in range(self.chain.unconfirmed_count())]
+		self.assertEqual(mempool, [b'1:Chris:00:Bob:0', b'1:Chris:00:Bob:1'])
+
+		# Mining the requeued transaction again is refused, since Alice's nonce already moved on
+		again = Block(self.chain.last_transaction().block_hash, [transaction], self.chain.state_root)
+		self.assertFalse(self.chain.append_to_chain(again))
+		self.assertEqual((self.chain.confirmed_delta('Alice'), self.chain.confirmed_nonce('Alice')), (-5, 1))
+
+	def test_orphan_connects_when_parent_arrives(self):
+		parent = self.mine(self.genesis, b'5:Alice:00:Bob:0')
+		child = self.mine(parent.block_hash, b'1:Bob:00:Alice:0')
+		self.chain.append_to_chain(child)
+		self.assertEqual(self.chain.orphan_count(), 1)
+		self.assertEqual(self.chain.height, 0)
+		self.chain.append_to_chain(parent)
+		self.assertEqual(self.chain.orphan_count(), 0)
+		self.assertEqual(self.chain.last_transaction().block_hash, child.block_hash)
+
+	def test_orphan_buffer_is_bounded(self):
+		for index in range(BlockChain._max_orphans + 10):
+			self.chain.append_to_chain(self.mine(bytes(32), b'orphan', bytes([index])))
+		self.assertEqual(self.chain.orphan_count(), BlockChain._max_orphans)
+
+class MempoolTests(TestCase):
+	def test_head_right_after_append(self):
+		chain = BlockChain()
+		chain.append_unconfirmed(b'1:Alice:00:Bob:0')
+		self.assertFalse(chain.unconfirmed_empty())
+		self.assertEqual(chain.unconfirmed_head(), b'1:Alice:00:Bob:0')
+		self.assertTrue(chain.unconfirmed_empty())
+
+	def test_template_error_keeps_transaction(self):
+		network = WalletController(['Alice', 'Bob'])
+		for transaction in (b'1:Alice:00:Bob:5', b'1:Alice:00:Bob:6'):
+			network.chain.append_unconfirmed(transaction)
+		with self.assertRaises(ValueError):
+			services.serial_transaction_request(1, network)
+		self.assertEqual([network.chain.unconfirmed_head() for _ in range(network.chain.unconfirmed_count())],
+			[b'1:Alice:00:Bob:5', b'1:Alice:00:Bob:6'])
+
 # class MassSerialMiningTests(TestCase):
 # 	def setUp(self):
 # 		pass
@@ -22,3 +138,747 @@ class SingleMiningTests(TestCase):
 # class MassParallelMiningTests(TestCase):
 # 	def setUp(self):
 # 		pass
+
+class LightClientTests(TestCase):
+	def setUp(self):
+		self.chain = BlockChain(difficulty=0)
+		self.transactions = [f'{amount}:Alice:00:Bob:{amount}'.encode() for amount in range(5)]
+		for transaction in self.transactions:
+			prev_hash = self.chain.last_transaction().block_hash
+			self.chain.append_to_chain(Block(prev_hash, [transaction], self.chain.state_root_after(prev_hash, [transaction])))
+
+	def test_merkle_proof_round_trip(self):
+		for size in range(1, len(self.transactions) + 1):
+			leaves = self.transactions[:size]
+			root = merkle_root(leaves)
+			for index, leaf in enumerate(leaves):
+				self.assertTrue(verify_proof(hash_leaf(leaf), merkle_proof(leaves, index), root))
+				self.assertFalse(verify_proof(hash_leaf(b'forged'), merkle_proof(leaves, index), root))
+
+	def test_header_round_trip(self):
+		header = self.chain.last_transaction().header
+		parsed = BlockHeader.from_bytes(header.to_bytes())
+		self.assertEqual(parsed.block_hash, self.chain.last_transaction().block_hash)
+		with self.assertRaises(ValueError):
+			BlockHeader.from_bytes(header.to_bytes()[:-1])
+
+	def test_sync_and_verify_confirmation(self):
+		client = LightClient(difficulty=0)
+		self.assertEqual(client.sync(self.chain.headers(client.locator())), 6)
+		self.assertEqual(client.sync(self.chain.headers(client.locator())), 0)
+
+		block_hash, _, proof = self.chain.transaction_proof(hash_leaf(self.transactions[2]))
+		self.assertTrue(client.verify_transaction(self.transactions[2], block_hash, proof, min_confirmations=3))
+		self.assertFalse(client.verify_transaction(self.transactions[2], block_hash, proof, min_confirmations=4))
+		self.assertFalse(client.verify_transaction(self.transactions[3], block_hash, proof))
+
+class WalletInfoTests(TestCase):
+	def setUp(self):
+		self.network = WalletController(['Alice', 'Bob', 'Chris'])
+
+	def test_read_does_not_rotate_keys(self):
+		pub_key = self.network.get_user('Alice').pub_key
+		version = self.network.version
+		info = self.network.get_user_wallet_info('Alice')
+		self.assertNotIn('privKey', info)
+		self.assertEqual(info['pubKey'], pub_key.hex())
+		self.assertEqual(self.network.get_user('Alice').pub_key, pub_key)
+		self.assertEqual(self.network.version, version)
+
+	def test_provision_rotates_key_and_invalidates_cache(self):
+		before = self.network.get_user_wallet_info('Bob')
+		provisioned = self.network.provision_keys('Bob')
+		self.assertIn('privKey', provisioned)
+		self.assertNotEqual(provisioned['pubKey'], before['pubKey'])
+		self.assertEqual(self.network.get_user_wallet_info('Bob')['pubKey'], provisioned['pubKey'])
+
+	def test_pagination(self):
+		self.assertEqual([info['user'] for info in self.network.get_wallets_page(1, 1)], ['Bob'])
+		self.assertEqual([info['user'] for info in self.network.get_wallets_page(1)], ['Bob', 'Chris'])
+
+	def test_conditional_get(self):
+		res = self.client.get('/get-user/', {'limit': 2})
+		self.assertEqual(res.status_code, 200)
+		self.assertEqual(len(res.json()), 2)
+		res = self.client.get('/get-user/', HTTP_IF_NONE_MATCH=res['ETag'])
+		self.assertEqual(res.status_code, 304)
+
+class LoadGeneratorTests(TestCase):
+	def setUp(self):
+		self.network = WalletController(['Alice', 'Bob'])
+		self.keys = [self.network.provision_keys(user) for user in self.network.users()]
+
+	def test_hot_key_skew(self):
+		workload = loadgen.plan_workload(self.keys + [{**self.keys[0], 'user': f'Cold{index}'} for index in range(8)], 1000, skew=3, seed=1)
+		payers = [payer for payer, _, _ in workload]
+		self.assertGreater(max(map(payers.count, set(payers))), 700)
+
+	def test_payee_skew(self):
+		wallets = self.keys + [{**self.keys[0], 'user': f'Cold{index}'} for index in range(8)]
+		for payee_skew, (low, high) in ((0.0, (0, 300)), (3.0, (500, 1000))):
+			payees = [transaction.split(':')[3] for _, _, transaction in loadgen.plan_workload(wallets, 1000, payee_skew=payee_skew, seed=1)]
+			self.assertTrue(low < max(map(payees.count, set(payees))) < high)
+
+	def test_payers_without_payee_never_picked(self):
+		lonely = [{**self.keys[0], 'user': 'Lonely', 'shardId': '7'}]
+		workload = loadgen.plan_workload(self.keys + lonely, 50, seed=1)
+		self.assertEqual(len(workload), 50)
+		self.assertNotIn('Lonely', [payer for payer, _, _ in workload])
+		self.assertEqual({payer for payer, _, _ in loadgen.plan_workload(self.keys + lonely, 50, cross_shard_ratio=0.1, seed=1)},
+			{'Alice', 'Bob', 'Lonely'})
+		with self.assertRaises(ValueError):
+			loadgen.plan_workload(lonely, 1)
+
+	def test_replay_round_trip(self):
+		workload = loadgen.plan_workload(self.keys, 6, seed=1)
+		records = loadgen.sign_workload(workload, {key['user']: key['privKey'] for key in self.keys}, workers=1)
+		with tempfile.TemporaryDirectory() as directory:
+			path = os.path.join(directory, 'workload.rpl')
+			loadgen.write_replay(path, records)
+			submit = lambda batch: sum(self.network.process_transaction_request(req['transaction'], req['signature']) for req in batch)
+			self.assertEqual(loadgen.replay(path, submit, batch_size=4), 6)
+
+class NonceBufferingTests(TestCase):
+	def setUp(self):
+		self.network = WalletController(['Alice', 'Bob'])
+		self.alice = self.network.provision_keys('Alice')
+
+	def submit(self, amount: int, nonce: int) -> bool:
+		return self.network.process_transaction_request(*signed_request(self.alice, f"{amount}:Alice:{self.alice['pubKey']}:Bob:{nonce}"))
+
+	def test_out_of_order_nonces_promoted(self):
+		self.assertTrue(self.submit(30, 2))
+		self.assertTrue(self.submit(30, 1))
+		self.assertEqual(self.network.get_user('Alice').nonce, 0)
+		self.assertEqual(self.network.available_balance('Alice'), 40)
+		self.assertTrue(self.submit(30, 0))
+		self.assertEqual(self.network.get_user('Alice').nonce, 3)
+		self.assertEqual(self.network.available_balance('Alice'), 10)
+		self.assertEqual(self.network.confirmed_balance('Alice'), 100)
+
+	def test_no_double_spend(self):
+		self.assertTrue(self.submit(60, 1))
+		self.assertFalse(self.submit(60, 0))
+		self.assertFalse(self.submit(10, 1))
+		self.assertTrue(self.submit(40, 0))
+		self.assertFalse(self.submit(1, 2))
+
+	def test_nonce_outside_window_rejected(self):
+		self.assertFalse(self.submit(1, 100))
+
+class AdmissionControlTests(TestCase):
+	def setUp(self):
+		self.admission = AdmissionController(max_mempool=10, max_per_sender=2)
+
+	def test_quotas(self):
+		self.admission.check(9, 1)
+		with self.assertRaises(AdmissionRejected):
+			self.admission.check(10, 0)
+		with self.assertRaises(AdmissionRejected):
+			self.admission.check(0, 2)
+
+	def test_retry_after_follows_drain_rate(self):
+		self.assertEqual(self.admission.retry_after(10), AdmissionController._default_retry)
+		self.admission._last_sample -= 1
+		self.admission.observe(5)
+		self.assertAlmostEqual(self.admission.drain_rate, 5, delta=1)
+		self.assertEqual(self.admission.retry_after(18), 4)
+
+	def test_rejected_before_signature_check(self):
+		network = WalletController(['Alice', 'Bob'])
+		network._admission = AdmissionController(max_mempool=0)
+		with self.assertRaises(AdmissionRejected):
+			network.process_transaction_request('1:Alice:00:Bob:0', 'bad signature')
+
+	def test_overload_responds_429(self):
+		admission = services.wallets._admission
+		services.wallets._admission = AdmissionController(max_mempool=0)
+		try:
+			res = self.client.post('/parse-transactions', [{'transaction': '1:Alice:00:Bob:0', 'signature': '00'}], content_type='application/json')
+		finally:
+			services.wallets._admission = admission
+		self.assertEqual(res.status_code, 429)
+		self.assertEqual(res.json(), {'processed': 0, 'queued': 0})
+		self.assertIn('Retry-After', res)
+
+class StaleWorkTests(TestCase):
+	def setUp(self):
+		self.chain = BlockChain()
+		self.block = Block(self.chain.last_transaction().block_hash, [b'1:Alice:00:Bob:0'])
+		self.queue = Queue()
+
+	def test_miner_aborts_stale_template(self):
+		stale_version = self.chain.tip_version
+		self.chain.shared_tip_version.value += 1
+		Miner.mine(0, self.block, self.queue, self.chain.shared_tip_version, stale_version)
+		kind, stats = self.queue.get_nowait()
+		self.assertEqual(kind, 'stats')
+		self.assertTrue(stats.stale)
+		self.assertEqual(stats.iterations, 0)
+
+	def test_miner_reports_block_and_stats(self):
+		difficulty = Miner._mining_difficulty
+		Miner._mining_difficulty = 1
+		try:
+			Miner.mine(0, self.block, self.queue, self.chain.shared_tip_version, self.chain.tip_version)
+		finally:
+			Miner._mining_difficulty = difficulty
+		kind, block = self.queue.get_nowait()
+		self.assertEqual(kind, 'block')
+		self.assertTrue(block.meets_difficulty(1))
+		self.assertFalse(self.queue.get_nowait()[1].stale)
+
+	def test_dead_miner_is_counted(self):
+		network = WalletController(['Alice', 'Bob'])
+		network.chain.append_unconfirmed(b'1:Alice:00:Bob:0')
+		mine = Miner.__dict__['mine']
+		def mine_or_die(id: int, *args) -> None:
+			if id == 0:
+				os._exit(1)
+			mine(id, *args)
+		Miner.mine = mine_or_die
+		try:
+			result = services.serial_transaction_request(2, network, cores=[0, 0])
+		finally:
+			Miner.mine = mine
+		self.assertEqual((result['transactions'], network.chain.height), (1, 1))
+
+class BodyPruningTests(TestCase):
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.transactions = [f'1:Alice:00:Bob:{nonce}'.encode() for nonce in range(20)]
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def build(self, **retention) -> BlockChain:
+		chain = BlockChain(difficulty=0, cold_store=ColdStore(self.directory.name, segment_size=4), **retention)
+		for transaction in self.transactions:
+			prev_hash = chain.last_transaction().block_hash
+			chain.append_to_chain(Block(prev_hash, [transaction], chain.state_root_after(prev_hash, [transaction])))
+		return chain
+
+	def test_old_bodies_moved_to_cold_storage(self):
+		chain = self.build(retain_bodies=0)
+		retained = BlockChain._max_fork_depth + 1
+		self.assertEqual(sum(block.has_body for block in chain._chain), retained)
+		self.assertEqual(len(chain.headers([])), len(self.transactions) + 1)
+		self.assertTrue(os.listdir(self.directory.name))
+		block_hash, _, proof = chain.transaction_proof(hash_leaf(self.transactions[2]))
+		self.assertFalse(chain._blocks[block_hash].has_body)
+		self.assertEqual(chain.block_body(block_hash), [self.transactions[2]])
+		self.assertTrue(verify_proof(hash_leaf(self.transactions[2]), proof, chain._blocks[block_hash].header.merkle_root))
+
+	def test_checkpoint_keeps_bodies_above_it(self):
+		chain = self.build(retain_bodies=0, checkpoint=5)
+		self.assertEqual(sum(block.has_body for block in chain._chain), len(self.transactions) - 5)
+
+	def test_memory_budget(self):
+		chain = self.build(max_body_bytes=0)
+		self.assertLessEqual(chain.body_memory(), (BlockChain._max_fork_depth + 4) * len(self.transactions[-1]))
+
+class ProfilingTests(TestCase):
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+
+	def tearDown(self):
+		profiling.disable()
+		self.directory.cleanup()
+
+	def busy(self):
+		return sum(Transaction.parse_string('1:Alice:00:Bob:0')[0] for _ in range(20000))
+
+	def test_disabled_writes_nothing(self):
+		profiling.enable('off', self.directory.name)
+		with profiling.profiled('run'):
+			self.busy()
+		self.assertEqual(os.listdir(self.directory.name), [])
+
+	def test_merge_deterministic_and_sampled(self):
+		profiling.enable('deterministic', self.directory.name)
+		with profiling.profiled('run'):
+			self.busy()
+		with profiling.profiled('run', 'sampling'):
+			self.busy()
+		merged = profiling.merge()
+		self.assertEqual(sorted(map(os.path.basename, merged)), ['merged.collapsed', 'merged.prof'])
+		with open(os.path.join(profiling.directory(), 'merged.collapsed')) as collapsed_file:
+			self.assertIn('busy', collapsed_file.read())
+
+	def test_merge_covers_one_run(self):
+		for _ in range(2):
+			run = profiling.enable('deterministic', self.directory.name)
+			with profiling.profiled('run'):
+				self.busy()
+			profiling.disable()
+		self.assertEqual(len(os.listdir(self.directory.name)), 2)
+		profiling.merge()
+		self.assertEqual(sorted(name.split('-')[0] for name in os.listdir(run)), ['merged.prof', 'run'])
+
+	def test_disable_creates_no_directory(self):
+		profiling.enable('off', self.directory.name)
+		profiling.disable()
+		self.assertEqual((os.listdir(self.directory.name), profiling.directory()), ([], ''))
+
+	def test_client_directory_ignored(self):
+		profiling.enable('off', self.directory.name)
+		with tempfile.TemporaryDirectory() as other:
+			run = services.set_profiling({'mode': 'deterministic', 'directory': other})['directory']
+			self.assertEqual((os.listdir(other), os.path.dirname(run)), ([], self.directory.name))
+
+	@override_settings(DEBUG=True)
+	def test_request_opt_in(self):
+		profiling.enable('off', self.directory.name)
+		self.client.get('/get-user/', {'profile': 'deterministic'})
+		self.assertTrue(any(name.startswith('request-get-user') for name in os.listdir(profiling.directory())))
+
+	def test_request_opt_in_needs_debug(self):
+		profiling.enable('off', self.directory.name)
+		self.client.get('/get-user/', {'profile': 'deterministic'})
+		self.assertEqual((os.listdir(self.directory.name), profiling.directory()), ([], ''))
+
+class ShardActorTests(TestCase):
+	def setUp(self):
+		self.difficulty = Miner._mining_difficulty
+		Miner._mining_difficulty = 1
+		self.shards = ShardController(['Alice', 'Bob', 'Chris', 'David'])
+		self.shards.start_actors(services._mine_shard)
+
+	def tearDown(self):
+		self.shards.stop_actors()
+		Miner._mining_difficulty = self.difficulty
+
+	def test_actor_owns_shard_state(self):
+		alice = self.shards.provision_keys(0, 'Alice')
+		self.assertTrue(self.shards.send_transaction_request(0, *signed_request(alice, f"1:Alice:{alice['pubKey']}:Bob:0")))
+		self.assertEqual(self.shards.heads()[0]['mempool'], 1)
+
+		core = CoreScheduler(1).cores
+		results = self.shards.mine({0: (core, -1, 'off', ''), 1: (core, -1, 'off', '')})
+		self.assertEqual((results[0]['transactions'], results[1]['transactions']), (1, 0))
+		head = self.shards.heads()[0]
+		self.assertEqual((head['height'], head['confirmed'], head['mempool']), (1, 1, 0))
+		self.assertEqual(self.shards.get_user_wallet_info(0, 'Alice')['confirmedBalance'], '99')
+		# Coordinator's copy is never touched once the actor owns the shard
+		self.assertEqual(self.shards.shards[0].chain.height, 0)
+
+	def test_actor_follows_profiling_switch(self):
+		with tempfile.TemporaryDirectory() as directory:
+			self.shards.mine({1: (CoreScheduler(1).cores, -1, 'deterministic', directory)})
+			self.assertTrue(any(name.startswith('shard1-') for name in os.listdir(directory)))
+
+	def test_events_relayed_from_actor(self):
+		alice = self.shards.provision_keys(0, 'Alice')
+		request = signed_request(alice, f"1:Alice:{alice['pubKey']}:Bob:0")
+		async def run():
+			subscription = events.bus.subscribe([events.wallet_topic(0, 'Alice')])
+			try:
+				self.shards.send_transaction_request(0, *request)
+				return await asyncio.wait_for(subscription.get(), 5)
+			finally:
+				events.bus.unsubscribe(subscription)
+		self.assertEqual(asyncio.run(run())['type'], 'admitted')
+
+	def test_actor_serves_commands_while_mining(self):
+		shards = ShardController(['Alice', 'Bob'])
+		shards.start_actors(lambda seconds, network, shard_id, on_block: time.sleep(seconds))
+		try:
+			actor = shards._actors[0]
+			actor.send('mine', 2)
+			start = time.perf_counter()
+			users = shards.call(0, 'users')
+			served = time.perf_counter() - start
+			self.assertIsNone(actor.receive('mine'))
+			self.assertEqual(users, shards.get_shard_users(0))
+			self.assertLess(served, 1)
+		finally:
+			shards.stop_actors()
+
+	def test_actor_errors_are_raised(self):
+		with self.assertRaises(KeyError):
+			self.shards.get_user_wallet_info(0, 'Chris')
+		self.assertEqual(self.shards.call(0, 'users'), ['Alice', 'Bob'])
+
+	def test_admission_rejected_crosses_pipe(self):
+		rejected = pickle.loads(pickle.dumps(AdmissionRejected(7)))
+		self.assertEqual(rejected.retry_after, 7)
+
+class CoreSchedulerTests(TestCase):
+	def setUp(self):
+		self.scheduler = CoreScheduler()
+		self.scheduler._cores = list(range(8))
+
+	def test_cores_follow_mempool_depth(self):
+		allocation = self.scheduler.allocate([30, 0, 10])
+		self.assertEqual(list(map(len, allocation)), [6, 0, 2])
+		self.assertEqual(sorted(sum(allocation, [])), list(range(8)))
+		self.assertEqual([self.scheduler.blocks(cores) for cores in allocation], [24, 0, 8])
+
+	def test_deepest_shards_served_when_cores_run_out(self):
+		self.scheduler._cores = [0, 1]
+		self.assertEqual(self.scheduler.allocate([1, 5, 3]), [[], [0], [1]])
+
+	def test_idle_network_gets_nothing(self):
+		self.assertEqual(self.scheduler.allocate([0, 0]), [[], []])
+
+	def test_report(self):
+		self.scheduler.allocate([1])
+		self.scheduler.record(2.0, 4, 6.0)
+		report = self.scheduler.report()
+		self.assertEqual((report['cores'], report['rounds']), (8, 1))
+		self.assertAlmostEqual(report['allocation'], 0.5)
+		self.assertAlmostEqual(report['utilisation'], 0.375)
+
+class SeenFilterTests(TestCase):
+	def setUp(self):
+		self.network = WalletController(['Alice', 'Bob'])
+		self.alice = self.network.provision_keys('Alice')
+		self.requests = []
+		for nonce in range(3):
+			self.requests.append(signed_request(self.alice, f"1:Alice:{self.alice['pubKey']}:Bob:{nonce}"))
+
+	def test_duplicate_rejected_before_validation(self):
+		self.assertTrue(self.network.process_transaction_request(*self.requests[0]))
+		validate = Transaction.validate
+		Transaction.validate = lambda *args: self.fail('Duplicate was validated')
+		try:
+			self.assertFalse(self.network.process_transaction_request(*self.requests[0]))
+		finally:
+			Transaction.validate = validate
+		self.assertEqual(self.network.seen.report()['exactHits'], 1)
+
+	def test_bloom_hit_confirmed_by_nonce(self):
+		self.network._seen = SeenFilter(max_exact=1)
+		self.assertTrue(self.network.process_transaction_request(*self.requests[0]))
+		self.assertTrue(self.network.process_transaction_request(*self.requests[1]))
+		self.assertFalse(self.network.process_transaction_request(*self.requests[0]))
+		report = self.network.seen.report()
+		self.assertEqual((report['bloomHits'], report['falsePositives']), (1, 0))
+
+	def test_false_positive_admitted_and_counted(self):
+		self.network._seen = SeenFilter(generation_size=1, error_rate=0.999)
+		self.network._seen._current._bits[:] = b'\xff' * len(self.network._seen._current._bits)
+		self.assertTrue(self.network.process_transaction_request(*self.requests[0]))
+		report = self.network.seen.report()
+		self.assertEqual(report['falsePositives'], 1)
+		self.assertEqual(report['falsePositiveRate'], 1.0)
+
+	def test_simulated_network_filter_is_small(self):
+		self.assertGreater(self.network.seen.memory_bytes, 900000)
+		self.assertLess(WalletController(['Alice', 'Bob'], simulated=True).seen.memory_bytes, 20000)
+
+	def test_bloom_generations_rotate(self):
+		seen = SeenFilter(max_exact=1, generation_size=2)
+		ids = [hash_leaf(bytes([index])) for index in range(5)]
+		for transaction_id in ids:
+			seen.add(transaction_id)
+		self.assertEqual(seen.check(ids[0]), UNSEEN)
+		self.assertEqual(seen.check(ids[3]), MAYBE_SEEN)
+		self.assertEqual(seen.check(ids[4]), SEEN)
+
+class SimulationTests(TestCase):
+	def simulate(self, delay: float) -> tuple[ShardSimulation, dict]:
+		simulation = ShardSimulation(3, wallets_per_shard=2, hash_rate=65536, delay=delay, key_pool=1, seed=7)
+		self.assertEqual(simulation.submit_workload(3, workers=1), 9)
+		return simulation, simulation.run()
+
+	def test_mempools_confirmed_on_virtual_clock(self):
+		simulation, report = self.simulate(0.0)
+		self.assertEqual((report['confirmed'], report['blocks'], report['staleBlocks']), (9, 9, 0))
+		self.assertEqual(report['virtualSeconds'], simulation.clock)
+		self.assertEqual(sum(network.chain.height for network in simulation.networks), 9)
+		for network in simulation.networks:
+			self.assertEqual(sum(network.confirmed_balance(user) for user in network.users()), 200)
+
+	def test_propagation_delay_causes_stale_blocks(self):
+		_, report = self.simulate(5.0)
+		self.assertEqual(report['confirmed'], 9)
+		self.assertGreater(report['staleBlocks'], 0)
+
+	def test_real_chains_still_check_work(self):
+		network = WalletController(['Alice'], simulated=True)
+		prev_hash = network.chain.last_transaction().block_hash
+		block = Block(prev_hash, [b'1:Alice:00:Bob:0'], network.chain.state_root_after(prev_hash, [b'1:Alice:00:Bob:0']))
+		self.assertTrue(network.chain.append_to_chain(block))
+		self.assertFalse(BlockChain(difficulty=32).append_to_chain(Block(block.prev_hash, block.transactions, block.state_root)))
+
+class EventStreamTests(TestCase):
+	def setUp(self):
+		self.network = WalletController(['Alice', 'Bob'], 0)
+		self.alice = self.network.provision_keys('Alice')
+
+	def submit(self) -> None:
+		self.assertTrue(self.network.process_transaction_request(*signed_request(self.alice, f"5:Alice:{self.alice['pubKey']}:Bob:0")))
+
+	def mine(self) -> None:
+		chain = self.network.chain
+		prev_hash, transactions = chain.last_transaction().block_hash, [chain._unconfirmed_transactions.get(timeout=1)]
+		block = Block(prev_hash, transactions, chain.state_root_after(prev_hash, transactions))
+		chain._unconfirmed_count -= 1
+		chain._difficulty = 0
+		self.assertTrue(chain.append_to_chain(block))
+
+	async def collect(self, topics: list[str], count: int) -> list[dict]:
+		shard = events.bus.subscribe([events.shard_topic(0)])
+		wallet = events.bus.subscribe(topics)
+		try:
+			self.submit()
+			self.mine()
+			received = [await asyncio.wait_for(wallet.get(), 1) for _ in range(count)]
+			self.assertEqual((await asyncio.wait_for(shard.get(), 1))['type'], 'admitted')
+			return received
+		finally:
+			events.bus.unsubscribe(shard)
+			events.bus.unsubscribe(wallet)
+
+	def test_wallet_and_shard_fan_out(self):
+		received = asyncio.run(self.collect([events.wallet_topic(0, 'Bob')], 1))
+		self.assertEqual(received[0]['type'], 'balance')
+		self.assertEqual(received[0]['confirmedBalance'], 105)
+		self.assertTrue(events.bus.idle)
+
+	def test_confirmation_follows_admission(self):
+		received = asyncio.run(self.collect([events.shard_topic(0)], 2))
+		self.assertEqual([event['type'] for event in received], ['admitted', 'confirmed'])
+		self.assertEqual(received[1]['transactions'], [received[0]['txid']])
+		self.assertEqual(received[1]['height'], 1)
+
+	def test_slow_subscriber_drops_oldest(self):
+		async def run():
+			bus = events.EventBus(max_queued=2)
+			subscription = bus.subscribe(['topic'])
+			for index in range(3):
+				bus.publish(['topic'], {'type': 'test', 'index': index})
+			await asyncio.sleep(0)
+			return [(await subscription.get())['index'] for _ in range(2)], subscription.dropped
+		self.assertEqual(asyncio.run(run()), ([1, 2], 1))
+
+	def test_actor_forwards_only_while_coordinator_has_subscribers(self):
+		async def run():
+			coordinator, actor = events.EventBus(), events.EventBus()
+			forwarded: list = []
+			actor.forward_to(forwarded.append, coordinator.shared_subscriptions())
+			actor.publish(['topic'], {'type': 'test'})
+			idle = actor.idle
+			subscription = coordinator.subscribe(['topic'])
+			actor.publish(['topic'], {'type': 'test'})
+			subscribed = actor.idle
+			coordinator.unsubscribe(subscription)
+			return idle, subscribed, actor.idle, len(forwarded)
+		self.assertEqual(asyncio.run(run()), (True, False, True, 1))
+
+	def test_server_sent_events(self):
+		async def run():
+			sent: list[dict] = []
+			disconnect = asyncio.Event()
+			async def receive():
+				await disconnect.wait()
+				return {'type': 'http.disconnect'}
+			async def send(message):
+				sent.append(message)
+				if b'event: admitted' in message.get('body', b''):
+					disconnect.set()
+			stream = asyncio.ensure_future(events.sse_application({'type': 'http', 'query_string': b'shardId=0&user=Alice'}, receive, send))
+			while len(sent) < 2:
+				await asyncio.sleep(0)
+			self.submit()
+			await asyncio.wait_for(stream, 1)
+			return sent
+		sent = asyncio.run(run())
+		self.assertEqual(sent[0]['status'], 200)
+		self.assertIn((b'content-type', b'text/event-stream'), sent[0]['headers'])
+		self.assertTrue(events.bus.idle)
+
+	def test_background_run_mines_transaction_queued_as_it_ends(self):
+		chain = services.wallets.chain
+		runs: list[int] = []
+		def run(miners: int) -> None:
+			with services.wallets.lock:
+				while not chain.unconfirmed_empty():
+					chain.unconfirmed_head()
+			# Arrives after the run's last mempool check, while it still holds the mining lock
+			if not runs:
+				chain.append_unconfirmed(b'1:Alice:00:Bob:0')
+				self.assertFalse(services.start_mining(False))
+			runs.append(miners)
+		wrapper = services.serial_transaction_wrapper
+		services.serial_transaction_wrapper = run
+		try:
+			self.assertTrue(services.start_mining(False))
+			for _ in range(200):
+				if len(runs) == 2 and not services._mining.locked():
+					break
+				time.sleep(0.01)
+		finally:
+			services.serial_transaction_wrapper = wrapper
+		self.assertEqual(len(runs), 2)
+		self.assertTrue(chain.unconfirmed_empty())
+
+class SnapshotTests(TestCase):
+	def setUp(self):
+		self.chain = BlockChain(difficulty=0)
+
+	def append(self, parent: bytes, transaction: bytes) -> Block:
+		block = Block(parent, [transaction], self.chain.state_root_after(parent, [transaction]))
+		self.assertTrue(self.chain.append_to_chain(block))
+		return block
+
+	def test_readers_keep_their_snapshot(self):
+		genesis = self.chain.last_transaction().block_hash
+		before = self.chain.snapshot
+		first = self.append(genesis, b'5:Alice:00:Bob:0')
+		after = self.chain.snapshot
+		self.assertEqual((before.height, before.confirmed_delta('Alice')), (0, 0))
+		self.assertEqual((after.height, after.confirmed_delta('Alice'), after.confirmed_nonce('Alice')), (1, -5, 1))
+		self.assertEqual(after.tip_hash, first.block_hash)
+
+		# Reorg to a heavier branch without Alice's payment
+		self.append(self.append(genesis, b'3:Bob:00:Chris:0').block_hash, b'1:Bob:00:Chris:1')
+		reorged = self.chain.snapshot
+		self.assertEqual((reorged.height, reorged.confirmed_delta('Alice'), reorged.confirmed_delta('Chris')), (2, 0, 4))
+		self.assertEqual(after.confirmed_delta('Alice'), -5)
+
+	def test_wallet_reads_served_from_snapshot(self):
+		network = WalletController(['Alice', 'Bob'])
+		network.chain._snapshot = LedgerSnapshot(1, 1, bytes(32), 1, StateTree().updated({'Alice': (-10, 1), 'Bob': (10, 0)}))
+		self.assertEqual([info['confirmedBalance'] for info in network.get_wallets_page()], ['90', '110'])
+
+class ShardRoutingTests(TestCase):
+	def setUp(self):
+		self.shards = ShardController(['Alice', 'Bob', 'Chris', 'David', 'Edgar'])
+
+	def signed(self, payer: str, payee: str, shard_id: int) -> tuple[str, str]:
+		keys = self.shards.provision_keys(shard_id, payer)
+		return signed_request(keys, f"1:{payer}:{keys['pubKey']}:{payee}:0")
+
+	def test_directory(self):
+		self.assertEqual([self.shards.shard_of(user) for user in ['Alice', 'Bob', 'Chris', 'David', 'Edgar']], [0, 0, 1, 1, 2])
+		self.assertEqual(self.shards.route('1:Chris:00:David:0'), 1)
+		with self.assertRaises(KeyError):
+			self.shards.route('1:Nobody:00:David:0')
+
+	def test_batch_split_in_submission_order(self):
+		batch = [('1:Chris:00:David:0', ''), ('1:Alice:00:Bob:0', ''), ('bad', ''), ('1:Chris:00:David:1', '')]
+		self.assertEqual(self.shards.route_batch(batch), ({1: [0, 3], 0: [1]}, [2]))
+
+	def test_submit_mixed_batch(self):
+		self.shards.shards[1]._admission = AdmissionController(max_mempool=0)
+		batch = [self.signed('Alice', 'Bob', 0), self.signed('Chris', 'David', 1), ('1:Nobody:00:Bob:0', '00')]
+		results, retry_after = self.shards.submit_batch(batch)
+		self.assertEqual(results, [True, None, False])
+		self.assertEqual(retry_after, AdmissionController._default_retry)
+		self.assertEqual(self.shards.shards[0].chain.unconfirmed_count(), 1)
+
+	def test_submit_endpoint(self):
+		res = self.client.post('/submit/', [{'transaction': '1:Nobody:00:Bob:0', 'signature': '00'}], content_type='application/json')
+		self.assertEqual((res.status_code, res.json()), (200, {'results': [False], 'queued': 0}))
+		self.assertEqual(self.client.post('/submit/', [{}], content_type='application/json').status_code, 400)
+
+	def test_shard_endpoint_routes_without_shard_id(self):
+		transaction, signature = self.signed('Chris', 'David', 1)
+		shards, start_mining = services.shards, services.start_mining
+		services.shards, services.start_mining = self.shards, lambda sharded: False
+		serial_depth = services.wallets.chain.unconfirmed_count()
+		try:
+			res = self.client.post('/shard/', {'transaction': transaction, 'signature': signature}, content_type='application/json')
+		finally:
+			services.shards, services.start_mining = shards, start_mining
+		self.assertEqual((res.status_code, res.json()), (202, {'queued': True, 'mining': False}))
+		self.assertEqual(self.shards.shards[1].chain.unconfirmed_count(), 1)
+		self.assertEqual(services.wallets.chain.unconfirmed_count(), serial_depth)
+
+	def test_numeric_shard_id(self):
+		transaction, signature = self.signed('Chris', 'David', 1)
+		shards = services.shards
+		services.shards = self.shards
+		try:
+			self.assertFalse(services.process_transaction_request({'transaction': transaction, 'signature': signature, 'shardId': 0}))
+			self.assertTrue(services.process_transaction_request({'transaction': transaction, 'signature': signature, 'shardId': 1}))
+		finally:
+			services.shards = shards
+		self.assertEqual(self.shards.shards[1].chain.unconfirmed_count(), 1)
+
+class BenchmarkTests(TestCase):
+	def test_run_reports_timing_and_memory(self):
+		result = benchmarks.run(['parse_string', 'mempool_roundtrip'], repeats=2, min_time=0.01)
+		for name in ['parse_string', 'mempool_roundtrip']:
+			self.assertEqual(result[name]['iterations'] & (result[name]['iterations'] - 1), 0)
+			self.assertLessEqual(result[name]['min'], result[name]['median'])
+			self.assertGreater(result[name]['peakBytes'], 0)
+
+	def test_compare_flags_regressions(self):
+		baseline = {'parse_string': {'min': 1e-6, 'peakBytes': 100}, 'removed': {'min': 1.0, 'peakBytes': 1}}
+		results = {'parse_string': {'min': 1.5e-6, 'peakBytes': 105}, 'added': {'min': 1.0, 'peakBytes': 1}}
+		self.assertEqual(benchmarks.compare(results, baseline, 0.1), [('parse_string', 'min', 1e-6, 1.5e-6)])
+
+	def test_miner_attempt_matches_difficulty(self):
+		block = Block(bytes(32), [b'1:Alice:00:Bob:0'])
+		difficulty = Miner._mining_difficulty
+		try:
+			Miner._mining_difficulty = 0
+			self.assertTrue(Miner.attempt(block))
+			self.assertEqual(block.nonce, b'')
+			Miner._mining_difficulty = 32
+			self.assertFalse(Miner.attempt(block))
+			self.assertEqual(len(block.nonce), 10)
+		finally:
+			Miner._mining_difficulty = difficulty
+
+class StateTreeTests(TestCase):
+	def setUp(self):
+		self.chain = BlockChain(difficulty=0)
+		self.genesis = self.chain.last_transaction().block_hash
+
+	def append(self, parent: bytes, transaction: bytes, nonce: bytes = b'') -> Block:
+		block = Block(parent, [transaction], self.chain.state_root_after(parent, [transaction]))
+		block.nonce = nonce
+		self.assertTrue(self.chain.append_to_chain(block))
+		return block
+
+	def test_root_depends_only_on_account_states(self):
+		accounts = {f'user{index}': (index, index % 3) for index in range(1, 51)}
+		forwards = StateTree().updated(accounts)
+		backwards = StateTree().updated(dict(reversed(list(accounts.items()))))
+		self.assertEqual(forwards.root, backwards.root)
+		self.assertEqual(len(forwards), 50)
+		self.assertEqual(forwards.updated({'user1': EMPTY_ACCOUNT}).root, StateTree().updated(
+			{user: value for user, value in accounts.items() if user != 'user1'}).root)
+		self.assertEqual(StateTree().updated({'user0': EMPTY_ACCOUNT}).root, bytes(32))
+
+	def test_proofs_and_diff(self):
+		tree = StateTree().updated({f'user{index}': (index, 1) for index in range(1, 40)})
+		for user, value in [('user7', (7, 1)), ('nobody', EMPTY_ACCOUNT)]:
+			proof = tree.prove(user)
+			self.assertTrue(verify_account(tree.root, user, value, proof))
+			self.assertFalse(verify_account(tree.root, user, (value[0] + 1, value[1]), proof))
+		changed = tree.updated({'user3': (-5, 2), 'user9': EMPTY_ACCOUNT, 'new': (1, 0)})
+		self.assertEqual(changed.diff(tree), {'user3': (-5, 2), 'user9': EMPTY_ACCOUNT, 'new': (1, 0)})
+		self.assertEqual(tree.updated(changed.diff(tree)).root, changed.root)
+
+	def test_header_commits_to_confirmed_state(self):
+		block = self.append(self.genesis, b'5:Alice:00:Bob:0')
+		expected = StateTree().updated({'Alice': (-5, 1), 'Bob': (5, 0)})
+		self.assertEqual(block.header.state_root, expected.root)
+		self.assertEqual(self.chain.snapshot.state_root, expected.root)
+		wrong = Block(block.block_hash, [b'1:Bob:00:Alice:0'], expected.root)
+		self.assertFalse(self.chain.append_to_chain(wrong))
+		self.assertEqual(self.chain.height, 1)
+
+	def test_reorg_switches_state_root(self):
+		self.append(self.genesis, b'5:Alice:00:Bob:0', b'a')
+		side = self.append(self.genesis, b'3:Bob:00:Carol:0', b'b')
+		self.append(side.block_hash, b'1:Carol:00:Alice:0')
+		replay = StateTree().updated({'Bob': (-3, 1), 'Carol': (2, 1), 'Alice': (1, 0)})
+		self.assertEqual(self.chain.state_root, replay.root)
+		self.assertEqual(self.chain.snapshot.state.get('Alice'), (1, 0))
+
+	def test_light_client_verifies_account_proof(self):
+		self.append(self.genesis, b'5:Alice:00:Bob:0')
+		client = LightClient(difficulty=0)
+		client.sync(self.chain.headers(client.locator()))
+		block_hash, height, value, proof = self.chain.account_proof('Bob')
+		self.assertEqual((height, value), (1, (5, 0)))
+		self.assertTrue(client.verify_account('Bob', value, proof, block_hash))
+		self.assertFalse(client.verify_account('Bob', (6, 0), proof, block_hash))
+		_, _, absent, proof = self.chain.account_proof('Dave')
+		self.assertTrue(client.verify_account('Dave', absent, proof, block_hash))
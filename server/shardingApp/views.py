@@ -3,33 +3,71 @@ from rest_framework.decorators import api_view
 from rest_framework.request import Request
 from rest_framework.response import Response
 from . import services
+from .admission import AdmissionRejected
 
 # Create your views here.
 @api_view(['POST'])
 def shard(req: Request):
-	transaction = services.process_transaction_request(req.data)
-	res = services.shard_transaction_request()
-	return Response(res, status=status.HTTP_200_OK)
+	""" Queue transaction in its shard, and start mining shards in the background. Follow progress on /events/ """
+	return _queue_and_mine(req, True)
 
 @api_view(['POST'])
 def normal(req: Request):
-	transaction = services.process_transaction_request(req.data)
-	# TODO: Perform some error handling if bad data
-	res = services.serial_transaction_request()
-	return Response(res, status=status.HTTP_200_OK)
+	""" Queue transaction in serial network, and start mining it in the background. Follow progress on /events/ """
+	return _queue_and_mine(req, False)
+
+def _queue_and_mine(req: Request, sharded: bool):
+	try:
+		if sharded:
+			queued = services.process_sharded_transaction_request(req.data)
+		else:
+			queued = services.process_serial_transaction_request(req.data)
+	except AdmissionRejected as rejected:
+		return Response(status=status.HTTP_429_TOO_MANY_REQUESTS, headers={'Retry-After': str(rejected.retry_after)})
+	except (KeyError, ValueError):
+		return Response(status=status.HTTP_400_BAD_REQUEST)
+	return Response({'queued': queued, 'mining': services.start_mining(sharded)}, status=status.HTTP_202_ACCEPTED)
 
 @api_view(['POST'])
 def transactions(req: Request):
-	""" Process array of transactions and append to blockchain queue """
-	queued_transactions = sum(
-		map(lambda transaction: services.process_transaction_request(transaction), req.data)
-	)
-	return Response(queued_transactions, statuts=status.HTTP_200_OK)
+	""" Process array of transactions and append to blockchain queue
+	If the network is overloaded, responds 429 with the number of transactions processed and queued
+	before the rejected one. Remaining transactions should be resent after Retry-After seconds
+	"""
+	queued_transactions = 0
+	for processed, transaction in enumerate(req.data):
+		try:
+			queued_transactions += services.process_transaction_request(transaction)
+		except AdmissionRejected as rejected:
+			return Response({'processed': processed, 'queued': queued_transactions},
+				status=status.HTTP_429_TOO_MANY_REQUESTS, headers={'Retry-After': str(rejected.retry_after)})
+	return Response(queued_transactions, status=status.HTTP_200_OK)
 
 @api_view(['GET'])
 def user(req: Request):
-	""" Get array of of all user Wallet info, and their private keys """
-	return Response(services.get_user_wallets(), status=status.HTTP_200_OK)
+	""" Get page of public user Wallet info. Supports conditional GET with If-None-Match """
+	try:
+		offset = max(int(req.query_params.get('offset', 0)), 0)
+		limit = int(req.query_params.get('limit', -1))
+	except ValueError:
+		return Response(status=status.HTTP_400_BAD_REQUEST)
+	etag = f'"{services.wallets.version}"'
+	if req.headers.get('If-None-Match') == etag:
+		return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+	version, page = services.get_user_wallets(offset, limit)
+	return Response(page, status=status.HTTP_200_OK, headers={
+		'ETag': f'"{version}"',
+		'X-Total-Count': str(len(services.wallets.users()))
+	})
+
+@api_view(['POST'])
+def keys(req: Request):
+	""" Generate new key pair for user Wallet, and return Wallet info with private key """
+	try:
+		res = services.provision_user_keys(req.data)
+	except (ValueError, KeyError):
+		return Response(status=status.HTTP_400_BAD_REQUEST)
+	return Response(res, status=status.HTTP_201_CREATED)
 
 @api_view(['GET'])
 def test(req: Request):
@@ -38,4 +76,73 @@ def test(req: Request):
 
 @api_view(['GET'])
 def test2(req: Request):
-	return Response(services.test2(), status=status.HTTP_200_OK)
\ No newline at end of file
+	return Response(services.test2(), status=status.HTTP_200_OK)
+
+@api_view(['GET'])
+def headers(req: Request):
+	""" Get compact block headers following client's block locator """
+	try:
+		res = services.get_headers(req.query_params)
+	except ValueError:
+		return Response(status=status.HTTP_400_BAD_REQUEST)
+	return Response(res, status=status.HTTP_200_OK)
+
+@api_view(['GET'])
+def proof(req: Request):
+	""" Get Merkle inclusion proof of confirmed transaction """
+	try:
+		res = services.get_transaction_proof(req.query_params)
+	except ValueError:
+		return Response(status=status.HTTP_400_BAD_REQUEST)
+	except KeyError:
+		return Response(status=status.HTTP_404_NOT_FOUND)
+	return Response(res, status=status.HTTP_200_OK)
+
+@api_view(['GET'])
+def account_proof(req: Request):
+	""" Get proof of account's confirmed balance change and nonce against the tip's state root """
+	try:
+		res = services.get_account_proof(req.query_params)
+	except ValueError:
+		return Response(status=status.HTTP_400_BAD_REQUEST)
+	return Response(res, status=status.HTTP_200_OK)
+
+@api_view(['GET', 'POST'])
+def profile(req: Request):
+	""" Get profiling state, or switch profiling mode """
+	if req.method == 'GET':
+		return Response({'mode': services.profiling.mode(), 'directory': services.profiling.directory()}, status=status.HTTP_200_OK)
+	try:
+		res = services.set_profiling(req.data)
+	except ValueError:
+		return Response(status=status.HTTP_400_BAD_REQUEST)
+	return Response(res, status=status.HTTP_200_OK)
+
+@api_view(['GET'])
+def shard_heads(req: Request):
+	""" Get chain head of every shard """
+	return Response(services.get_shard_heads(), status=status.HTTP_200_OK)
+
+@api_view(['GET'])
+def seen_filter(req: Request):
+	""" Get duplicate transaction filter statistics """
+	try:
+		res = services.get_seen_filter_report(req.query_params)
+	except ValueError:
+		return Response(status=status.HTTP_400_BAD_REQUEST)
+	return Response(res, status=status.HTTP_200_OK)
+
+@api_view(['POST'])
+def submit(req: Request):
+	""" Route array of transactions to their senders' shards. No shardId needed
+	Responds with the result of each transaction, null for those an overloaded shard did not process.
+	If any are null, responds 429 and they should be resent after Retry-After seconds
+	"""
+	try:
+		results, retry_after = services.submit_transactions(req.data)
+	except (KeyError, TypeError):
+		return Response(status=status.HTTP_400_BAD_REQUEST)
+	res = {'results': results, 'queued': sum(result is True for result in results)}
+	if retry_after != -1:
+		return Response(res, status=status.HTTP_429_TOO_MANY_REQUESTS, headers={'Retry-After': str(retry_after)})
+	return Response(res, status=status.HTTP_200_OK)
@@ -13,4 +13,13 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'shardingPoc.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from shardingApp.events import sse_application
+
+
+async def application(scope, receive, send):
+    """ Serve the event stream directly, and everything else through Django """
+    if scope['type'] == 'http' and scope['path'].startswith('/events/'):
+        return await sse_application(scope, receive, send)
+    return await django_application(scope, receive, send)
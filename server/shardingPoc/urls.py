@@ -15,13 +15,21 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path
-from shardingApp.views import shard, normal, user, transactions,test
+from shardingApp.views import shard, normal, user, transactions, test, headers, proof, account_proof, keys, profile, shard_heads, seen_filter, submit
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('get-user/', user),
+    path('provision-keys/', keys),
     path('parse-transactions', transactions),
     path('shard/', shard),
     path('normal/', normal),
-    path('test/', test)
+    path('test/', test),
+    path('headers/', headers),
+    path('proof/', proof),
+    path('account-proof/', account_proof),
+    path('profiling/', profile),
+    path('shard-heads/', shard_heads),
+    path('seen-filter/', seen_filter),
+    path('submit/', submit)
 ]